@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
-import sys, json, random
-from config import get_openai_client, MODEL_NAME, Timer
+import os, re, sys, json, time, random, hashlib, threading
+from datetime import date, timedelta
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from config import get_openai_client, MODEL_NAME, Timer, count_tokens, compute_cost
+from cache import AnswerCache
+from metrics import histogram, counter, timed, record_usage, MS_BUCKETS
+
+DETERMINISTIC_WEATHER = os.getenv("AGENT_DETERMINISTIC_WEATHER", "0") == "1"
 
 # ── Mock tool implementations ───────────────────────────────────────────────
 # Ai Generated Mock data
@@ -14,9 +21,11 @@ def search_flights(origin: str, destination: str, date: str, max_price: float =
     return [f for f in flights if f["price_nzd"] <= max_price]
 # Ai Generated Mock data
 def get_weather(city: str, date: str) -> dict:
+    # Deterministic mode seeds from (city, date) so runs, tests and cached results are reproducible
+    rng = random.Random(f"{city.strip().lower()}|{date.strip()}") if DETERMINISTIC_WEATHER else random
     return {"city": city, "date": date,
-            "condition": random.choice(["Sunny", "Partly Cloudy", "Overcast", "Light Rain", "Clear"]),
-            "high_c": random.randint(18, 26), "low_c": random.randint(10, 16), "rain_chance_pct": random.randint(0, 40)}
+            "condition": rng.choice(["Sunny", "Partly Cloudy", "Overcast", "Light Rain", "Clear"]),
+            "high_c": rng.randint(18, 26), "low_c": rng.randint(10, 16), "rain_chance_pct": rng.randint(0, 40)}
 # Ai Generated Mock data
 def search_attractions(city: str, category: str = "all") -> list[dict]:
     data = [
@@ -66,45 +75,349 @@ TOOL_DISPATCH = {
     "search_attractions": search_attractions, "search_accommodation": search_accommodation,
 }
 
+# ── Tool execution ──────────────────────────────────────────────────────────
+# All tool calls from one model turn run concurrently; each gets its own timeout, and a failure or timeout becomes
+# an {"error": ...} tool result instead of aborting the run. A timed-out call keeps its worker until it returns,
+# so the pool is shared and sized for several agent runs at once.
+
+TOOL_WORKERS = int(os.getenv("AGENT_TOOL_WORKERS", "16"))
+TOOL_TIMEOUT_S = float(os.getenv("AGENT_TOOL_TIMEOUT_S", "10"))
+TOOL_TIMEOUTS = {name: TOOL_TIMEOUT_S for name in TOOL_DISPATCH}  # per-tool overrides
+_tool_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+# ── Tool result cache ───────────────────────────────────────────────────────
+# Runs for the same trip repeat the same searches. Results are cached per tool (TTL in seconds, 0 = never cache)
+# under the tool name + canonicalised arguments; AGENT_TOOL_CACHE_PATH puts them in SQLite shared by API workers.
+
+TOOL_CACHE_TTLS = {"search_flights": 300, "search_accommodation": 900, "search_attractions": 86400, "get_weather": 1800}
+TOOL_CACHE_SIZE = int(os.getenv("AGENT_TOOL_CACHE_SIZE", "2000"))  # 0 disables
+TOOL_CACHE_PATH = os.getenv("AGENT_TOOL_CACHE_PATH", "")
+_tool_cache, _tool_cache_lock = None, threading.Lock()
+
+def _get_tool_cache():
+    global _tool_cache
+    if TOOL_CACHE_SIZE <= 0: return None
+    with _tool_cache_lock:
+        if _tool_cache is None:
+            _tool_cache = AnswerCache(TOOL_CACHE_SIZE, max(TOOL_CACHE_TTLS.values()), TOOL_CACHE_PATH or None)
+        return _tool_cache
+
+def _canonical(value):
+    """"Auckland " / "auckland", 2.0 / 2 and key order all map to the same cache key."""
+    if isinstance(value, str): return " ".join(value.split()).casefold()
+    if isinstance(value, float) and value.is_integer(): return int(value)
+    if isinstance(value, dict): return {k: _canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, list): return [_canonical(v) for v in value]
+    return value
+
+def _tool_key(name: str, args: dict) -> str:
+    return hashlib.sha1(json.dumps([name, _canonical(args)], sort_keys=True).encode()).hexdigest()
+
+def _cached_tool(name: str, args: dict, use_cache: bool = True):
+    """Cached result, or None. Records the lookup in agent_tool_cache_total{tool, result}."""
+    cache = _get_tool_cache() if use_cache else None
+    if cache is None or not TOOL_CACHE_TTLS.get(name): return None
+    hit = cache.get(_tool_key(name, args))
+    counter("agent_tool_cache_total", "Tool result cache lookups", task="agent", tool=name,
+            result="miss" if hit is None else "hit").inc()
+    return hit
+
+def _store_tool(name: str, args: dict, result, use_cache: bool = True):
+    cache = _get_tool_cache() if use_cache else None
+    if cache is None or not TOOL_CACHE_TTLS.get(name) or (isinstance(result, dict) and "error" in result): return
+    cache.put(_tool_key(name, args), result, TOOL_CACHE_TTLS[name])
+
+def _call_tool(name: str, args: dict, use_cache: bool = True) -> tuple[object, float]:
+    """(result, latency ms); exceptions become an error result."""
+    fn = TOOL_DISPATCH.get(name)
+    with timed(_tool_ms(name)) as t:
+        try:
+            result = fn(**args) if fn else {"error": "unknown tool"}
+        except Exception as e:
+            result = {"error": f"{name} failed: {type(e).__name__}: {e}"}
+    _store_tool(name, args, result, use_cache)
+    return result, t.elapsed_ms
+
+def _run_tools(tool_calls, use_cache: bool = True) -> list[tuple[object, dict, object, float, bool]]:
+    """Runs a turn's tool calls in parallel (cache hits inline, unless use_cache is off); returns
+    (tool_call, args, result, latency ms, cached) in tool_call order."""
+    start, futures = time.perf_counter(), []
+    for tc in tool_calls:
+        try:
+            args = json.loads(tc.function.arguments or "{}")
+        except json.JSONDecodeError as e:
+            futures.append((tc, {}, None, ({"error": f"invalid arguments: {e}"}, False)))
+            continue
+        hit = _cached_tool(tc.function.name, args, use_cache)
+        if hit is not None:
+            futures.append((tc, args, None, (hit, True)))
+        else:
+            futures.append((tc, args, _tool_pool.submit(_call_tool, tc.function.name, args, use_cache), None))
+    outcomes = []
+    for tc, args, fut, ready in futures:
+        if fut is None:
+            outcomes.append((tc, args, ready[0], 0.0, ready[1])); continue
+        timeout = TOOL_TIMEOUTS.get(tc.function.name, TOOL_TIMEOUT_S)
+        try:
+            result, ms = fut.result(timeout=max(0.0, start + timeout - time.perf_counter()))
+        except FutureTimeout:
+            result, ms = {"error": f"{tc.function.name} timed out after {timeout:g}s"}, timeout * 1000
+        outcomes.append((tc, args, result, ms, False))
+    return outcomes
+
+# ── Conversation compaction ─────────────────────────────────────────────────
+# Every iteration resends the whole conversation, so tool results are serialised compactly and projected to the
+# fields the itinerary needs, and once the prompt passes AGENT_PROMPT_BUDGET tokens the oldest tool results are
+# replaced by short summaries (the latest turn is always kept whole). AGENT_COMPACT=0 restores the verbose format.
+
+AGENT_COMPACT = os.getenv("AGENT_COMPACT", "1") != "0"
+AGENT_PROMPT_BUDGET = int(os.getenv("AGENT_PROMPT_BUDGET", "3000"))
+TOOL_MAX_ITEMS = 8
+TOOL_FIELDS = {
+    "search_flights": ["flight", "airline", "departure", "arrival", "price_nzd"],
+    "search_accommodation": ["name", "type", "price_per_night_nzd", "rating"],
+    "search_attractions": ["name", "category", "price_nzd", "rating", "duration_hrs"],
+}
+SUMMARY_ITEMS = 3
+SUMMARY_PREFIX = "[earlier result, summarised] "
+
+def _serialize_result(name: str, result) -> str:
+    if not AGENT_COMPACT: return json.dumps(result, indent=2)
+    if isinstance(result, list):
+        fields = TOOL_FIELDS.get(name)
+        items = [{k: r[k] for k in fields if k in r} if fields and isinstance(r, dict) else r for r in result]
+        result = items if len(items) <= TOOL_MAX_ITEMS else {"results": items[:TOOL_MAX_ITEMS], "omitted": len(items) - TOOL_MAX_ITEMS}
+    return json.dumps(result, separators=(",", ":"), ensure_ascii=False)
+
+def _summarize_result(name: str, content: str) -> str:
+    """A few cheapest items (identity + price) instead of the full list; small results are kept as they are."""
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return SUMMARY_PREFIX + content[:200]
+    items = data.get("results", data) if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items or not all(isinstance(i, dict) for i in items):
+        return SUMMARY_PREFIX + json.dumps(data, separators=(",", ":"))[:300]
+    price = next((k for k in ("price_nzd", "price_per_night_nzd") if k in items[0]), None)
+    keep = sorted(items, key=lambda i: i.get(price, 0))[:SUMMARY_ITEMS] if price else items[:SUMMARY_ITEMS]
+    fields = (TOOL_FIELDS.get(name) or list(items[0]))[:2] + ([price] if price else [])
+    brief = [{k: i[k] for k in dict.fromkeys(fields) if k in i} for i in keep]
+    return SUMMARY_PREFIX + f"{name}: {len(items)} results, cheapest {json.dumps(brief, separators=(',', ':'))}"
+
+def _message_tokens(m: dict) -> int:
+    return count_tokens(m.get("content") or "") + (count_tokens(json.dumps(m["tool_calls"])) if m.get("tool_calls") else 0)
+
+def _compact(messages: list[dict], budget: int = None) -> int:
+    """Summarise the oldest tool results in place until the prompt fits the budget; returns prompt tokens."""
+    budget = AGENT_PROMPT_BUDGET if budget is None else budget
+    tokens = sum(_message_tokens(m) for m in messages)
+    if not AGENT_COMPACT or tokens <= budget: return tokens
+    names = {tc["id"]: tc["function"]["name"] for m in messages if m.get("tool_calls") for tc in m["tool_calls"]}
+    latest = max((i for i, m in enumerate(messages) if m.get("tool_calls")), default=None)
+    if latest is None: return tokens  # no tool turn yet: nothing to summarise
+    for m in messages[:latest]:
+        if tokens <= budget: break
+        if m["role"] != "tool" or m["content"].startswith(SUMMARY_PREFIX): continue
+        before = _message_tokens(m)
+        m["content"] = _summarize_result(names.get(m["tool_call_id"], "tool"), m["content"])
+        tokens += _message_tokens(m) - before
+    return tokens
+
+# ── Speculative prefetch ────────────────────────────────────────────────────
+# SYSTEM_PROMPT's sequence is predictable, so with origin, destination, dates and budget read from the prompt the
+# flights, accommodation, weather and attractions calls can run up front (in parallel, through the tool cache) and be
+# handed to the model as an already-answered tool turn. Whatever the prompt does not pin down is left to the model.
+
+AGENT_PREFETCH = os.getenv("AGENT_PREFETCH", "0") == "1"
+PREFETCH_MAX_DAYS = 7
+MONTHS = ["january", "february", "march", "april", "may", "june", "july", "august", "september", "october",
+          "november", "december"]
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "a": 1}
+_PLACE = r"([A-Z][\w'-]*(?:\s+[A-Z][\w'-]*)*)\b(?!\$)"  # capitalised words, not a currency ("NZ$500")
+PREFETCH_NOTE = ("\nSome tool results are already in the conversation, fetched from the user's request; "
+                 "only call tools for information that is still missing.")
+
+def _month(word: str):
+    """1-12 for a month name or abbreviation ("mar", "Sept", "march"), else None."""
+    word = word.lower()
+    return next((i for i, m in enumerate(MONTHS, 1) if len(word) >= 3 and m.startswith(word)), None)
+
+def _parse_date(text: str, today: date):
+    """First date in the text: ISO, tomorrow, "15th of next month", "15 March", "March 15th"."""
+    t = text.lower()
+    if m := re.search(r"\b(\d{4}-\d{2}-\d{2})\b", t):
+        try: return date.fromisoformat(m.group(1))
+        except ValueError: pass
+    if "day after tomorrow" in t: return today + timedelta(days=2)
+    if re.search(r"\btomorrow\b", t): return today + timedelta(days=1)
+    candidates = [(m.start(), m.group(1), m.group(2)) for m in
+                  re.finditer(r"\b(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?(next month|this month|[a-z]{3,9})\b", t)]
+    candidates += [(m.start(), m.group(2), m.group(1)) for m in
+                   re.finditer(r"\b([a-z]{3,9})\s+(\d{1,2})(?:st|nd|rd|th)?\b(?![-\s]*(?:day|night))", t)]
+    for _, day, month_word in sorted(candidates):
+        if month_word == "this month": year, month = today.year, today.month
+        elif month_word == "next month": year, month = today.year + today.month // 12, today.month % 12 + 1
+        elif month := _month(month_word): year = today.year
+        else: continue
+        try:
+            d = date(year, month, int(day))
+        except ValueError:
+            continue
+        return d if d >= today or month_word == "this month" else d.replace(year=year + 1)
+    return None
+
+def _extract_trip(prompt: str, today: date = None) -> dict:
+    """origin, destination, start/end (YYYY-MM-DD), days, budget — only the keys the prompt resolves."""
+    today, trip = today or date.today(), {}
+    for pattern in (r"\b(?:trip|travel|fly|flying|going|getaway|holiday|head(?:ing)?)\s+to\s+" + _PLACE,
+                    r"\bto\s+" + _PLACE, r"\b(?:in|visit|visiting)\s+" + _PLACE):
+        if (m := re.search(pattern, prompt)) and not _month(m.group(1).split()[0]):
+            trip["destination"] = m.group(1); break
+    if (m := re.search(r"\b(?:from|departing|leaving)\s+" + _PLACE, prompt)) and m.group(1) != trip.get("destination"):
+        trip["origin"] = m.group(1)
+    if m := re.search(r"\b(\d{1,2}|" + "|".join(NUMBER_WORDS) + r")[-\s](day|night)s?\b", prompt, re.I):
+        n = int(m.group(1)) if m.group(1).isdigit() else NUMBER_WORDS[m.group(1).lower()]
+        trip["days"] = n + 1 if m.group(2).lower() == "night" else n
+    elif re.search(r"\bweekend\b", prompt, re.I):
+        trip["days"] = 2
+    if m := re.search(r"(?:under|below|budget(?:\s+of)?|max(?:imum)?|up to|less than|within)\s+(?:NZ)?\$?\s*([\d,]+(?:\.\d+)?)",
+                      prompt, re.I) or re.search(r"(?:NZ)?\$\s*([\d,]+(?:\.\d+)?)", prompt):
+        trip["budget"] = float(m.group(1).replace(",", ""))
+    if start := _parse_date(prompt, today):
+        trip["start"] = start.isoformat()
+        if "days" in trip: trip["end"] = (start + timedelta(days=trip["days"] - 1)).isoformat()
+    return trip
+
+def _prefetch_calls(trip: dict) -> list[tuple[str, dict]]:
+    """The calls SYSTEM_PROMPT's steps would make, for whatever the trip resolves (nothing without a destination)."""
+    dest = trip.get("destination")
+    if not dest: return []
+    calls = []
+    # Nothing dearer than the whole budget can fit it. search_accommodation's max_price caps the stay (per night x
+    # nights), so there the budget is a budget / nights cap per night.
+    cap = {"max_price": trip["budget"]} if trip.get("budget") else {}
+    if trip.get("origin") and trip.get("start"):
+        calls.append(("search_flights", {"origin": trip["origin"], "destination": dest, "date": trip["start"], **cap}))
+        if trip.get("end"):
+            calls.append(("search_flights", {"origin": dest, "destination": trip["origin"], "date": trip["end"], **cap}))
+    if trip.get("start") and trip.get("days", 0) > 1:
+        calls.append(("search_accommodation", {"city": dest, "checkin": trip["start"], "nights": trip["days"] - 1, **cap}))
+    if trip.get("start"):
+        start = date.fromisoformat(trip["start"])
+        calls += [("get_weather", {"city": dest, "date": (start + timedelta(days=i)).isoformat()})
+                  for i in range(min(trip.get("days", 1), PREFETCH_MAX_DAYS))]
+    calls.append(("search_attractions", {"city": dest}))
+    return calls
+
 # Agent loop
 
+LLM_MS = histogram("agent_llm_ms", MS_BUCKETS, "LLM call time per agent iteration", task="agent")
+ITERATIONS = histogram("agent_iterations", list(range(1, 16)), "LLM iterations per agent run", task="agent")
+
+def _tool_ms(name: str):
+    tool = name if name in TOOL_DISPATCH else "unknown"  # hallucinated names must not grow the label set
+    return histogram("agent_tool_ms", [0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000], "Tool call latency", task="agent", tool=tool)
+
 SYSTEM_PROMPT = """You are a travel planning agent. Use the provided tools to gather data, then output a JSON itinerary.
 Steps: 1) Search flights (outbound+return) 2) Search accommodation 3) Check weather 4) Search attractions 5) Build itinerary.
 Output JSON with: destination, total_budget_nzd, total_estimated_cost_nzd, days (array of {day, date, weather, activities}),
 flights, accommodation, budget_breakdown (flights, accommodation, activities, food_estimate).
 IMPORTANT: total cost MUST stay within budget."""
 
-def run_agent(user_prompt: str) -> dict:
+def _tool_turn(tool_calls, messages: list[dict], scratchpad: list[str], use_cache: bool = True) -> float:
+    """Runs one assistant turn's tool calls and appends the turn and its results; returns wall time in ms."""
+    # Convert SDK object to plain dict to avoid pydantic version conflicts
+    messages.append({
+        "role": "assistant",
+        "tool_calls": [{"id": tc.id, "type": "function",
+                        "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+                       for tc in tool_calls]
+    })
+    with Timer() as tt:
+        outcomes = _run_tools(tool_calls, use_cache)
+    # Appended in tool_call order, whatever order the calls finished in
+    for tc, fn_args, result, ms, cached in outcomes:
+        log = f" {tc.function.name}({json.dumps(fn_args)})  [{'cached' if cached else f'{ms:.0f} ms'}]"
+        print(log); scratchpad.append(log)
+        result_str = _serialize_result(tc.function.name, result)
+        print(f"     ->{len(result) if isinstance(result, list) else 1} result(s)")
+        scratchpad.append(f"  Result: {result_str[:200]}...")
+        messages.append({"role": "tool", "tool_call_id": tc.id, "content": result_str})
+    if len(outcomes) > 1:
+        log = f"  [{len(outcomes)} tools in parallel: {tt.elapsed_ms:.0f} ms wall, {sum(o[3] for o in outcomes):.0f} ms summed]"
+        print(log); scratchpad.append(log)
+    cache = _get_tool_cache() if use_cache else None
+    if cache:
+        hits = sum(o[4] for o in outcomes)
+        log = f"  [tool cache: {hits}/{len(outcomes)} hits this turn, {cache.stats()['hit_rate']:.0%} overall]"
+        print(log); scratchpad.append(log)
+    return tt.elapsed_ms
+
+def _prefetch(user_prompt: str, messages: list[dict], scratchpad: list[str], use_cache: bool = True):
+    """Runs _prefetch_calls for the prompt as a synthetic first tool turn; returns its wall time in ms, or None when
+    nothing could be resolved and the normal loop runs as usual."""
+    trip = _extract_trip(user_prompt)
+    calls = _prefetch_calls(trip)
+    missing = [k for k in ("origin", "destination", "start", "days", "budget") if k not in trip]
+    counter("agent_prefetch_total", "Prefetch attempts by how much of the trip the prompt resolved", task="agent",
+            result="skipped" if not calls else "partial" if missing else "full").inc()
+    if not calls:
+        log = "  [prefetch: no destination in the prompt, using the normal loop]"
+        print(log); scratchpad.append(log)
+        return None
+    print(f"\n{'─'*60}\nPrefetch: {json.dumps(trip)}")
+    messages[0]["content"] += PREFETCH_NOTE
+    tool_calls = [SimpleNamespace(id=f"prefetch_{i}", function=SimpleNamespace(name=name, arguments=json.dumps(args)))
+                  for i, (name, args) in enumerate(calls)]
+    ms = _tool_turn(tool_calls, messages, scratchpad, use_cache)
+    log = f"  [prefetch: {len(calls)} tools in {ms:.0f} ms" + (f"; unresolved {', '.join(missing)}]" if missing else "]")
+    print(log); scratchpad.append(log)
+    return ms
+
+def run_agent(user_prompt: str, on_step=None, prefetch: bool = None, use_cache: bool = True) -> dict:
+    """on_step, if given, is called after every iteration with
+    {"iteration", "llm_ms", "tools_ms", "prompt_tokens", "completion_tokens", "cost_usd",
+    "scratchpad": [lines added this iteration]} (background jobs record it); a prefetch turn is iteration 0.
+    prefetch (default AGENT_PREFETCH) runs the predictable tool calls before the first LLM call; use_cache=False
+    bypasses the tool cache for this run only."""
     client = get_openai_client()
     messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}]
     scratchpad = []
 
+    totals = {"prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+    if AGENT_PREFETCH if prefetch is None else prefetch:
+        tools_ms = _prefetch(user_prompt, messages, scratchpad, use_cache)
+        if on_step and tools_ms is not None:
+            on_step({"iteration": 0, "llm_ms": 0.0, "tools_ms": tools_ms, "prompt_tokens": 0, "completion_tokens": 0,
+                     "cost_usd": 0.0, "scratchpad": list(scratchpad)})
+
     for iteration in range(15):
         print(f"\n{'─'*60}\nAgent iteration {iteration + 1}")
-        with Timer() as t:
+        estimate = _compact(messages)
+        with timed(LLM_MS) as t:
             resp = client.chat.completions.create(model=MODEL_NAME, messages=messages, tools=TOOLS_SPEC, tool_choice="auto")
         msg = resp.choices[0].message
-        print(f"  [latency: {t.elapsed_ms:.0f} ms]")
+        usage = {"prompt_tokens": resp.usage.prompt_tokens if resp.usage else estimate,
+                 "completion_tokens": resp.usage.completion_tokens if resp.usage else count_tokens(
+                     (msg.content or "") + "".join(tc.function.arguments for tc in msg.tool_calls or []))}
+        usage["cost_usd"] = compute_cost(usage["prompt_tokens"], usage["completion_tokens"])
+        record_usage("agent", usage["prompt_tokens"], usage["completion_tokens"])
+        for k in totals: totals[k] += usage[k]
+        print(f"  [latency: {t.elapsed_ms:.0f} ms | prompt {usage['prompt_tokens']} tok, "
+              f"completion {usage['completion_tokens']} tok, ${usage['cost_usd']:.4f}]")
 
         if msg.tool_calls:
-            # Convert SDK object to plain dict to avoid pydantic version conflicts
-            messages.append({
-                "role": "assistant",
-                "tool_calls": [{"id": tc.id, "type": "function",
-                                "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
-                               for tc in msg.tool_calls]
-            })
-            for tc in msg.tool_calls:
-                fn_name, fn_args = tc.function.name, json.loads(tc.function.arguments)
-                log = f" {fn_name}({json.dumps(fn_args)})"
-                print(log); scratchpad.append(log)
-
-                result = TOOL_DISPATCH.get(fn_name, lambda **kw: {"error": "unknown tool"})(**fn_args)
-                result_str = json.dumps(result, indent=2)
-                print(f"     ->{len(result) if isinstance(result, list) else 1} result(s)")
-                scratchpad.append(f"  Result: {result_str[:200]}...")
-                messages.append({"role": "tool", "tool_call_id": tc.id, "content": result_str})
+            step_start = len(scratchpad)
+            tools_ms = _tool_turn(msg.tool_calls, messages, scratchpad, use_cache)
+            if on_step:
+                on_step({"iteration": iteration + 1, "llm_ms": t.elapsed_ms, "tools_ms": tools_ms, **usage,
+                         "scratchpad": scratchpad[step_start:]})
         else:
+            if on_step:
+                on_step({"iteration": iteration + 1, "llm_ms": t.elapsed_ms, "tools_ms": 0.0, **usage, "scratchpad": []})
+            ITERATIONS.observe(iteration + 1)
+            scratchpad.append(f"Tokens: prompt {totals['prompt_tokens']}, completion {totals['completion_tokens']}, "
+                              f"cost ${totals['cost_usd']:.4f} over {iteration + 1} iterations")
             content = msg.content or ""
             print(f"\n{'═'*60}\nAgent finished.\n")
             try:
@@ -119,6 +432,7 @@ def run_agent(user_prompt: str) -> dict:
             for e in scratchpad: print(e)
             return itinerary
 
+    ITERATIONS.observe(15)
     return {"error": "Max iterations reached", "scratchpad": scratchpad}
 
 
@@ -183,6 +497,34 @@ def _print_itinerary(it: dict):
     print(f"{'─'*60}\nRaw JSON:")
     print(json.dumps(it, indent=2))
 
+def compare_prefetch(prompt: str) -> dict:
+    """Runs the prompt with and without prefetch (tool cache off, so neither run warms the other) and reports
+    LLM iterations, LLM/tool time, tokens and end-to-end latency for each."""
+    report = {}
+    for mode, prefetch in (("normal", False), ("prefetch", True)):
+        steps = []
+        with Timer() as t:
+            result = run_agent(prompt, on_step=steps.append, prefetch=prefetch, use_cache=False)
+        report[mode] = {"iterations": sum(s["iteration"] > 0 for s in steps), "wall_ms": round(t.elapsed_ms, 1),
+                        "llm_ms": round(sum(s["llm_ms"] for s in steps), 1),
+                        "tools_ms": round(sum(s["tools_ms"] for s in steps), 1),
+                        "prompt_tokens": sum(s["prompt_tokens"] for s in steps),
+                        "cost_usd": round(sum(s["cost_usd"] for s in steps), 6), "ok": "error" not in result}
+    base, fast = report["normal"], report["prefetch"]
+    report["reduction"] = {"iterations": base["iterations"] - fast["iterations"],
+                           "wall_pct": round(100 * (1 - fast["wall_ms"] / base["wall_ms"]), 1) if base["wall_ms"] else 0.0}
+    print(f"\n{'═'*60}\nPrefetch comparison")
+    print(f"  {'mode':10s} {'iters':>6s} {'wall ms':>10s} {'llm ms':>10s} {'tools ms':>9s} {'prompt tok':>11s} {'cost':>9s}")
+    for mode in ("normal", "prefetch"):
+        r = report[mode]
+        print(f"  {mode:10s} {r['iterations']:6d} {r['wall_ms']:10.0f} {r['llm_ms']:10.0f} {r['tools_ms']:9.0f} "
+              f"{r['prompt_tokens']:11d} ${r['cost_usd']:.4f}")
+    print(f"  -> {report['reduction']['iterations']} fewer iterations, {report['reduction']['wall_pct']:.1f}% lower latency")
+    return report
+
 if __name__ == "__main__":
-    prompt = " ".join(sys.argv[1:]) or "Plan a 2-day trip to Auckland for under NZ$500. Departing from Wellington on the 15th of next month."
-    run_agent(prompt)
\ No newline at end of file
+    # python agent.py [--prefetch | --compare] [prompt]
+    flags = {a for a in sys.argv[1:] if a.startswith("--")}
+    prompt = " ".join(a for a in sys.argv[1:] if not a.startswith("--")) or "Plan a 2-day trip to Auckland for under NZ$500. Departing from Wellington on the 15th of next month."
+    if "--compare" in flags: compare_prefetch(prompt)
+    else: run_agent(prompt, prefetch=True if "--prefetch" in flags else None)
\ No newline at end of file
@@ -1,32 +1,252 @@
 #!/usr/bin/env python3
+import os, json, math, time, asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Literal, Optional, Union
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from rag import query as rag_query
+from metrics import histogram, counter, gauge, registered, render_prometheus
+from rag import aquery as rag_query, aquery_stream as rag_query_stream, batch as rag_batch, warm_up, BATCH_CONCURRENCY, BATCH_RPS
 from agent import run_agent
+from jobs import JobStore, JobQueue, QueueFull
 
-app = FastAPI(title="AI Assessment API", version="1.0")
+# ── Admission control ───────────────────────────────────────────────────────
+# Each endpoint family gets its own concurrency limit and bounded wait queue, so a burst of slow /agent/plan calls
+# can't take the slots (or threads) /rag/query needs. Saturated endpoints answer 429 (queue full) or 503 (waited
+# ADMISSION_WAIT_S without a slot), both with Retry-After.
+
+RAG_CONCURRENCY = int(os.getenv("RAG_CONCURRENCY", "16"))
+RAG_QUEUE = int(os.getenv("RAG_QUEUE", "64"))
+AGENT_CONCURRENCY = int(os.getenv("AGENT_CONCURRENCY", "4"))
+AGENT_QUEUE = int(os.getenv("AGENT_QUEUE", "16"))
+ADMISSION_WAIT_S = float(os.getenv("ADMISSION_WAIT_S", "10"))
+
+class AdmissionGate:
+    """Semaphore with a bounded number of waiters, plus the counters the stats endpoint reports."""
+    def __init__(self, name: str, limit: int, max_queue: int, max_wait_s: float = ADMISSION_WAIT_S):
+        self.name, self.limit, self.max_queue, self.max_wait_s = name, limit, max_queue, max_wait_s
+        self.active = self.waiting = self.rejected = self.timed_out = 0
+        self._sem = asyncio.Semaphore(limit)
+        self.wait_ms = histogram("api_queue_wait_ms", [1, 5, 10, 50, 100, 500, 1000, 5000, 10000],
+                                 "Time requests waited for an admission slot", endpoint=name)
+        self._rejections = {status: counter("api_rejected_total", "Requests turned away by admission control",
+                                            endpoint=name, status=status) for status in (429, 503)}
+        gauge("api_active_requests", lambda: self.active, "Requests holding an admission slot", endpoint=name)
+        gauge("api_queued_requests", lambda: self.waiting, "Requests waiting for an admission slot", endpoint=name)
+    def _reject(self, status: int, detail: str):
+        # Rough time until a slot frees up: the full wait budget when timing out, less when only the queue is full
+        retry = math.ceil(self.max_wait_s if status == 503 else max(1.0, self.max_wait_s / 2))
+        self._rejections[status].inc()
+        raise HTTPException(status_code=status, detail=detail, headers={"Retry-After": str(retry)})
+    async def acquire(self):
+        if self._sem.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            self._reject(429, f"{self.name}: {self.waiting} requests already queued")
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.max_wait_s)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            self._reject(503, f"{self.name}: no slot free within {self.max_wait_s:g}s")
+        finally:
+            self.waiting -= 1
+            self.wait_ms.observe((time.perf_counter() - start) * 1000)
+        self.active += 1
+    def release(self):
+        self.active -= 1
+        self._sem.release()
+    def releaser(self):
+        """Once-only, thread-safe release for streamed responses: called from the body's finally and again as the
+        response's background task (which covers a client that disconnects before the body runs). Either may run
+        in a worker thread, so the semaphore is released back on the event loop. Call from the endpoint."""
+        loop, once = asyncio.get_running_loop(), threading.Lock()
+        def release():
+            if once.acquire(blocking=False):
+                loop.call_soon_threadsafe(self.release)
+        return release
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "queued": self.waiting, "max_queue": self.max_queue,
+                "rejected": self.rejected, "timed_out": self.timed_out, "wait_ms": self.wait_ms.snapshot()}
+
+rag_gate = AdmissionGate("rag", RAG_CONCURRENCY, RAG_QUEUE)
+# A batch fans out to many LLM calls, so batches get their own (small) gate instead of one rag slot each
+batch_gate = AdmissionGate("rag_batch", int(os.getenv("RAG_BATCH_JOBS", "2")), int(os.getenv("RAG_BATCH_QUEUE", "4")))
+agent_gate = AdmissionGate("agent", AGENT_CONCURRENCY, AGENT_QUEUE)
+# run_agent is a blocking loop of LLM calls; its own pool keeps it off the default executor RAG retrieval uses
+agent_executor = ThreadPoolExecutor(max_workers=AGENT_CONCURRENCY, thread_name_prefix="agent")
+
+# Background agent jobs (see jobs.py): built on first use, resumed on startup
+_job_queue = None
+JOB_POLL_S = 0.5
+
+def job_queue() -> JobQueue:
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue(JobStore(), {"agent_plan": lambda payload, on_step: run_agent(
+            payload["prompt"], on_step=on_step, prefetch=payload.get("prefetch"))})
+        gauge("agent_jobs_pending", lambda: _job_queue.stats()["pending"], "Agent jobs queued or running")
+    return _job_queue
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"[warm-up] skipped: {e}")  # first request will build them instead
+    resumed = job_queue().resume()
+    if resumed: print(f"[jobs] resumed {resumed} unfinished job(s)")
+    yield
+    agent_executor.shutdown(wait=False, cancel_futures=True)
+    if _job_queue: _job_queue.shutdown()
+
+app = FastAPI(title="AI Assessment API", version="1.0", lifespan=lifespan)
 
 class QueryRequest(BaseModel):
     question: str
     top_k: int = 5
+    mode: Optional[Literal["vector", "lexical", "hybrid"]] = None  # None = RAG_RETRIEVAL_MODE (hybrid)
+
+class BatchItem(BaseModel):
+    question: str
+    id: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    questions: list[Union[str, BatchItem]]
+    top_k: int = 5
+    mode: Optional[Literal["vector", "lexical", "hybrid"]] = None
+    concurrency: int = BATCH_CONCURRENCY  # parallel LLM calls, capped at RAG_BATCH_CONCURRENCY
+    rps: float = BATCH_RPS                # LLM calls started per second, 0 = unlimited
 
 class AgentRequest(BaseModel):
     prompt: str
+    prefetch: Optional[bool] = None  # speculative tool prefetch, default AGENT_PREFETCH
 
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus scrape endpoint: latency histograms, token/cost counters, queue gauges."""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get("/rag/embedder/stats")
+def embedder_stats():
+    """Batch-size and queue-wait histograms of the query-embedding micro-batcher."""
+    return {name: h.snapshot() for name, h in registered().items() if name.startswith("rag_embed_")}
+
+@app.get("/admission/stats")
+def admission_stats():
+    """Per-endpoint slots in use, queue depth, rejections and queue-wait histogram."""
+    return {gate.name: gate.stats() for gate in (rag_gate, batch_gate, agent_gate)}
+
+# One store row per answered query (0 or 1) feeds the dashboard's hit-rate panel; /metrics gets the running total
+CACHE_HITS = counter("rag_cache_hits_total", "RAG answers served from the answer cache", task="rag")
+
 @app.post("/rag/query")
-def rag_endpoint(req: QueryRequest):
-    try:
-        return rag_query(req.question, top_k=req.top_k, verbose=False)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def rag_endpoint(req: QueryRequest):
+    async with rag_gate.slot():
+        try:
+            result = await rag_query(req.question, top_k=req.top_k, mode=req.mode)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    CACHE_HITS.inc(int(result["cached"]))
+    return result
+
+@app.post("/rag/query/stream")
+async def rag_stream_endpoint(req: QueryRequest):
+    """Server-sent events: `sources` first, then one `token` event per answer delta, then `done` with timings."""
+    await rag_gate.acquire()  # before the response starts, so saturation is still a plain 429/503
+    release = rag_gate.releaser()
+    async def events():
+        try:
+            async for event, data in rag_query_stream(req.question, top_k=req.top_k, mode=req.mode):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event == "done":
+                    CACHE_HITS.inc(int(data["cached"]))
+        except Exception as e:
+            # Headers are already sent, so errors travel in-band
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+        finally:
+            release()
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"},
+                             background=BackgroundTask(release))
+
+def _batch_rps(requested: float) -> float:
+    """A client may ask for a slower rate than RAG_BATCH_RPS, never a faster or unlimited (0) one."""
+    if not BATCH_RPS: return max(0.0, requested)
+    return min(requested, BATCH_RPS) if requested > 0 else BATCH_RPS
+
+@app.post("/rag/query/batch")
+async def rag_batch_endpoint(req: BatchRequest):
+    """NDJSON stream: one result per question in input order, then a {"summary": ...} line with throughput and cost."""
+    await batch_gate.acquire()
+    release = batch_gate.releaser()
+    items = [q if isinstance(q, str) else q.model_dump(exclude_none=True) for q in req.questions]
+    def rows():
+        try:
+            for row in rag_batch(items, top_k=req.top_k, mode=req.mode,
+                                 concurrency=max(1, min(req.concurrency, BATCH_CONCURRENCY)), rps=_batch_rps(req.rps)):
+                yield json.dumps(row) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            release()
+    # A sync generator: Starlette iterates it in a worker thread, so the blocking retrieval/LLM work stays off the loop
+    return StreamingResponse(rows(), media_type="application/x-ndjson", background=BackgroundTask(release))
 
 @app.post("/agent/plan")
-def agent_endpoint(req: AgentRequest):
+async def agent_endpoint(req: AgentRequest):
+    async with agent_gate.slot():
+        try:
+            return await asyncio.get_running_loop().run_in_executor(agent_executor, run_agent, req.prompt, None, req.prefetch)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/agent/jobs", status_code=202)
+def submit_agent_job(req: AgentRequest):
+    """Queue an agent run; poll GET /agent/jobs/{id} or follow /agent/jobs/{id}/events."""
     try:
-        return run_agent(req.prompt)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        job_id = job_queue().submit("agent_plan", {"prompt": req.prompt, "prefetch": req.prefetch})
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/agent/jobs/{job_id}")
+def get_agent_job(job_id: str):
+    job = job_queue().store.get(job_id)
+    if job is None: raise HTTPException(status_code=404, detail="unknown job")
+    return job
+
+@app.get("/agent/jobs/{job_id}/events")
+async def agent_job_events(job_id: str):
+    """Server-sent events: `status` on each change, `step` per agent iteration, then `done` or `failed`."""
+    if job_queue().store.get(job_id) is None: raise HTTPException(status_code=404, detail="unknown job")
+    async def events():
+        status, sent = None, 0
+        while True:
+            job = await asyncio.to_thread(job_queue().store.get, job_id)
+            if job["status"] != status:
+                status = job["status"]
+                yield f"event: status\ndata: {json.dumps({'status': status})}\n\n"
+            steps = job["steps"] or []
+            if len(steps) < sent: sent = 0  # job restarted after an API restart
+            for step in steps[sent:]:
+                yield f"event: step\ndata: {json.dumps(step)}\n\n"
+            sent = len(steps)
+            if status in ("done", "failed"):
+                data = {"result": job["result"]} if status == "done" else {"error": job["error"]}
+                yield f"event: {status}\ndata: {json.dumps(data)}\n\n"
+                return
+            await asyncio.sleep(JOB_POLL_S)
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
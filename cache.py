@@ -0,0 +1,239 @@
+import os, json, time, sqlite3, hashlib, threading
+from collections import OrderedDict
+from array import array
+
+# ── Embedding cache ─────────────────────────────────────────────────────────
+
+class EmbeddingCache:
+    """On-disk text -> embedding cache in SQLite, keyed by sha1(model id + text), LRU-evicted past max_entries.
+    Safe to share between threads, and between processes (WAL), e.g. ingest and the API. Hits only note their
+    last-used time in memory; those touches are written with the next put_many, or every TOUCH_FLUSH_S, so a
+    lookup stays a read."""
+
+    TOUCH_FLUSH_S = 60
+
+    def __init__(self, path: str, model_id: str, max_entries: int = 200_000):
+        self.model_id, self.max_entries = model_id, max_entries
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._touched, self._flushed = {}, time.monotonic()  # key -> last used, not yet written
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")  # with WAL: no fsync per commit, still safe if the app crashes
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB, used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self._size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_id}\0{text}".encode()).hexdigest()
+
+    def get_many(self, texts: list[str]) -> list:
+        """Cached vector per text, or None for a miss."""
+        keys = [self._key(t) for t in texts]
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):  # stay under SQLite's bound-parameter limit
+                part = keys[i:i + 500]
+                found.update(self._conn.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part))
+            now = time.time()
+            self._touched.update(dict.fromkeys(found, now))
+            if self._touched and time.monotonic() - self._flushed > self.TOUCH_FLUSH_S:
+                self._flush_touches(); self._conn.commit()
+        out = []
+        for k in keys:
+            if k in found:
+                vec = array("f"); vec.frombytes(found[k])
+                out.append(vec.tolist())
+            else:
+                out.append(None)
+        self.hits += len(keys) - out.count(None)
+        self.misses += out.count(None)
+        return out
+
+    def put_many(self, texts: list[str], vectors: list):
+        now = time.time()
+        rows = [(self._key(t), array("f", (float(x) for x in v)).tobytes(), now) for t, v in zip(texts, vectors)]
+        with self._lock:
+            self._flush_touches()  # eviction below must see recent hits
+            before = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO embeddings (key, vec, used) VALUES (?, ?, ?)", rows)
+            self._size += self._conn.total_changes - before
+            if self._size > self.max_entries:
+                # Evict the least recently used ~10% beyond the cap so we don't evict on every insert
+                n = self._size - int(self.max_entries * 0.9)
+                self._conn.execute("DELETE FROM embeddings WHERE key IN "
+                                   "(SELECT key FROM embeddings ORDER BY used LIMIT ?)", (n,))
+                self._size -= n
+            self._conn.commit()
+
+    def _flush_touches(self):
+        self._flushed = time.monotonic()
+        if self._touched:
+            self._conn.executemany("UPDATE embeddings SET used = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()])
+            self._touched = {}
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": self._size,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+# ── Answer cache ────────────────────────────────────────────────────────────
+
+class AnswerCache:
+    """LRU + TTL cache for JSON-serialisable values (RAG answers, agent tool results). With a path, entries are also
+    written to SQLite, reloaded on start and read through on a memory miss, so a restarted API keeps its warm
+    entries and several worker processes sharing the file share them too. The LRU cap is per process and evicts
+    from memory only; disk rows go when they expire (swept every SWEEP_S) or past max_disk_entries, soonest-expiring
+    first (default 10 x max_entries)."""
+
+    SWEEP_S = 60
+
+    def __init__(self, max_entries: int = 1000, ttl_s: float = 3600, path: str = None, max_disk_entries: int = None):
+        self.max_entries, self.ttl_s = max_entries, ttl_s
+        self.max_disk_entries = max_disk_entries or 10 * max_entries
+        self._swept = time.monotonic()
+        self.hits = self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value), oldest first
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self._conn.execute("DELETE FROM answers WHERE expires < ?", (time.time(),))
+            self._conn.commit()
+            for key, value, expires in self._conn.execute(
+                    "SELECT key, value, expires FROM answers ORDER BY expires DESC LIMIT ?", (max_entries,)).fetchall()[::-1]:
+                self._data[key] = (expires, json.loads(value))
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._drop(key); entry = None
+                if self._conn: self._conn.commit()
+            if entry is None and self._conn:
+                # Another process may have written it since we started
+                row = self._conn.execute("SELECT expires, value FROM answers WHERE key = ? AND expires >= ?",
+                                         (key, time.time())).fetchone()
+                if row:
+                    entry = self._data[key] = (row[0], json.loads(row[1]))
+                    if len(self._data) > self.max_entries: self._data.popitem(last=False)  # memory only; disk keeps it
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value, ttl_s: float = None):
+        expires = time.time() + (self.ttl_s if ttl_s is None else ttl_s)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)  # memory only: other processes may still be using the disk row
+            if self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO answers (key, value, expires) VALUES (?, ?, ?)",
+                                   (key, json.dumps(value), expires))
+                if time.monotonic() - self._swept > self.SWEEP_S: self._sweep()
+                self._conn.commit()
+
+    def _sweep(self):
+        """Deletes expired disk rows, then the soonest-expiring ones beyond max_disk_entries."""
+        self._swept = time.monotonic()
+        self._conn.execute("DELETE FROM answers WHERE expires < ?", (time.time(),))
+        self._conn.execute("DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY expires DESC LIMIT -1 "
+                           "OFFSET ?)", (self.max_disk_entries,))
+
+    def _drop(self, key: str):
+        """Forgets an expired entry, on disk too: it has expired for every process."""
+        self._data.pop(key, None)
+        if self._conn: self._conn.execute("DELETE FROM answers WHERE key = ? AND expires < ?", (key, time.time()))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data),
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+# ── Solution cache ──────────────────────────────────────────────────────────
+
+class SolutionCache:
+    """Verified healer solutions in SQLite, content-addressed by sha1(normalized task, language, model), with how
+    often re-running their tests passed and failed; plus fixes keyed by sha1(language, model, failing code, error
+    signature). Callers re-verify every entry by running its tests, so a stale one costs a test run, never a wrong
+    answer. Safe to share between threads and processes (WAL)."""
+
+    def __init__(self, path: str):
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS solutions (key TEXT PRIMARY KEY, task TEXT, lang TEXT, model TEXT, "
+                           "blocks TEXT, passes INTEGER DEFAULT 0, fails INTEGER DEFAULT 0, ok INTEGER, used REAL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS fixes (key TEXT PRIMARY KEY, blocks TEXT, passes INTEGER DEFAULT 0, "
+                           "fails INTEGER DEFAULT 0, used REAL)")
+        self._conn.commit()
+
+    @staticmethod
+    def _key(*parts) -> str:
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, task: str, lang: str, model: str):
+        """{"blocks", "passes", "fails"} if the last run of this solution's tests passed, else None."""
+        with self._lock:
+            row = self._conn.execute("SELECT blocks, passes, fails FROM solutions WHERE key = ? AND ok = 1",
+                                     (self._key(task, lang, model),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"blocks": json.loads(row[0]), "passes": row[1], "fails": row[2]}
+
+    def put(self, task: str, lang: str, model: str, blocks: list[str]):
+        """Stores (or replaces) the solution whose tests just passed."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO solutions (key, task, lang, model, blocks, passes, ok, used) VALUES (?, ?, ?, ?, ?, 1, 1, ?) "
+                "ON CONFLICT (key) DO UPDATE SET blocks = excluded.blocks, passes = passes + 1, ok = 1, used = excluded.used",
+                (self._key(task, lang, model), task, lang, model, json.dumps(blocks), time.time()))
+            self._conn.commit()
+
+    def record(self, task: str, lang: str, model: str, passed: bool):
+        """Result of re-running a cached solution's tests; a failure hides it until a new solution is put."""
+        col = "passes" if passed else "fails"
+        with self._lock:
+            self._conn.execute(f"UPDATE solutions SET {col} = {col} + 1, ok = ?, used = ? WHERE key = ?",
+                               (int(passed), time.time(), self._key(task, lang, model)))
+            self._conn.commit()
+
+    def get_fix(self, lang: str, model: str, code: list[str], signature: str):
+        """Code that once fixed this failing code with this error signature, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT blocks FROM fixes WHERE key = ? AND passes > fails",
+                                     (self._key(lang, model, code, signature),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_fix(self, lang: str, model: str, code: list[str], signature: str, blocks: list[str], passed: bool = True):
+        """Records a fix's test result: a pass stores (or replaces) it, a failure counts against it."""
+        key = self._key(lang, model, code, signature)
+        with self._lock:
+            if passed:
+                self._conn.execute("INSERT INTO fixes (key, blocks, passes, used) VALUES (?, ?, 1, ?) ON CONFLICT (key) "
+                                   "DO UPDATE SET blocks = excluded.blocks, passes = passes + 1, used = excluded.used",
+                                   (key, json.dumps(blocks), time.time()))
+            else:
+                self._conn.execute("UPDATE fixes SET fails = fails + 1, used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM solutions").fetchone()[0]
+            fixes = self._conn.execute("SELECT COUNT(*) FROM fixes").fetchone()[0]
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": size, "fixes": fixes,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
@@ -1,34 +1,89 @@
 #!/usr/bin/env python3
-import sqlite3, os, argparse
-from config import get_openai_client, MODEL_NAME, count_tokens, compute_cost, Timer
+import sqlite3, os, time, argparse
+from collections import deque
+from config import get_openai_client, MODEL_NAME, count_tokens, compute_cost
+from metrics import histogram, timed, record_usage, MS_BUCKETS
 
 MAX_HISTORY = 10  # default, overridden by --history arg
+MAX_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "4000"))  # overridden by --history-tokens
 DB_PATH = os.path.join(os.path.dirname(__file__), "chat_history.db")
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+LLM_MS = histogram("chat_llm_ms", MS_BUCKETS, "Streamed reply time, to last token", task="chat")
+TTFT_MS = histogram("chat_ttft_ms", MS_BUCKETS, "Time to first streamed token", task="chat")
 
 # ── SQLite history store ────────────────────────────────────────────────────
+# Each row carries its token count, computed once on insert, so choosing the history that fits a token budget never
+# re-tokenizes it. id is the rowid, so "newest first" walks the table's own b-tree and stops after max_messages rows.
 
-def _init_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, role TEXT, content TEXT)")
+def _init_db(path: str = None):
+    conn = sqlite3.connect(path or DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # with WAL: no fsync per commit, still safe if the app crashes
+    conn.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, role TEXT, content TEXT, "
+                 "token_count INTEGER)")
+    if "token_count" not in {row[1] for row in conn.execute("PRAGMA table_info(messages)")}:
+        # History from before token counts: add the column and count every stored message once
+        conn.execute("ALTER TABLE messages ADD COLUMN token_count INTEGER")
+        rows = conn.execute("SELECT id, content FROM messages").fetchall()
+        conn.executemany("UPDATE messages SET token_count = ? WHERE id = ?", [(count_tokens(c or ""), i) for i, c in rows])
+    conn.commit()
     return conn
 
-def _add_message(conn, role: str, content: str):
-    conn.execute("INSERT INTO messages (role, content) VALUES (?, ?)", (role, content))
+def _add_messages(conn, rows: list[tuple[str, str, int]]):
+    """(role, content, token_count) rows in one transaction — one commit per turn."""
+    conn.executemany("INSERT INTO messages (role, content, token_count) VALUES (?, ?, ?)", rows)
     conn.commit()
 
-def _get_last_n(conn, n: int) -> list[dict]:
-    rows = conn.execute("SELECT role, content FROM messages ORDER BY id DESC LIMIT ?", (n,)).fetchall()
-    return [{"role": r, "content": c} for r, c in reversed(rows)]
+def _get_history(conn, max_messages: int, max_tokens: int) -> list[tuple[str, str, int]]:
+    """Newest messages, oldest first, that fit both caps (the newest one always), as (role, content, token_count)."""
+    return conn.execute(
+        "SELECT role, content, token_count FROM ("
+        "  SELECT id, role, content, token_count, SUM(token_count) OVER (ORDER BY id DESC) AS running"
+        "  FROM (SELECT id, role, content, token_count FROM messages ORDER BY id DESC LIMIT ?)"
+        ") WHERE running <= ? OR running = token_count ORDER BY id", (max_messages, max_tokens)).fetchall()
+
+class _Window:
+    """The history sent with each request: the newest messages within both caps, same rule as _get_history. Kept
+    in memory after start-up, so a turn costs the same however much history is stored."""
+
+    def __init__(self, max_messages: int, max_tokens: int, rows: list[tuple[str, str, int]] = ()):
+        self.max_messages, self.max_tokens = max_messages, max_tokens
+        self._items, self.tokens = deque(), 0
+        for row in rows: self.append(*row)
+
+    def append(self, role: str, content: str, tokens: int) -> list:
+        """Adds a message, evicting the oldest to fit both caps; returns what was evicted, for undo()."""
+        self._items.append(({"role": role, "content": content}, tokens))
+        self.tokens += tokens
+        evicted = []
+        while len(self._items) > 1 and (len(self._items) > self.max_messages or self.tokens > self.max_tokens):
+            evicted.append(self._items.popleft())
+            self.tokens -= evicted[-1][1]
+        return evicted
+
+    def undo(self, evicted: list):
+        """Takes back the newest append(), given what it evicted."""
+        self.tokens -= self._items.pop()[1]
+        self._items.extendleft(reversed(evicted))
+        self.tokens += sum(tokens for _, tokens in evicted)
+
+    def messages(self) -> list[dict]:
+        return [m for m, _ in self._items]
+
+    def __len__(self):
+        return len(self._items)
 
 # ── Chat loop ───────────────────────────────────────────────────────────────
 
-def chat_loop(max_history: int = MAX_HISTORY):
+def chat_loop(max_history: int = MAX_HISTORY, max_history_tokens: int = MAX_HISTORY_TOKENS):
     client = get_openai_client()
     conn = _init_db()
-    existing = _get_last_n(conn, max_history)
-    if existing:
-        print(f"(Restored {len(existing)} messages from previous session)")
-    print(f"Chat with Assistant — history={max_history} (type 'quit' to exit)\n")
+    window = _Window(max_history, max_history_tokens, _get_history(conn, max_history, max_history_tokens))
+    if window:
+        print(f"(Restored {len(window)} messages, {window.tokens} tokens, from previous session)")
+    print(f"Chat with Assistant — history={max_history} messages / {max_history_tokens} tokens (type 'quit' to exit)\n")
+    system_tokens = count_tokens(SYSTEM_PROMPT)
 
     while True:
         try:
@@ -40,31 +95,43 @@ def chat_loop(max_history: int = MAX_HISTORY):
         if not user_input:
             continue
 
-        _add_message(conn, "user", user_input)
-        history = _get_last_n(conn, max_history)
-        messages = [{"role": "system", "content": "You are a helpful assistant."}] + history
+        user_tokens = count_tokens(user_input)
+        evicted = window.append("user", user_input, user_tokens)
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + window.messages()
 
-        prompt_tokens = count_tokens(" ".join(m["content"] for m in messages))
+        prompt_tokens = system_tokens + window.tokens
         completion_text = ""
         print("Assistant: ", end="", flush=True)
 
-        with Timer() as t:
-            for chunk in client.chat.completions.create(model=MODEL_NAME, messages=messages, stream=True):
-                delta = chunk.choices[0].delta if chunk.choices else None
-                if delta and delta.content:
-                    print(delta.content, end="", flush=True)
-                    completion_text += delta.content
+        start = time.perf_counter()
+        try:
+            with timed(LLM_MS) as t:
+                for chunk in client.chat.completions.create(model=MODEL_NAME, messages=messages, stream=True):
+                    delta = chunk.choices[0].delta if chunk.choices else None
+                    if delta and delta.content:
+                        if not completion_text: TTFT_MS.observe((time.perf_counter() - start) * 1000)
+                        print(delta.content, end="", flush=True)
+                        completion_text += delta.content
+        except Exception as e:
+            # Nothing was stored for this turn: drop the question from the window too, so it can be asked again
+            window.undo(evicted)
+            print(f"\n[error] {type(e).__name__}: {e}\n")
+            continue
         print()
 
-        _add_message(conn, "assistant", completion_text)
         completion_tokens = count_tokens(completion_text)
+        window.append("assistant", completion_text, completion_tokens)
+        _add_messages(conn, [("user", user_input, user_tokens), ("assistant", completion_text, completion_tokens)])
         cost = compute_cost(prompt_tokens, completion_tokens)
+        record_usage("chat", prompt_tokens, completion_tokens)
         print(f"[stats] prompt={prompt_tokens} completion={completion_tokens} cost=${cost:.6f} latency={t.elapsed_ms:.0f} ms\n")
 
     conn.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Streaming chat with GPT-4o")
-    parser.add_argument("--history", type=int, default=MAX_HISTORY, help=f"Number of messages to persist (default: {MAX_HISTORY})")
+    parser.add_argument("--history", type=int, default=MAX_HISTORY, help=f"Most messages sent as history (default: {MAX_HISTORY})")
+    parser.add_argument("--history-tokens", type=int, default=MAX_HISTORY_TOKENS,
+                        help=f"Most history tokens sent with a turn (default: {MAX_HISTORY_TOKENS}, CHAT_HISTORY_TOKENS)")
     args = parser.parse_args()
-    chat_loop(max_history=args.history)
\ No newline at end of file
+    chat_loop(max_history=args.history, max_history_tokens=args.history_tokens)
\ No newline at end of file
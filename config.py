@@ -1,4 +1,5 @@
-import os, time, tiktoken
+import os, json, math, time, tiktoken
+from datetime import datetime
 from dotenv import load_dotenv
 from openai import OpenAI
 
@@ -9,6 +10,9 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME", "Gpt4o")
 CHROMA_HOST = os.getenv("CHROMA_HOST", "")  # empty = embedded, set to "chromadb" in Docker (For future)
 
+# Shared metrics store (JSONL) read by dashboard.py
+METRICS_FILE = os.path.join(os.path.dirname(__file__), "metrics", "metrics.jsonl")
+
 # GPT-4o pricing per 1K tokens (from $2.50/1M input, $10.00/1M output) from OpenAI website
 COST_PER_1K_PROMPT = 0.0025
 COST_PER_1K_COMPLETION = 0.01
@@ -24,6 +28,16 @@ def count_tokens(text: str) -> int:
 def compute_cost(prompt_tokens: int, completion_tokens: int) -> float:
     return (prompt_tokens / 1000) * COST_PER_1K_PROMPT + (completion_tokens / 1000) * COST_PER_1K_COMPLETION
 
+def percentile(values: list[float], pct: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]  # nearest-rank
+
+def log_metric(task, metric_type, value):
+    os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
+    with open(METRICS_FILE, "a") as f:
+        f.write(json.dumps({"ts": datetime.utcnow().isoformat(), "task": task, "type": metric_type, "value": value}) + "\n")
+
 class Timer:
     def __enter__(self):
         self._start = time.perf_counter()
@@ -1,32 +1,25 @@
 import streamlit as st, json, os, subprocess, sys
-from datetime import datetime
+from config import METRICS_FILE
+
+BENCH_FILE = os.path.join(os.path.dirname(METRICS_FILE), "rag_bench.json")
 
 st.set_page_config(page_title="AI Assessment Dashboard", layout="wide")
 st.title(" AI Assessment — Evaluation Dashboard")
 
-METRICS_FILE = os.path.join(os.path.dirname(__file__), "metrics", "metrics.jsonl")
-os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
-
-def log_metric(task, metric_type, value):
-    with open(METRICS_FILE, "a") as f:
-        f.write(json.dumps({"ts": datetime.utcnow().isoformat(), "task": task, "type": metric_type, "value": value}) + "\n")
-
 def load_metrics():
     if not os.path.exists(METRICS_FILE): return []
     return [json.loads(l) for l in open(METRICS_FILE) if l.strip()]
 
+def stats(metrics, task, metric):
+    """The periodic aggregate rows metrics.py writes for one series (headline rows are skipped)."""
+    return [m for m in metrics if m["type"] == "stats" and m["task"] == task and m["metric"] == metric]
+
 #  Sidebar actions 
-if st.sidebar.button("▶ Run RAG Evaluation"):
+if st.sidebar.button("▶ Run RAG Benchmark"):
     with st.spinner("Running..."):
-        r = subprocess.run([sys.executable, "rag.py", "evaluate"], capture_output=True, text=True, cwd=os.path.dirname(__file__))
+        # rag.py bench writes BENCH_FILE and logs headline accuracy/latency to the metrics store itself
+        r = subprocess.run([sys.executable, "rag.py", "bench", "vector,hybrid"], capture_output=True, text=True, cwd=os.path.dirname(__file__))
         st.sidebar.code(r.stdout + r.stderr)
-        for line in r.stdout.split("\n"):
-            if "Accuracy" in line:
-                try: log_metric("rag", "accuracy", float(line.split("(")[1].split("%")[0]))
-                except: pass
-            if "Median" in line:
-                try: log_metric("rag", "retrieval_ms", float(line.split(":")[1].strip().split(" ")[0]))
-                except: pass
 
 if st.sidebar.button("▶ Run Unit Tests"):
     with st.spinner("Running..."):
@@ -39,21 +32,50 @@ c1, c2, c3 = st.columns(3)
 
 with c1:
     st.subheader(" Latency")
-    lat = [m for m in metrics if m["type"] == "retrieval_ms"]
-    st.line_chart({m["ts"][-8:]: m["value"] for m in lat}) if lat else st.info("No data yet.")
+    lat = [m for m in metrics if m["type"] == "retrieval_ms"]  # benchmark p50s
+    st.line_chart({m["ts"]: m["value"] for m in lat}) if lat else st.info("No data yet.")
 
 with c2:
     st.subheader(" Retrieval Accuracy")
     acc = [m for m in metrics if m["type"] == "accuracy"]
     if acc:
         st.metric("Latest", f"{acc[-1]['value']:.1f}%")
-        st.line_chart({m["ts"][-8:]: m["value"] for m in acc})
+        st.line_chart({m["ts"]: m["value"] for m in acc})
     else: st.info("No data yet.")
 
 with c3:
     st.subheader(" Agent Runs")
-    agent = [m for m in metrics if m["task"] == "agent"]
-    st.metric("Total Runs", len(agent)) if agent else st.info("No data yet.")
+    runs = stats(metrics, "agent", "iterations")
+    if runs:
+        n = sum(m["count"] for m in runs)
+        st.metric("Total Runs", n, help=f"mean {sum(m['sum'] for m in runs) / n:.1f} LLM iterations per run")
+    else: st.info("No data yet.")
+
+    st.subheader(" LLM Cost")
+    cost = {}
+    for m in metrics:
+        if m["type"] == "stats" and m["metric"] == "cost_usd": cost[m["task"]] = cost.get(m["task"], 0) + m["sum"]
+    if cost:
+        st.metric("Total", f"${sum(cost.values()):.4f}", help=", ".join(f"{t}: ${c:.4f}" for t, c in cost.items()))
+    else: st.info("No data yet.")
+
+    st.subheader(" Answer Cache")
+    hits = stats(metrics, "rag", "cache_hits")  # one sample per /rag/query call: 1 hit, 0 miss
+    if hits:
+        n = sum(m["count"] for m in hits)
+        st.metric("Hit Rate", f"{sum(m['sum'] for m in hits) / n * 100:.1f}%", help=f"{n} /rag/query calls")
+        q_ms = stats(metrics, "rag", "query_ms")
+        if q_ms: st.metric("/rag/query latency, last window", f"p50 {q_ms[-1]['p50']:.0f} ms",
+                           help=f"p95 {q_ms[-1]['p95']:.0f} ms over {q_ms[-1]['count']} queries")
+    else: st.info("No data yet.")
+
+st.subheader(" Retrieval Benchmark")
+if os.path.exists(BENCH_FILE):
+    bench = json.load(open(BENCH_FILE))
+    st.caption(f"{bench['ts']} — {bench['n_questions']} questions, collection v{bench['collection_version']}, "
+               f"batch embed {bench['embed_batch_ms']:.0f} ms")
+    st.dataframe(bench["results"])
+else: st.info("Run the RAG benchmark to see recall@k, MRR and latency percentiles.")
 
 st.subheader(" Raw Log")
 st.dataframe(metrics) if metrics else st.info("Run tasks to see metrics.")
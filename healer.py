@@ -1,8 +1,23 @@
 #!/usr/bin/env python3
-import sys, os, re, subprocess, tempfile, shutil
-from config import get_openai_client, MODEL_NAME, Timer
+import sys, os, re, glob, json, time, atexit, queue, signal, argparse, functools, itertools, threading, subprocess, tempfile, shutil
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from openai import BadRequestError
+from config import get_openai_client, MODEL_NAME, Timer, compute_cost, percentile
+from cache import SolutionCache
+from metrics import histogram, counter, timed, record_usage, MS_BUCKETS
 
 MAX_RETRIES = 3
+# Parallel candidates: each attempt asks for HEALER_CANDIDATES completions at once and tests them side by side in
+# their own workdirs; the first to pass wins and the others are killed, otherwise the next attempt repairs the
+# candidate that passed the most tests. 1 = the plain generate -> test -> fix loop.
+HEALER_CANDIDATES = int(os.getenv("HEALER_CANDIDATES", "1"))
+CANDIDATE_TEMPERATURE = float(os.getenv("HEALER_CANDIDATE_TEMPERATURE", "0.8"))  # n > 1 wants varied candidates
+HEALER_TEST_WORKERS = int(os.getenv("HEALER_TEST_WORKERS", "0")) or os.cpu_count() or 1
+# Caps shared by every task and candidate under one _Scheduler (see batch()): LLM calls are network-bound and can
+# overlap freely, test runs are CPU-bound and beyond the core count only queue up inside the OS scheduler.
+HEALER_LLM_CONCURRENCY = int(os.getenv("HEALER_LLM_CONCURRENCY", "8"))
+HEALER_TEST_CONCURRENCY = int(os.getenv("HEALER_TEST_CONCURRENCY", "0")) or os.cpu_count() or 1
 
 # AI Assisted config
 LANG_CONFIG = {
@@ -18,6 +33,55 @@ LANG_CONFIG = {
     },
 }
 
+LLM_MS = histogram("healer_llm_ms", MS_BUCKETS, "Code generation call time", task="healer")
+TIME_TO_GREEN = histogram("healer_time_to_green_ms", MS_BUCKETS, "Task start to first passing candidate", task="healer")
+
+def _test_ms(lang: str):
+    return histogram("healer_test_ms", MS_BUCKETS, "Write + build + test time per attempt", task="healer", lang=lang)
+
+def _phase_ms(lang: str, phase: str):
+    return histogram("healer_phase_ms", MS_BUCKETS, "Per-attempt write / build / test time", task="healer", lang=lang, phase=phase)
+
+def _attempts(lang: str, result: str):
+    return counter("healer_attempts_total", "Healing attempts by outcome", task="healer", lang=lang, result=result)
+
+_report_lock = threading.Lock()
+
+class _Scheduler:
+    """The LLM and test slots shared by everything healed under it, whether progress is printed, and the cargo
+    build jobs per test slot (None: cargo's default, every core)."""
+
+    def __init__(self, llm_concurrency: int = HEALER_LLM_CONCURRENCY, test_concurrency: int = HEALER_TEST_CONCURRENCY,
+                 verbose: bool = True, cargo_jobs: int = None):
+        self.llm_concurrency, self.test_concurrency = llm_concurrency, test_concurrency
+        self.llm_slots = threading.BoundedSemaphore(llm_concurrency)
+        self.test_slots = threading.BoundedSemaphore(test_concurrency)
+        self.verbose, self.cargo_jobs = verbose, cargo_jobs
+
+    def say(self, *args, **kwargs):
+        if self.verbose: print(*args, **kwargs)
+
+_scheduler = _Scheduler()  # single heal() runs from the CLI
+
+def _tally(report: dict, phases: dict = None, **counts):
+    """Adds counts and phase timings (ms) into a per-task report; report None means nobody is collecting."""
+    if report is None: return
+    with _report_lock:
+        for k, v in counts.items(): report[k] = report.get(k, 0) + v
+        totals = report.setdefault("phases_ms", {})
+        for k, v in (phases or {}).items(): totals[k] = totals.get(k, 0) + v
+
+@contextmanager
+def _slot(slots: threading.BoundedSemaphore, report: dict, name: str):
+    """Holds one of the shared LLM / test slots, reporting the wait as the <name>_wait phase."""
+    with Timer() as wait:
+        slots.acquire()
+    _tally(report, {f"{name}_wait": wait.elapsed_ms})
+    try:
+        yield
+    finally:
+        slots.release()
+
 def _detect_lang(task: str) -> str:
     return "rust" if any(w in task.lower() for w in ("rust", "cargo")) else "python"
 
@@ -27,78 +91,586 @@ def _extract_blocks(text: str, lang: str) -> list[str]:
         if blocks: return [b.strip() for b in blocks]
     return []
 
-def _generate(client, lang: str, task: str, error_ctx: str = None) -> list[str]:
+def _prompt(lang: str, task: str, error_ctx: str = None, code: list[str] = None) -> str:
     cfg = LANG_CONFIG[lang]
-    if error_ctx:
-        prompt = f"{cfg['fix_prompt']}\n\nTask: {task}\n\nErrors:\n```\n{error_ctx[-3000:]}\n```"
-    else:
-        prompt = f"Task: {task}\n\n{cfg['gen_prompt']}"
+    if not error_ctx:
+        return f"Task: {task}\n\n{cfg['gen_prompt']}"
+    prompt = f"{cfg['fix_prompt']}\n\nTask: {task}"
+    if code: prompt += "\n\nCode:\n" + "\n\n".join(f"```{lang}\n{b}\n```" for b in code)
+    return prompt + f"\n\nErrors:\n```\n{error_ctx[-3000:]}\n```"
 
-    print(f"  Generating {lang.title()}...", end=" ", flush=True)
-    with Timer() as t:
-        resp = client.chat.completions.create(model=MODEL_NAME, temperature=0.3,
-            messages=[{"role": "system", "content": cfg["system"]},
-                      {"role": "user", "content": prompt}])
-    print(f"({t.elapsed_ms:.0f} ms)")
-    return _extract_blocks(resp.choices[0].message.content, lang)
-
-def _write_and_test_python(workdir: str, blocks: list[str]) -> tuple[bool, str]:
-    if len(blocks) < 2: return False, "Expected 2 code blocks (solution + tests), got fewer."
-    for name, content in [("solution.py", blocks[0]), ("test_solution.py", blocks[1])]:
-        open(os.path.join(workdir, name), "w").write(content)
-        print(f"  {name} ({len(content)} chars)")
-    print("   Running pytest...")
+def _generate(client, lang: str, task: str, error_ctx: str = None, code: list[str] = None, n: int = 1,
+              report: dict = None, sched: _Scheduler = None) -> list[list[str]]:
+    """n candidates (code blocks each) from one request using the `n` parameter; a provider that returns fewer
+    choices, or rejects `n`, is topped up with concurrent single calls."""
+    messages = [{"role": "system", "content": LANG_CONFIG[lang]["system"]},
+                {"role": "user", "content": _prompt(lang, task, error_ctx, code)}]
+    temperature = 0.3 if n == 1 else CANDIDATE_TEMPERATURE
+    sched = sched or _scheduler
+
+    def call(k: int) -> list[str]:
+        with _slot(sched.llm_slots, report, "llm"), timed(LLM_MS) as t:
+            resp = client.chat.completions.create(model=MODEL_NAME, temperature=temperature, messages=messages,
+                                                  **({"n": k} if k > 1 else {}))
+        _tally(report, {"llm": t.elapsed_ms}, llm_calls=1)
+        if resp.usage:
+            record_usage("healer", resp.usage.prompt_tokens, resp.usage.completion_tokens)
+            _tally(report, prompt_tokens=resp.usage.prompt_tokens, completion_tokens=resp.usage.completion_tokens,
+                   cost_usd=compute_cost(resp.usage.prompt_tokens, resp.usage.completion_tokens))
+        return [c.message.content or "" for c in resp.choices]
+
+    sched.say(f"  Generating {lang.title()}{f' x{n}' if n > 1 else ''}...", end=" ", flush=True)
+    start = time.perf_counter()
     try:
-        r = subprocess.run([sys.executable, "-m", "pytest", "test_solution.py", "-v", "--tb=short"],
-                           capture_output=True, text=True, cwd=workdir, timeout=30)
-        return r.returncode == 0, r.stdout + r.stderr
-    except subprocess.TimeoutExpired:
-        return False, "ERROR: pytest timed out (30s)"
+        texts = call(n)
+    except BadRequestError:
+        if n == 1: raise
+        texts = []
+    if len(texts) < n:
+        with ThreadPoolExecutor(max_workers=n - len(texts)) as pool:
+            for more in pool.map(call, [1] * (n - len(texts))): texts += more
+    sched.say(f"({(time.perf_counter() - start) * 1000:.0f} ms)")
+    return [_extract_blocks(t, lang) for t in texts[:n]]
 
-# AI assissted because I'm not too knowledgeable with rust
-def _write_and_test_rust(workdir: str, blocks: list[str]) -> tuple[bool, str]:
-    if not blocks: return False, "No code block generated."
-    proj = os.path.join(workdir, "proj")
-    os.makedirs(os.path.join(proj, "src"), exist_ok=True)
-    open(os.path.join(proj, "Cargo.toml"), "w").write(
-        '[package]\nname = "healer"\nversion = "0.1.0"\nedition = "2021"\n')
-    open(os.path.join(proj, "src", "main.rs"), "w").write(blocks[0])
-    print(f"  src/main.rs ({len(blocks[0])} chars)")
-    for step, cmd in [(" Compiling...", ["cargo", "build"]), (" Running cargo test...", ["cargo", "test"])]:
-        print(f"  {step}")
+# ── Test runners ────────────────────────────────────────────────────────────
+# Python: a warm "zygote" process imports pytest once and forks a fresh child per run (own workdir, rlimits, output
+# to a file), so a run costs a fork rather than interpreter + pytest start-up and nothing leaks between runs.
+# HEALER_WARM_PYTEST=0, or no fork(), falls back to a `python -m pytest` subprocess per run.
+# Rust: template crates under HEALER_CARGO_DIR, one per concurrent run, are reused so their target dirs and
+# incremental caches stay warm across attempts and tasks; one `cargo test --no-run` build, then the test binary.
+# Runners return (passed, output, phase timings in ms).
+
+HEALER_WARM_PYTEST = os.getenv("HEALER_WARM_PYTEST", "1") != "0" and hasattr(os, "fork")
+TEST_TIMEOUT_S, BUILD_TIMEOUT_S = 30, 60
+TEST_LIMITS = {"mem_mb": int(os.getenv("HEALER_TEST_MEM_MB", "1024")), "cpu_s": int(os.getenv("HEALER_TEST_CPU_S", "30")),
+               "fsize_mb": 64}
+HEALER_CARGO_DIR = os.getenv("HEALER_CARGO_DIR", os.path.join(os.path.expanduser("~"), ".cache", "healer", "cargo"))
+HEALER_KEEP_WORKDIR = os.getenv("HEALER_KEEP_WORKDIR", "0") == "1"
+TMP_MAX_AGE_S = float(os.getenv("HEALER_TMP_MAX_AGE_S", "3600"))  # older healer_* temp dirs are swept at start
+PYTEST_ARGS = ["test_solution.py", "-v", "--tb=short"]
+PYTEST_OUTPUT = ".pytest_output"
+CARGO_TOML = '[package]\nname = "healer"\nversion = "0.1.0"\nedition = "2021"\n'
+CANCELLED = "CANCELLED: another candidate passed first"
+
+def _kill_group(pid: int):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:  # not yet its own group leader
+        try: os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError: pass
+
+def _set_limits(limits: dict):
+    import resource
+    mb = 1 << 20
+    resource.setrlimit(resource.RLIMIT_AS, (limits["mem_mb"] * mb,) * 2)
+    resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu_s"], limits["cpu_s"] + 1))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (limits["fsize_mb"] * mb,) * 2)
+
+def _run(cmd: list[str], cwd: str, timeout: float, cancel: threading.Event = None, env: dict = None) -> tuple[int, str]:
+    """subprocess.run in its own process group that a cancel event can kill; returncode None on timeout/cancel.
+    env entries are added to this process's environment."""
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, start_new_session=True,
+                            env={**os.environ, **env} if env else None)
+    deadline = time.monotonic() + timeout
+    while True:
         try:
-            r = subprocess.run(cmd, capture_output=True, text=True, cwd=proj, timeout=60)
-            if r.returncode != 0: return False, r.stdout + r.stderr
+            out, err = proc.communicate(timeout=0.1)
+            return proc.returncode, out + err
         except subprocess.TimeoutExpired:
-            return False, f"ERROR: {cmd[1]} timed out"
-    return True, r.stdout + r.stderr
+            if time.monotonic() > deadline or (cancel is not None and cancel.is_set()):
+                _kill_group(proc.pid)
+                out, err = proc.communicate()
+                return None, out + err
+
+def _pytest_child(workdir: str, args: list[str], limits: dict):
+    """Runs in a fresh fork of the zygote and never returns."""
+    code = 3  # pytest's "internal error"
+    try:
+        os.setsid()
+        os.chdir(workdir)
+        out = os.open(PYTEST_OUTPUT, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(out, 1); os.dup2(out, 2)
+        _set_limits(limits)
+        import pytest
+        code = int(pytest.main(args))
+    except BaseException:
+        import traceback; traceback.print_exc()
+    finally:
+        sys.stdout.flush(); sys.stderr.flush()
+        os._exit(code)
+
+def _zygote(limits: dict):
+    """Entry point of the zygote process. Single-threaded, so fork is safe: reads {"id", "workdir", "args"} JSON
+    lines on stdin, forks a child per request and writes {"kind": "started"|"done", "id", "value"} lines (pid, then
+    exit code) to stdout. Exits when stdin closes."""
+    import select
+    import pytest
+    # Importing pytest is cheap; finding and importing the installed plugins is what takes seconds. One throwaway
+    # in-process session (output to /dev/null, stdout is the reply channel) loads them, and every fork inherits them.
+    with tempfile.TemporaryDirectory(prefix="pytest_prime_") as d:
+        open(os.path.join(d, "test_prime.py"), "w").write("def test_prime():\n    pass\n")
+        saved, devnull = (os.dup(1), os.dup(2)), os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1); os.dup2(devnull, 2)
+        try:
+            pytest.main(["-q", "-p", "no:cacheprovider", d])
+        finally:
+            sys.stdout.flush(); sys.stderr.flush()
+            os.dup2(saved[0], 1); os.dup2(saved[1], 2)
+    stdin, running, buf = sys.stdin.fileno(), {}, b""
+    def reply(kind, run_id, value):
+        os.write(1, (json.dumps({"kind": kind, "id": run_id, "value": value}) + "\n").encode())
+    while True:
+        if select.select([stdin], [], [], 0.02)[0]:
+            data = os.read(stdin, 65536)
+            if not data: break
+            buf += data
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                req = json.loads(line)
+                pid = os.fork()
+                if pid == 0: _pytest_child(req["workdir"], req["args"], limits)
+                running[pid] = req["id"]
+                reply("started", req["id"], pid)
+        while running:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid: break
+            reply("done", running.pop(pid), os.waitstatus_to_exitcode(status))
+
+class _WarmPytest:
+    """Client side of the zygote; candidate threads share it."""
+
+    def __init__(self, limits: dict = TEST_LIMITS):
+        boot = f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); import healer; healer._zygote({limits!r})"
+        self._proc = subprocess.Popen([sys.executable, "-c", boot], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._send_lock, self._waiters, self._ids, self._abandoned = threading.Lock(), {}, itertools.count(), set()
+        threading.Thread(target=self._read, daemon=True, name="pytest-zygote-reader").start()
+
+    def _read(self):
+        for line in self._proc.stdout:
+            msg = json.loads(line)
+            if msg["id"] in self._waiters: self._waiters[msg["id"]].put((msg["kind"], msg["value"]))
+            elif msg["kind"] == "started" and msg["id"] in self._abandoned:  # started after run() gave up on it
+                self._abandoned.discard(msg["id"]); _kill_group(msg["value"])
+
+    def alive(self) -> bool:
+        return self._proc.poll() is None
+
+    def run(self, workdir: str, args: list[str], timeout: float, cancel: threading.Event = None) -> tuple[int, str]:
+        """Same contract as _run; raises RuntimeError if the zygote has died."""
+        run_id, replies = next(self._ids), queue.Queue()
+        self._waiters[run_id] = replies
+        pid, killed, deadline = None, False, time.monotonic() + timeout
+        try:
+            with self._send_lock:
+                self._proc.stdin.write((json.dumps({"id": run_id, "workdir": workdir, "args": args}) + "\n").encode())
+                self._proc.stdin.flush()
+            while True:
+                try:
+                    kind, value = replies.get(timeout=0.05)
+                except queue.Empty:
+                    if not self.alive(): raise RuntimeError("pytest zygote exited")
+                    if not killed and (time.monotonic() > deadline or (cancel is not None and cancel.is_set())):
+                        if pid is None:  # never started: the zygote is wedged, let the caller run pytest cold
+                            self._abandoned.add(run_id)
+                            raise RuntimeError("pytest zygote did not start the run")
+                        _kill_group(pid); killed = True
+                    continue
+                if kind == "started": pid = value
+                else: code = value; break
+        except OSError as e:
+            raise RuntimeError(f"pytest zygote unreachable: {e}")
+        finally:
+            self._waiters.pop(run_id, None)
+        try:
+            output = open(os.path.join(workdir, PYTEST_OUTPUT)).read()
+        except OSError:
+            output = ""
+        if code < 0: output += f"\nERROR: test process killed by signal {-code} (limits: {TEST_LIMITS})"
+        return (None if killed else code), output
+
+    def close(self):
+        self._proc.stdin.close()
+
+_warm_pytest, _warm_lock = None, threading.Lock()
+
+def _get_warm_pytest():
+    global _warm_pytest
+    if not HEALER_WARM_PYTEST: return None
+    with _warm_lock:
+        if _warm_pytest is None or not _warm_pytest.alive():
+            _warm_pytest = _WarmPytest()
+            atexit.register(_warm_pytest.close)
+        return _warm_pytest
+
+def _pytest(workdir: str, cancel: threading.Event = None, sched: _Scheduler = None) -> tuple[int, str]:
+    warm = _get_warm_pytest()
+    if warm is not None:
+        try:
+            return warm.run(workdir, PYTEST_ARGS, TEST_TIMEOUT_S, cancel)
+        except RuntimeError as e:
+            (sched or _scheduler).say(f"  ⚠ {e}, running pytest cold")
+    return _run([sys.executable, "-m", "pytest", *PYTEST_ARGS], workdir, TEST_TIMEOUT_S, cancel)
+
+def _write_and_test_python(workdir: str, blocks: list[str], cancel: threading.Event = None,
+                           sched: _Scheduler = None) -> tuple[bool, str, dict]:
+    if len(blocks) < 2: return False, "Expected 2 code blocks (solution + tests), got fewer.", {}
+    sched = sched or _scheduler
+    with Timer() as w:
+        for name, content in [("solution.py", blocks[0]), ("test_solution.py", blocks[1])]:
+            open(os.path.join(workdir, name), "w").write(content)
+            sched.say(f"  {name} ({len(content)} chars)")
+    sched.say("   Running pytest...")
+    with Timer() as t:
+        code, output = _pytest(workdir, cancel, sched)
+    phases = {"write": w.elapsed_ms, "test": t.elapsed_ms}
+    if code is None:
+        return False, CANCELLED if cancel is not None and cancel.is_set() else f"ERROR: pytest timed out ({TEST_TIMEOUT_S}s)", phases
+    return code == 0, output, phases
+
+@contextmanager
+def _cargo_slot():
+    """A template crate under HEALER_CARGO_DIR that no other run, in this or another process, is using."""
+    import fcntl
+    os.makedirs(HEALER_CARGO_DIR, exist_ok=True)
+    for i in itertools.count():
+        proj = os.path.join(HEALER_CARGO_DIR, f"slot{i}")
+        lock = open(proj + ".lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close(); continue
+        try:
+            os.makedirs(os.path.join(proj, "src"), exist_ok=True)
+            if not os.path.exists(os.path.join(proj, "Cargo.toml")):
+                open(os.path.join(proj, "Cargo.toml"), "w").write(CARGO_TOML)
+            yield proj
+        finally:
+            lock.close()
+        return
+
+# AI assissted because I'm not too knowledgeable with rust
+def _write_and_test_rust(workdir: str, blocks: list[str], cancel: threading.Event = None,
+                         sched: _Scheduler = None) -> tuple[bool, str, dict]:
+    if not blocks: return False, "No code block generated.", {}
+    sched = sched or _scheduler
+    # an explicit CARGO_BUILD_JOBS in the environment wins over the scheduler's share
+    env = {"CARGO_BUILD_JOBS": str(sched.cargo_jobs)} if sched.cargo_jobs and "CARGO_BUILD_JOBS" not in os.environ else None
+    phases = {}
+    with _cargo_slot() as proj:
+        with Timer() as w:
+            for path in (os.path.join(workdir, "main.rs"), os.path.join(proj, "src", "main.rs")):
+                open(path, "w").write(blocks[0])
+        phases["write"] = w.elapsed_ms
+        sched.say(f"  src/main.rs ({len(blocks[0])} chars)")
+        sched.say("   Building tests...")
+        with Timer() as b:
+            code, output = _run(["cargo", "test", "--no-run"], proj, BUILD_TIMEOUT_S, cancel, env)
+        phases["build"] = b.elapsed_ms
+        if code is None:
+            return False, CANCELLED if cancel is not None and cancel.is_set() else "ERROR: cargo build timed out", phases
+        if code != 0: return False, output, phases
+        exe = re.findall(r"Executable .*?\((.+?)\)", output)
+        sched.say("   Running tests...")
+        with Timer() as t:
+            code, output = _run([os.path.join(proj, exe[-1])] if exe else ["cargo", "test"], proj, TEST_TIMEOUT_S, cancel)
+        phases["test"] = t.elapsed_ms
+    if code is None:
+        return False, CANCELLED if cancel is not None and cancel.is_set() else "ERROR: cargo test timed out", phases
+    return code == 0, output, phases
+
+WORKDIR_LOCK = ".healer.lock"
+
+@contextmanager
+def _workdir():
+    """A new healer_* temp dir, flocked for as long as a run uses it so that no sweep, in this or another process,
+    removes it (the lock goes with the process if it dies)."""
+    import fcntl
+    workdir = tempfile.mkdtemp(prefix="healer_")
+    lock = open(os.path.join(workdir, WORKDIR_LOCK), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        yield workdir
+    finally:
+        lock.close()
+
+def _newest_mtime(path: str) -> float:
+    """Latest mtime of the dir or anything in it: rewriting a file doesn't touch its directory's mtime."""
+    return max([os.path.getmtime(path)] + [os.path.getmtime(os.path.join(root, name))
+                                           for root, dirs, files in os.walk(path) for name in dirs + files])
+
+def _sweep_workdirs(max_age_s: float = TMP_MAX_AGE_S) -> int:
+    """Removes healer_* temp dirs left behind by earlier runs: nothing in them changed for max_age_s and no run
+    holds their lock."""
+    import fcntl
+    cutoff, removed = time.time() - max_age_s, 0
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), "healer_*")):
+        try:
+            if not os.path.isdir(path) or _newest_mtime(path) >= cutoff: continue
+            with open(os.path.join(path, WORKDIR_LOCK), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(path); removed += 1
+        except OSError:  # BlockingIOError: a live run holds it
+            pass
+    return removed
+
+# ── Solution cache ──────────────────────────────────────────────────────────
+# The same tasks come back (regression runs, retries). A verified solution is stored per normalized task + language +
+# model, and a hit is re-verified by running its cached tests with no LLM call. A fix that turned failing code green
+# is stored per failing code + error signature and tried before asking the LLM to repair that failure again.
+HEALER_CACHE_PATH = os.getenv("HEALER_CACHE_PATH", os.path.join(os.path.dirname(__file__), "healer_cache.db"))  # "" disables
+
+# Parts of a failure that differ between otherwise identical runs: workdir paths, line numbers, timings, addresses
+_VOLATILE = [(re.compile(r"(/[\w.-]+)+/"), ""), (re.compile(r":\d+(:\d+)?"), ":N"),
+             (re.compile(r"\b\d+(\.\d+)?m?s\b"), "Ns"), (re.compile(r"0x[0-9a-f]+"), "0x?")]
+_FAILURE_LINES = {"python": re.compile(r"^(E .*|FAILED .*|ERROR .*|\w+(Error|Exception): .*)$", re.M),
+                  "rust": re.compile(r"^(error(\[E\d+\])?: .*|test \S+ \.\.\. FAILED|.*panicked at.*|\s*(left|right): .*)$", re.M)}
+
+def _cache_lookups(kind: str, result: str):
+    return counter("healer_cache_total", "Solution cache lookups by outcome", task="healer", kind=kind, result=result)
+
+_solution_cache, _solution_cache_lock = None, threading.Lock()
+
+def _get_solution_cache():
+    global _solution_cache
+    if not HEALER_CACHE_PATH: return None
+    with _solution_cache_lock:
+        if _solution_cache is None: _solution_cache = SolutionCache(HEALER_CACHE_PATH)
+        return _solution_cache
+
+def _normalize_task(task: str) -> str:
+    return " ".join(re.sub(r"[^\w]+", " ", task.lower()).split())
+
+def _error_signature(lang: str, output: str) -> str:
+    """The failure lines of a run with the volatile parts stripped, so the same failure in another workdir or run
+    gives the same signature; output without recognisable failure lines falls back to its last lines."""
+    lines = [m.group(0).strip() for m in _FAILURE_LINES[lang].finditer(output)] or output.strip().split("\n")[-5:]
+    for pat, repl in _VOLATILE:
+        lines = [pat.sub(repl, line) for line in lines]
+    return "\n".join(sorted(set(lines)))
+
+# ── Parallel candidates ─────────────────────────────────────────────────────
+
+def _score(lang: str, output: str) -> float:
+    """Fraction of tests that passed in a failed run; build, collection and format errors score 0."""
+    if lang == "rust":
+        counts = re.findall(r"test result: \w+\. (\d+) passed; (\d+) failed", output)
+        passed, failed = (sum(int(c[i]) for c in counts) for i in (0, 1))
+    else:
+        tally = {k: int(v) for v, k in re.findall(r"(\d+) (passed|failed|errors?)\b", output)}
+        passed, failed = tally.get("passed", 0), tally.get("failed", 0) + tally.get("error", 0) + tally.get("errors", 0)
+    return passed / (passed + failed) if passed + failed else 0.0
 
-def heal(task: str) -> bool:
+def _test_candidates(runner, lang: str, workdirs: list[str], candidates: list[list[str]],
+                     report: dict = None, sched: _Scheduler = None) -> list[tuple[bool, str, float, dict]]:
+    """Tests each candidate in its own workdir, up to HEALER_TEST_WORKERS at once (and within the scheduler's test
+    slots); the first to pass kills the rest. Returns (passed, output, ms, phase timings) in candidate order."""
+    cancel = threading.Event()
+    sched = sched or _scheduler
+
+    def test(workdir: str, blocks: list[str]) -> tuple[bool, str, float, dict]:
+        os.makedirs(workdir, exist_ok=True)
+        with _slot(sched.test_slots, report, "test"):
+            if cancel.is_set(): return False, CANCELLED, 0.0, {}  # still queued when another candidate passed
+            with timed(_test_ms(lang)) as t:
+                passed, output, phases = runner(workdir, blocks, cancel)
+        if passed: cancel.set()
+        _attempts(lang, "pass" if passed else "cancelled" if output == CANCELLED else "fail").inc()
+        for phase, ms in phases.items(): _phase_ms(lang, phase).observe(ms)
+        _tally(report, phases)
+        return passed, output, t.elapsed_ms, phases
+
+    if len(candidates) == 1: return [test(workdirs[0], candidates[0])]
+    with ThreadPoolExecutor(max_workers=min(len(candidates), HEALER_TEST_WORKERS), thread_name_prefix="heal-test") as pool:
+        return list(pool.map(test, workdirs, candidates))
+
+def _timings(phases: dict) -> str:
+    return " | ".join(f"{phase} {ms:.0f} ms" for phase, ms in phases.items())
+
+def heal(task: str, candidates: int = None, use_cache: bool = True, report: dict = None,
+         sched: _Scheduler = None) -> bool:
+    """Generates, tests and repairs code for one task. A report dict, if given, collects lang, attempts, cached,
+    LLM calls, tokens, cost, per-phase ms and, on failure, the last error."""
+    if not HEALER_KEEP_WORKDIR: _sweep_workdirs()
+    with _workdir() as workdir:
+        return _heal(task, workdir, candidates, use_cache, report, sched or _scheduler)
+
+def _heal(task: str, workdir: str, candidates: int, use_cache: bool, report: dict, sched: _Scheduler) -> bool:
     client = get_openai_client()
     lang = _detect_lang(task)
     if lang == "rust" and not shutil.which("cargo"):
-        print("⚠ cargo not found, falling back to Python"); lang = "python"
-    workdir = tempfile.mkdtemp(prefix="healer_")
-    runner = _write_and_test_rust if lang == "rust" else _write_and_test_python
+        sched.say("⚠ cargo not found, falling back to Python"); lang = "python"
+    if report is not None: report.update(lang=lang, attempts=0, cached=None)
+    if lang == "python": _get_warm_pytest()  # the zygote primes pytest while the first candidate is generated
+    runner = functools.partial(_write_and_test_rust if lang == "rust" else _write_and_test_python, sched=sched)
+    n = max(1, candidates or HEALER_CANDIDATES)
+    cache, task_key = _get_solution_cache() if use_cache else None, _normalize_task(task)
 
-    print(f"\n{'═'*60}\nSelf-Healing Code Assistant\nTask: {task}\nLang: {lang.upper()}  Dir: {workdir}\n{'═'*60}")
+    sched.say(f"\n{'═'*60}\nSelf-Healing Code Assistant\nTask: {task}\nLang: {lang.upper()}  Dir: {workdir}"
+          f"{f'  Candidates: {n}' if n > 1 else ''}\n{'═'*60}")
 
-    error_ctx = None
-    for attempt in range(1, MAX_RETRIES + 1):
-        print(f"\n── Attempt {attempt}/{MAX_RETRIES} {'─'*40}")
-        blocks = _generate(client, lang, task, error_ctx)
-        passed, output = runner(workdir, blocks)
-        for line in output.strip().split("\n"): print(f"     {line}")
+    start = time.perf_counter()
+
+    def green(blocks: list[str], how: str) -> bool:
+        TIME_TO_GREEN.observe((time.perf_counter() - start) * 1000)
+        sched.say(f"\n{'═'*60}\n  ALL TESTS PASSED ({how}) in {time.perf_counter() - start:.1f} s!\n{'═'*60}")
+        sched.say(f"\n── Code {'─'*51}\n{blocks[0]}")
+        if not HEALER_KEEP_WORKDIR: shutil.rmtree(workdir, ignore_errors=True)
+        return True
 
+    error_ctx, code = None, None
+    hit = cache.get(task_key, lang, MODEL_NAME) if cache else None
+    if hit:
+        sched.say(f"\n── Cached solution (tests passed {hit['passes']}x, failed {hit['fails']}x) {'─'*14}")
+        passed, output, ms, phases = _test_candidates(runner, lang, [workdir], [hit["blocks"]], report, sched)[0]
+        for line in output.strip().split("\n"): sched.say(f"     {line}")
+        sched.say(f"     [{_timings(phases)}]")
+        cache.record(task_key, lang, MODEL_NAME, passed)
+        _cache_lookups("solution", "hit" if passed else "stale").inc()
         if passed:
-            print(f"\n{'═'*60}\n  ALL TESTS PASSED (attempt {attempt})!\n{'═'*60}")
-            print(f"\n── Code {'─'*51}\n{blocks[0]}")
-            return True
-        print(f"\n  Failed attempt {attempt}")
-        error_ctx = output
+            if report is not None: report["cached"] = "solution"
+            return green(hit["blocks"], "cached solution, no LLM call")
+        sched.say("\n  Cached solution no longer passes — repairing it")
+        error_ctx, code = output, hit["blocks"]
+    elif cache:
+        _cache_lookups("solution", "miss").inc()
+
+    for attempt in range(1, MAX_RETRIES + 1):
+        sched.say(f"\n── Attempt {attempt}/{MAX_RETRIES} {'─'*40}")
+        if report is not None: report["attempts"] = attempt
+        signature, fix = (_error_signature(lang, error_ctx), None) if error_ctx else (None, None)
+        if cache and error_ctx:
+            fix = cache.get_fix(lang, MODEL_NAME, code, signature)
+            _cache_lookups("fix", "hit" if fix else "miss").inc()
+        if fix: sched.say("  Cached fix for this failure, no LLM call")
+        batch = [fix] if fix else _generate(client, lang, task, error_ctx, code, n, report, sched)
+        workdirs = [workdir] if len(batch) == 1 else [os.path.join(workdir, f"attempt{attempt}_c{i + 1}") for i in range(len(batch))]
+        results = _test_candidates(runner, lang, workdirs, batch, report, sched)
+        if len(batch) == 1:
+            for line in results[0][1].strip().split("\n"): sched.say(f"     {line}")
+            sched.say(f"     [{_timings(results[0][3])}]")
+        else:
+            for i, (passed, output, ms, phases) in enumerate(results, 1):
+                state = "PASS" if passed else "cancelled" if output == CANCELLED else f"FAIL ({_score(lang, output):.0%} of tests)"
+                sched.say(f"     candidate {i}: {state}  [{_timings(phases) or f'{ms:.0f} ms'}]")
 
-    print(f"\n{'═'*60}\n  FAILED after {MAX_RETRIES} attempts\n{'═'*60}")
+        winner = next((i for i, r in enumerate(results) if r[0]), None)
+        if cache and error_ctx and (fix or winner is not None):
+            cache.put_fix(lang, MODEL_NAME, code, signature, fix or batch[winner], passed=winner is not None)
+        if winner is not None:
+            if cache: cache.put(task_key, lang, MODEL_NAME, batch[winner])
+            if report is not None and fix: report["cached"] = "fix"
+            which = f", candidate {winner + 1}/{len(batch)}" if len(batch) > 1 else ", cached fix" if fix else ""
+            return green(batch[winner], f"attempt {attempt}{which}")
+        # Repair from the candidate that got furthest (earliest on ties), with its code and errors
+        best = max(range(len(batch)), key=lambda i: _score(lang, results[i][1]))
+        sched.say(f"\n  Failed attempt {attempt}" + (f" — repairing candidate {best + 1}" if len(batch) > 1 else ""))
+        error_ctx, code = results[best][1], batch[best]
+
+    sched.say(f"\n{'═'*60}\n  FAILED after {MAX_RETRIES} attempts (attempts kept in {workdir})\n{'═'*60}")
+    if report is not None: report.update(workdir=workdir, error=error_ctx[-500:])
     return False
 
+# ── Batch mode ──────────────────────────────────────────────────────────────
+# `healer.py batch tasks.jsonl` for regression runs. Tasks overlap freely; their LLM calls queue for the
+# HEALER_LLM_CONCURRENCY slots and their test runs for the HEALER_TEST_CONCURRENCY slots, so the CPU-bound pytest and
+# cargo work stays at the core count however many tasks are in flight.
+
+def _heal_one(index: int, item: dict, candidates: int, use_cache: bool, sched: _Scheduler) -> dict:
+    report = {"id": item.get("id", index), "task": item["task"]}
+    with Timer() as t:
+        try:
+            report["passed"] = heal(item["task"], item.get("candidates", candidates), use_cache, report, sched)
+        except Exception as e:
+            report.update(passed=False, error=f"{type(e).__name__}: {e}"[:500])
+    report["wall_ms"] = round(t.elapsed_ms, 1)
+    report["phases_ms"] = {k: round(v, 1) for k, v in report.get("phases_ms", {}).items()}
+    if "cost_usd" in report: report["cost_usd"] = round(report["cost_usd"], 6)
+    return report
+
+def _summarize(reports: list[dict], wall_s: float, llm_concurrency: int, test_concurrency: int) -> dict:
+    """Pass rates (overall, by language, on the first attempt), cache use, totals and throughput."""
+    n, passed = len(reports), [r for r in reports if r["passed"]]
+    langs = sorted({r.get("lang", "?") for r in reports})
+    phases = {}
+    for r in reports:
+        for k, v in r.get("phases_ms", {}).items(): phases[k] = round(phases.get(k, 0) + v, 1)
+    task_ms = [r["wall_ms"] for r in reports]
+    return {
+        "tasks": n, "passed": len(passed), "pass_rate": round(len(passed) / n, 3) if n else 0.0,
+        "pass_rate_by_lang": {l: round(sum(r["passed"] for r in reports if r.get("lang", "?") == l) /
+                                       sum(r.get("lang", "?") == l for r in reports), 3) for l in langs},
+        "first_attempt_pass_rate": round(sum(r.get("attempts", 0) <= 1 for r in passed) / n, 3) if n else 0.0,
+        "cached": {kind: sum(r.get("cached") == kind for r in reports) for kind in ("solution", "fix")},
+        "llm_calls": sum(r.get("llm_calls", 0) for r in reports),
+        "prompt_tokens": sum(r.get("prompt_tokens", 0) for r in reports),
+        "completion_tokens": sum(r.get("completion_tokens", 0) for r in reports),
+        "cost_usd": round(sum(r.get("cost_usd", 0) for r in reports), 6),
+        "phases_ms": phases,
+        "task_ms": {"p50": percentile(task_ms, 50), "p95": percentile(task_ms, 95), "max": max(task_ms, default=0)},
+        "wall_s": round(wall_s, 2), "tasks_per_min": round(n / wall_s * 60, 2) if wall_s else 0.0,
+        "llm_concurrency": llm_concurrency, "test_concurrency": test_concurrency,
+    }
+
+def batch(items: list[dict], candidates: int = None, use_cache: bool = True, llm_concurrency: int = None,
+          test_concurrency: int = None, workers: int = None):
+    """Heals every {"task", "id"?, "candidates"?} item concurrently, quietly. Yields one report per task in input
+    order, then {"summary": ...}. Workers (tasks in flight) default to LLM + test concurrency, enough to keep both
+    kinds of slot busy."""
+    llm_n, test_n = llm_concurrency or HEALER_LLM_CONCURRENCY, test_concurrency or HEALER_TEST_CONCURRENCY
+    # cargo parallelises a build across every core by itself: share them out between the builds that run at once
+    sched = _Scheduler(llm_n, test_n, verbose=False, cargo_jobs=max(1, (os.cpu_count() or 1) // test_n))
+    reports, start = [], time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or llm_n + test_n, thread_name_prefix="heal-task") as pool:
+        for report in pool.map(lambda args: _heal_one(*args, candidates, use_cache, sched), enumerate(items)):
+            reports.append(report)
+            yield report
+    yield {"summary": _summarize(reports, time.perf_counter() - start, llm_n, test_n)}
+
+def batch_file(path: str, out: str = None, **kwargs) -> dict:
+    """CLI: heals every line of a JSONL file ({"task": ...} or a bare JSON string), writing reports as JSONL to `out`
+    (stdout by default) with the summary last; progress goes to stderr. Returns the summary."""
+    with open(path) as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    items = [{"task": it} if isinstance(it, str) else it for it in items]
+    sink = open(out, "w") if out else sys.stdout
+    try:
+        for done, row in enumerate(batch(items, **kwargs), 1):
+            sink.write(json.dumps(row) + "\n"); sink.flush()
+            if "summary" in row:
+                s = row["summary"]
+                print(f"[batch] {s['passed']}/{s['tasks']} passed ({s['pass_rate']:.0%}) in {s['wall_s']:.1f} s — "
+                      f"{s['tasks_per_min']:.1f} tasks/min, {s['llm_calls']} LLM calls, ${s['cost_usd']:.4f}", file=sys.stderr)
+            else:
+                print(f"[batch] {done}/{len(items)} {row['id']}: {'PASS' if row['passed'] else 'FAIL'} "
+                      f"(attempts {row.get('attempts', 0)}{', cached ' + row['cached'] if row.get('cached') else ''}, "
+                      f"{row['wall_ms'] / 1000:.1f} s)", file=sys.stderr)
+    finally:
+        if out: sink.close()
+    return row["summary"]
+
 if __name__ == "__main__":
-    heal(" ".join(sys.argv[1:]) or "write a function called quicksort that sorts a list using the quicksort algorithm")
\ No newline at end of file
+    if sys.argv[1:2] == ["batch"]:
+        parser = argparse.ArgumentParser(prog="healer.py batch", description="Heal every task in a JSONL file concurrently")
+        parser.add_argument("tasks", help='JSONL, one {"task": ..., "id"?: ..., "candidates"?: ...} or bare string per line')
+        parser.add_argument("--out", help="write the JSONL report here (default: stdout)")
+        parser.add_argument("--candidates", type=int, default=HEALER_CANDIDATES)
+        parser.add_argument("--llm-concurrency", type=int, default=HEALER_LLM_CONCURRENCY, help="LLM calls at once")
+        parser.add_argument("--test-concurrency", type=int, default=HEALER_TEST_CONCURRENCY,
+                            help="test runs / cargo builds at once (default: CPU count)")
+        parser.add_argument("--workers", type=int, help="tasks in flight (default: LLM + test concurrency)")
+        parser.add_argument("--no-cache", action="store_true", help="ignore the solution cache (HEALER_CACHE_PATH)")
+        parser.add_argument("--min-pass-rate", type=float, default=0.0, help="exit 1 below this pass rate (0-1)")
+        args = parser.parse_args(sys.argv[2:])
+        summary = batch_file(args.tasks, args.out, candidates=args.candidates, use_cache=not args.no_cache,
+                             llm_concurrency=args.llm_concurrency, test_concurrency=args.test_concurrency,
+                             workers=args.workers)
+        raise SystemExit(1 if summary["pass_rate"] < args.min_pass_rate else 0)
+    else:
+        parser = argparse.ArgumentParser(description="Self-healing code assistant")
+        parser.add_argument("task", nargs="*")
+        parser.add_argument("--candidates", type=int, default=HEALER_CANDIDATES,
+                            help=f"candidates generated and tested in parallel per attempt (default: {HEALER_CANDIDATES})")
+        parser.add_argument("--no-cache", action="store_true", help="ignore the solution cache (HEALER_CACHE_PATH)")
+        args = parser.parse_args()
+        heal(" ".join(args.task) or "write a function called quicksort that sorts a list using the quicksort algorithm",
+             candidates=args.candidates, use_cache=not args.no_cache)
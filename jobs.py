@@ -0,0 +1,120 @@
+import os, json, time, uuid, sqlite3, threading
+from concurrent.futures import ThreadPoolExecutor
+
+# ── Background jobs ─────────────────────────────────────────────────────────
+# Long agent runs are queued here instead of holding an HTTP connection open. Job rows live in SQLite, so a
+# restarted API picks up whatever was queued or mid-run when it stopped.
+
+JOBS_DB = os.getenv("JOBS_DB", os.path.join(os.path.dirname(__file__), "jobs.db"))
+JOB_WORKERS = int(os.getenv("AGENT_JOB_WORKERS", "2"))
+JOB_MAX_PENDING = int(os.getenv("AGENT_JOB_MAX_PENDING", "100"))
+
+class QueueFull(Exception):
+    pass
+
+class JobStore:
+    """Job rows: status queued -> running -> done | failed, with the payload, per-iteration steps and result as JSON."""
+
+    def __init__(self, path: str = JOBS_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, status TEXT, payload TEXT, "
+                           "steps TEXT DEFAULT '[]', result TEXT, error TEXT, created REAL, started REAL, finished REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self._conn.commit()
+
+    def _write(self, sql: str, args: tuple):
+        with self._lock:
+            self._conn.execute(sql, args)
+            self._conn.commit()
+
+    def create(self, kind: str, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        self._write("INSERT INTO jobs (id, kind, status, payload, created) VALUES (?, ?, 'queued', ?, ?)",
+                    (job_id, kind, json.dumps(payload), time.time()))
+        return job_id
+
+    def start(self, job_id: str):
+        self._write("UPDATE jobs SET status = 'running', started = ?, steps = '[]' WHERE id = ?", (time.time(), job_id))
+
+    def add_step(self, job_id: str, step: dict):
+        self._write("UPDATE jobs SET steps = json_insert(steps, '$[#]', json(?)) WHERE id = ?", (json.dumps(step), job_id))
+
+    def finish(self, job_id: str, result=None, error: str = None):
+        self._write("UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+                    ("failed" if error else "done", json.dumps(result), error, time.time(), job_id))
+
+    def get(self, job_id: str) -> dict:
+        with self._lock:
+            row = self._conn.execute("SELECT id, kind, status, payload, steps, result, error, created, started, finished "
+                                     "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None: return None
+        job = dict(zip(("id", "kind", "status", "payload", "steps", "result", "error", "created", "started", "finished"), row))
+        for k in ("payload", "steps", "result"):
+            job[k] = json.loads(job[k]) if job[k] else None
+        return job
+
+    def unfinished(self) -> list[tuple[str, str, dict]]:
+        """(id, kind, payload) of queued or interrupted jobs, oldest first; running ones go back to queued."""
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'")
+            self._conn.commit()
+            rows = self._conn.execute("SELECT id, kind, payload FROM jobs WHERE status = 'queued' ORDER BY created").fetchall()
+        return [(job_id, kind, json.loads(payload)) for job_id, kind, payload in rows]
+
+class JobQueue:
+    """Bounded worker pool over a JobStore. runners maps kind -> fn(payload, on_step) -> JSON-serialisable result."""
+
+    def __init__(self, store: JobStore, runners: dict, workers: int = JOB_WORKERS, max_pending: int = JOB_MAX_PENDING):
+        self.store, self.runners, self.max_pending = store, runners, max_pending
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def resume(self) -> int:
+        """Re-enqueue jobs left over from a previous process. Call once at startup."""
+        jobs = self.store.unfinished()
+        for job_id, kind, payload in jobs:
+            self._enqueue(job_id, kind, payload)
+        return len(jobs)
+
+    def submit(self, kind: str, payload: dict) -> str:
+        if kind not in self.runners: raise ValueError(f"unknown job kind {kind!r}")
+        with self._lock:  # check and reserve together, so concurrent submits can't overshoot the cap
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"{self._pending} jobs already pending")
+            self._pending += 1
+        try:
+            job_id = self.store.create(kind, payload)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        self._pool.submit(self._run, job_id, kind, payload)
+        return job_id
+
+    def _enqueue(self, job_id: str, kind: str, payload: dict):
+        with self._lock:
+            self._pending += 1
+        self._pool.submit(self._run, job_id, kind, payload)
+
+    def _run(self, job_id: str, kind: str, payload: dict):
+        self.store.start(job_id)
+        try:
+            result = self.runners[kind](payload, lambda step: self.store.add_step(job_id, step))
+        except Exception as e:
+            self.store.finish(job_id, error=f"{type(e).__name__}: {e}")
+        else:
+            self.store.finish(job_id, result=result)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self) -> dict:
+        return {"pending": self._pending, "max_pending": self.max_pending, "workers": self._pool._max_workers}
+
+    def shutdown(self):
+        # Queued and running jobs stay 'queued'/'running' in the store and are resumed on the next start
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import os, json, time, argparse, threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from config import percentile
+
+# ── Open-loop load generator for api.py ─────────────────────────────────────
+# Requests are scheduled at a fixed rate whatever the server does, and latency is measured from each request's
+# scheduled start, so a slow server (or a saturated generator) shows up as latency instead of a lower request rate.
+# Run it against the API with OPENAI_BASE_URL pointed at stub_server.py for repeatable, offline numbers.
+
+AGENT_PROMPT = "Plan a 2-day trip to Auckland for under NZ$500. Departing from Wellington on the 15th of next month."
+
+# name -> (method, path, body for a question, streamed)
+SCENARIOS = {
+    "health": ("GET", "/health", None, False),
+    "rag": ("POST", "/rag/query", lambda q: {"question": q}, False),
+    "rag_stream": ("POST", "/rag/query/stream", lambda q: {"question": q}, True),
+    "rag_batch": ("POST", "/rag/query/batch", lambda q: {"questions": [q]}, True),
+    "agent": ("POST", "/agent/plan", lambda q: {"prompt": AGENT_PROMPT}, False),
+    "agent_job": ("POST", "/agent/jobs", lambda q: {"prompt": AGENT_PROMPT}, False),
+}
+PERCENTILES = (50, 90, 95, 99)
+
+_local = threading.local()
+
+def _session() -> requests.Session:
+    if not hasattr(_local, "session"): _local.session = requests.Session()
+    return _local.session
+
+def _load_questions(path: str = None) -> list[str]:
+    if path is None:
+        from rag import EVAL_QUESTIONS
+        return [item["q"] for item in EVAL_QUESTIONS]
+    lines = [l.strip() for l in open(path) if l.strip()]
+    return [json.loads(l)["question"] if l.startswith("{") else l for l in lines]
+
+def _stream_error(line: bytes):
+    """The failure a streamed line reports after the 200 went out, else None: an SSE `event: error` frame, or an NDJSON
+    row whose "error" is set (a failed question in a batch, or the batch itself)."""
+    line = line.strip()
+    if line.startswith(b"event:"):
+        return line.decode(errors="replace") if line[6:].strip() == b"error" else None
+    if not line.startswith(b"{"): return None  # SSE data/comment lines, blank separators
+    try:
+        row = json.loads(line)
+    except ValueError:
+        return None
+    return line.decode(errors="replace") if isinstance(row, dict) and row.get("error") is not None else None
+
+def send(base_url: str, scenario: str, question: str, scheduled: float, timeout_s: float) -> dict:
+    """One request; latency_ms runs from the scheduled start, ttft_ms to the first body bytes of streamed replies."""
+    method, path, body, streamed = SCENARIOS[scenario]
+    lag_ms = (time.perf_counter() - scheduled) * 1000
+    row = {"scenario": scenario, "status": 0, "lag_ms": round(lag_ms, 1), "ttft_ms": None, "error": None}
+    try:
+        with _session().request(method, base_url + path, json=body(question) if body else None,
+                                stream=streamed, timeout=timeout_s) as r:
+            row["status"] = r.status_code
+            if streamed:
+                pending = b""  # a line split across chunks is checked once it is whole
+                for chunk in r.iter_content(chunk_size=None):
+                    if row["ttft_ms"] is None: row["ttft_ms"] = round((time.perf_counter() - scheduled) * 1000, 1)
+                    *lines, pending = (pending + chunk).split(b"\n")
+                    for line in lines:
+                        if row["error"] is None and (error := _stream_error(line)): row["error"] = error[:200]
+                if row["error"] is None and (error := _stream_error(pending)): row["error"] = error[:200]
+            else:
+                r.content
+            if r.status_code >= 400: row["error"] = r.text[:200] if not streamed else f"HTTP {r.status_code}"
+    except requests.RequestException as e:
+        row["error"] = f"{type(e).__name__}: {e}"[:200]
+    row["latency_ms"] = round((time.perf_counter() - scheduled) * 1000, 1)
+    return row
+
+def run_load(base_url: str, scenarios: list[str], rps: float, duration_s: float, questions: list[str],
+             timeout_s: float = 60, max_workers: int = 256, sender=send) -> dict:
+    """Fires int(rps * duration_s) requests at an even rate, cycling through scenarios and questions."""
+    total, futures, questions = int(rps * duration_s), [], questions or [""]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="load") as pool:
+        for i in range(total):
+            scheduled = start + i / rps
+            if (wait := scheduled - time.perf_counter()) > 0: time.sleep(wait)
+            futures.append(pool.submit(sender, base_url, scenarios[i % len(scenarios)], questions[i % len(questions)],
+                                       scheduled, timeout_s))
+        rows = [f.result() for f in futures]
+    return summarize(rows, time.perf_counter() - start, rps)
+
+def _dist(values: list[float]) -> dict:
+    if not values: return {}
+    return {**{f"p{p}": percentile(values, p) for p in PERCENTILES}, "max": max(values),
+            "mean": round(sum(values) / len(values), 1)}
+
+def _failed(row: dict) -> bool:
+    return bool(row["error"]) or not 200 <= row["status"] < 300
+
+def summarize(rows: list[dict], wall_s: float, target_rps: float) -> dict:
+    """Per-scenario and overall request counts, error breakdown by status, achieved rate and latency percentiles."""
+    report = {"target_rps": target_rps, "wall_s": round(wall_s, 2), "scenarios": {}}
+    for name in dict.fromkeys([r["scenario"] for r in rows] + ["all"]):
+        group = rows if name == "all" else [r for r in rows if r["scenario"] == name]
+        failed, ok = [r for r in group if _failed(r)], [r for r in group if not _failed(r)]
+        errors = {}
+        for r in failed: errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+        report["scenarios"][name] = {
+            "requests": len(group), "errors": errors, "error_rate": round(len(failed) / len(group), 4) if group else 0.0,
+            "achieved_rps": round(len(group) / wall_s, 2) if wall_s else 0.0,
+            "latency_ms": _dist([r["latency_ms"] for r in ok]),
+            "ttft_ms": _dist([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]),
+            "lag_ms_p99": percentile([r["lag_ms"] for r in group], 99),  # generator falling behind its schedule
+        }
+    return report
+
+def _print_report(report: dict):
+    print(f"\n{'═'*88}\nLoad test: {report['target_rps']:g} rps target, {report['wall_s']:.1f} s")
+    print(f"  {'scenario':12s} {'reqs':>6s} {'rps':>7s} {'err%':>6s} {'p50':>8s} {'p90':>8s} {'p95':>8s} {'p99':>8s} "
+          f"{'max':>8s} {'ttft p50':>9s}")
+    for name, s in report["scenarios"].items():
+        lat, ttft = s["latency_ms"], s["ttft_ms"]
+        cols = " ".join(f"{lat.get(k, 0):8.0f}" for k in ("p50", "p90", "p95", "p99", "max"))
+        print(f"  {name:12s} {s['requests']:6d} {s['achieved_rps']:7.2f} {s['error_rate'] * 100:6.2f} {cols} "
+              f"{ttft.get('p50', 0):9.0f}" + (f"  errors {s['errors']}" if s["errors"] else ""))
+
+def check(report: dict, max_p95_ms: float = None, max_error_rate: float = None) -> list[str]:
+    """Threshold violations over all requests (for regression runs)."""
+    overall, failures = report["scenarios"]["all"], []
+    if max_p95_ms is not None and overall["latency_ms"].get("p95", 0) > max_p95_ms:
+        failures.append(f"p95 {overall['latency_ms']['p95']:.0f} ms > {max_p95_ms:g} ms")
+    if max_error_rate is not None and overall["error_rate"] > max_error_rate:
+        failures.append(f"error rate {overall['error_rate']:.2%} > {max_error_rate:.2%}")
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive the API at a target request rate and report latency percentiles")
+    parser.add_argument("--url", default=os.getenv("API_URL", "http://localhost:8000"))
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="repeatable; requests cycle through them (default: rag)")
+    parser.add_argument("--rps", type=float, default=5)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--questions", help="text file (one per line) or JSONL with 'question'; default rag.EVAL_QUESTIONS")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--out", help="write the JSON report here")
+    parser.add_argument("--max-p95-ms", type=float, help="exit 1 if overall p95 latency exceeds this")
+    parser.add_argument("--max-error-rate", type=float, help="exit 1 if the overall error rate exceeds this (0-1)")
+    args = parser.parse_args()
+    report = run_load(args.url.rstrip("/"), args.scenario or ["rag"], args.rps, args.duration,
+                      _load_questions(args.questions), args.timeout)
+    _print_report(report)
+    if args.out:
+        with open(args.out, "w") as f: json.dump(report, f, indent=2)
+    if failures := check(report, args.max_p95_ms, args.max_error_rate):
+        print("\nFAILED: " + "; ".join(failures))
+        raise SystemExit(1)
@@ -0,0 +1,186 @@
+import os, json, time, bisect, atexit, threading
+from datetime import datetime
+from config import METRICS_FILE, Timer, compute_cost, percentile
+
+# In-process metrics for the hot paths: a lock and a few integer updates per observation, rendered on demand for
+# GET /metrics. Metrics declared with a task are also summarised into the shared metrics store (METRICS_FILE) that the
+# dashboard reads: every METRICS_FLUSH_S one "stats" row per series (count, sum, p50, p95), not one row per sample.
+
+MS_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+METRICS_STORE = os.getenv("METRICS_STORE", "1") != "0"
+METRICS_FLUSH_S = float(os.getenv("METRICS_FLUSH_S", "2"))
+
+def _labels(labels: dict, **extra) -> str:
+    items = {**labels, **extra}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(items.items())) + "}" if items else ""
+
+# ── Metrics store writer ────────────────────────────────────────────────────
+
+class _StoreWriter:
+    """Collects samples per series and appends one aggregate row each per flush, from a background thread. Rows are
+    {"ts", "task", "type": "stats", "metric", "labels"?, "count", "sum", "p50", "p95"}: "stats" keeps them apart from
+    the headline rows log_metric writes (accuracy, retrieval_ms, ...)."""
+    def __init__(self, path: str, flush_s: float):
+        self.path, self.flush_s = path, flush_s
+        self._samples, self._lock, self._thread = {}, threading.Lock(), None
+    def add(self, task: str, metric: str, value, labels: dict):
+        key = (task, metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._samples.setdefault(key, []).append(value)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="metrics-store")
+                self._thread.start()
+    def _run(self):
+        while True:
+            time.sleep(self.flush_s)
+            self.flush()
+    def flush(self):
+        with self._lock:
+            samples, self._samples = self._samples, {}
+        if not samples: return
+        ts, rows = datetime.utcnow().isoformat(), []
+        for (task, metric, labels), values in samples.items():
+            row = {"ts": ts, "task": task, "type": "stats", "metric": metric}
+            if labels: row["labels"] = dict(labels)
+            rows.append({**row, "count": len(values), "sum": round(sum(values), 6),
+                         "p50": percentile(values, 50), "p95": percentile(values, 95)})
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(r) + "\n" for r in rows))
+
+_store = _StoreWriter(METRICS_FILE, METRICS_FLUSH_S)
+atexit.register(_store.flush)
+
+# ── Metric types ────────────────────────────────────────────────────────────
+
+class _Metric:
+    kind = "untyped"
+    def __init__(self, name: str, help: str = "", labels: dict = None, task: str = None):
+        self.name, self.help, self.labels, self.task = name, help, labels or {}, task
+        self._lock = threading.Lock()
+    def _to_store(self, value):
+        if self.task and METRICS_STORE:
+            # rag_retrieval_ms -> "retrieval_ms", rag_cost_usd_total -> "cost_usd" (the dashboard's row types)
+            short = self.name[len(self.task) + 1:] if self.name.startswith(self.task + "_") else self.name
+            _store.add(self.task, short.removesuffix("_total"), value, self.labels)
+
+class Histogram(_Metric):
+    """Fixed-bucket histogram: O(log buckets) observe under a lock, cheap enough for hot paths."""
+    kind = "histogram"
+
+    def __init__(self, name: str, buckets: list[float], help: str = "", labels: dict = None, task: str = None):
+        super().__init__(name, help, labels, task)
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count, self.sum = 0, 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self.count += 1
+            self.sum += value
+        self._to_store(value)
+
+    def snapshot(self) -> dict:
+        """Cumulative counts per upper bound (Prometheus `le` semantics)."""
+        with self._lock:
+            counts, total, count = list(self._counts), self.sum, self.count
+        cumulative, running = {}, 0
+        for le, c in zip(self.buckets + ["+Inf"], counts):
+            running += c
+            cumulative[str(le)] = running
+        return {"count": count, "sum": round(total, 3), "buckets": cumulative}
+
+    def prometheus(self) -> list[str]:
+        snap = self.snapshot()
+        return ([f"{self.name}_bucket{_labels(self.labels, le=le)} {n}" for le, n in snap["buckets"].items()]
+                + [f"{self.name}_sum{_labels(self.labels)} {snap['sum']}", f"{self.name}_count{_labels(self.labels)} {snap['count']}"])
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str = "", labels: dict = None, task: str = None):
+        super().__init__(name, help, labels, task)
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+        self._to_store(amount)
+
+    def snapshot(self) -> dict:
+        return {"value": self.value}
+
+    def prometheus(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labels)} {self.value}"]
+
+class Gauge(_Metric):
+    """Read at scrape time from a callback (queue depths, slots in use), so it costs nothing in between."""
+    kind = "gauge"
+
+    def __init__(self, name: str, fn, help: str = "", labels: dict = None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def snapshot(self) -> dict:
+        return {"value": self.fn()}
+
+    def prometheus(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labels)} {self.fn()}"]
+
+# ── Registry ────────────────────────────────────────────────────────────────
+
+REGISTRY: dict[str, _Metric] = {}  # series key (name + labels) -> metric
+_registry_lock = threading.Lock()
+
+def _register(name: str, labels: dict, make) -> _Metric:
+    key = name + _labels(labels)
+    with _registry_lock:
+        if key not in REGISTRY:
+            REGISTRY[key] = make()
+        return REGISTRY[key]
+
+def histogram(name: str, buckets: list[float], help: str = "", task: str = None, **labels) -> Histogram:
+    """Get or create a process-wide histogram series."""
+    return _register(name, labels, lambda: Histogram(name, buckets, help, labels, task))
+
+def counter(name: str, help: str = "", task: str = None, **labels) -> Counter:
+    return _register(name, labels, lambda: Counter(name, help, labels, task))
+
+def gauge(name: str, fn, help: str = "", **labels) -> Gauge:
+    with _registry_lock:
+        metric = REGISTRY[name + _labels(labels)] = Gauge(name, fn, help, labels)  # re-registering rebinds fn
+    return metric
+
+def registered() -> dict[str, _Metric]:
+    """A copy of the registry, safe to iterate while request threads create new series."""
+    with _registry_lock:
+        return dict(REGISTRY)
+
+def render_prometheus() -> str:
+    """Prometheus text exposition format (0.0.4) for every registered series."""
+    lines, seen = [], set()
+    for metric in sorted(registered().values(), key=lambda m: m.name):
+        if metric.name not in seen:
+            seen.add(metric.name)
+            if metric.help: lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines += metric.prometheus()
+    return "\n".join(lines) + "\n"
+
+# ── Helpers ─────────────────────────────────────────────────────────────────
+
+class timed(Timer):
+    """Timer that also observes its elapsed_ms into a histogram: `with timed(RETRIEVAL_MS) as t:`."""
+    def __init__(self, hist: Histogram):
+        self.hist = hist
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        self.hist.observe(self.elapsed_ms)
+
+def record_usage(task: str, prompt_tokens: int, completion_tokens: int):
+    """Token and cost counters for one LLM call."""
+    counter(f"{task}_prompt_tokens_total", "Prompt tokens sent", task=task).inc(prompt_tokens)
+    counter(f"{task}_completion_tokens_total", "Completion tokens received", task=task).inc(completion_tokens)
+    counter(f"{task}_cost_usd_total", "Estimated LLM cost in USD", task=task).inc(compute_cost(prompt_tokens, completion_tokens))
@@ -1,16 +1,65 @@
 #!/usr/bin/env python3
-import sys, os, hashlib, requests
+import sys, os, json, time, queue, shutil, asyncio, hashlib, resource, threading, requests
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from collections import deque
 import chromadb
 from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
 from langchain_openai import ChatOpenAI
-from langchain_chroma import Chroma
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
-from config import OPENAI_BASE_URL, OPENAI_API_KEY, MODEL_NAME, CHROMA_HOST, Timer
+from config import OPENAI_BASE_URL, OPENAI_API_KEY, MODEL_NAME, CHROMA_HOST, METRICS_FILE, Timer, percentile, log_metric, count_tokens, compute_cost
+from cache import EmbeddingCache, AnswerCache
+from retrieval import LexicalIndex, rrf_fuse, pack_context
+from vecstore import ChromaStore, NumpyVectorStore
+from metrics import histogram, timed, record_usage, MS_BUCKETS
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 PERSIST_DIR = os.path.join(os.path.dirname(__file__), "chroma_db")
 COLLECTION = "rag_docs"
+# Embedded mode only: VECTOR_BACKEND=numpy swaps Chroma for the compact memory-mapped store in vecstore.py
+NUMPY_DIR = os.path.join(os.path.dirname(__file__), "numpy_db")
+NUMPY_DTYPE = os.getenv("NUMPY_DTYPE", "float16")  # or int8
+VECTOR_BACKEND = "numpy" if os.getenv("VECTOR_BACKEND", "chroma") == "numpy" and not CHROMA_HOST else "chroma"
+STORE_DIR = NUMPY_DIR if VECTOR_BACKEND == "numpy" else PERSIST_DIR
+# File + chunk content hashes from the last ingest, so re-runs only touch what changed
+MANIFEST_PATH = os.path.join(STORE_DIR, "ingest_manifest.json")
+# BM25 index over the same chunks, for hybrid retrieval
+LEXICAL_PATH = os.path.join(STORE_DIR, "lexical.db")
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "hybrid")
+# Token budget for the retrieved context in each prompt (merged, de-duplicated chunks packed in rank order)
+CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1800"))
+# Machine-readable output of `rag.py bench`, read by dashboard.py
+BENCH_FILE = os.path.join(os.path.dirname(METRICS_FILE), "rag_bench.json")
+
+# Streaming ingest: PDFs are parsed in shards of PAGES_PER_TASK pages across a process pool, and embed/upsert
+# batches flow through bounded queues so memory stays flat regardless of corpus size
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0")) or os.cpu_count() or 1
+PAGES_PER_TASK = 50
+EMBED_BATCH = 100
+QUEUE_DEPTH = 4  # batches buffered per stage before the producer blocks
+
+# Embedding cache shared by ingest and query (set EMBED_CACHE_MAX=0 to disable)
+EMBED_MODEL_ID = "chroma-onnx/all-MiniLM-L6-v2"
+EMBED_CACHE_PATH = os.path.join(os.path.dirname(__file__), "embed_cache.db")
+EMBED_CACHE_MAX = int(os.getenv("EMBED_CACHE_MAX", "200000"))
+
+# Answer cache for query(), keyed by normalized question + top_k + collection version (ANSWER_CACHE_SIZE=0 disables).
+# ANSWER_CACHE_PATH persists it to SQLite; empty keeps it in memory only.
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL_S = float(os.getenv("ANSWER_CACHE_TTL_S", "3600"))
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")
+
+# Query-embedding micro-batching: concurrent embed_query calls within the window share one ONNX run (0 disables)
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "2"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+
+# Batch answering (rag.py batch / POST /rag/query/batch): questions are retrieved BATCH_CHUNK at a time,
+# then answered by BATCH_CONCURRENCY parallel LLM calls, started at most BATCH_RPS per second (0 = unlimited)
+BATCH_CHUNK = 256
+BATCH_CONCURRENCY = int(os.getenv("RAG_BATCH_CONCURRENCY", "8"))
+BATCH_RPS = float(os.getenv("RAG_BATCH_RPS", "0"))
 
 # AI Generated sources
 SOURCES = [
@@ -36,28 +85,132 @@ SOURCES = [
 _default_ef = DefaultEmbeddingFunction()
 
 class _ChromaEmbeddingAdapter:
-    """Wraps Chroma's DefaultEmbeddingFunction to match LangChain's Embeddings interface."""
+    """Wraps Chroma's DefaultEmbeddingFunction to match LangChain's Embeddings interface.
+    With a cache, only texts never seen before (by this model) reach the ONNX model."""
+    def __init__(self, cache: EmbeddingCache = None):
+        self.cache = cache
     def embed_documents(self, texts: list[str]) -> list[list[float]]:
-        return _default_ef(texts)
+        if self.cache is None:
+            return _default_ef(texts)
+        vecs = self.cache.get_many(texts)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vecs) if v is None))  # unique, in order
+        if missing:
+            fresh = dict(zip(missing, ([float(x) for x in v] for v in _default_ef(missing))))
+            self.cache.put_many(missing, list(fresh.values()))
+            vecs = [v if v is not None else fresh[t] for t, v in zip(texts, vecs)]
+        return vecs
     def embed_query(self, text: str) -> list[float]:
-        return _default_ef([text])[0]
+        return self.embed_documents([text])[0]
+
+_embed_cache, _embed_cache_lock = None, threading.Lock()
+
+def _get_embed_cache():
+    global _embed_cache
+    if EMBED_CACHE_MAX <= 0: return None
+    with _embed_cache_lock:
+        if _embed_cache is None:
+            _embed_cache = EmbeddingCache(EMBED_CACHE_PATH, EMBED_MODEL_ID, max_entries=EMBED_CACHE_MAX)
+        return _embed_cache
 
 def _embeddings():
-    return _ChromaEmbeddingAdapter()
+    return _ChromaEmbeddingAdapter(_get_embed_cache())
+
+EMBED_BATCH_SIZE = histogram("rag_embed_batch_size", [1, 2, 4, 8, 16, 32, 64], "Queries per coalesced embedding batch")
+EMBED_QUEUE_WAIT = histogram("rag_embed_queue_wait_ms", [0.5, 1, 2, 5, 10, 25, 50, 100], "Time a query waited to join a batch")
+
+class _BatchingEmbedder:
+    """Coalesces concurrent embed_query calls: the first caller opens a window of window_ms (closed early at
+    max_batch callers), then one embed_documents call serves everyone and each caller gets its own vector back."""
+    def __init__(self, inner, window_ms: float = EMBED_BATCH_WINDOW_MS, max_batch: int = EMBED_MAX_BATCH):
+        self.inner, self.window_s, self.max_batch = inner, window_ms / 1000, max_batch
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True, name="embed-batcher").start()
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.inner.embed_documents(texts)  # already a batch
+    def embed_query(self, text: str) -> list[float]:
+        fut = Future()
+        self._queue.put((text, fut, time.perf_counter()))
+        return fut.result()
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = batch[0][2] + self.window_s
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:  # past the window, still take whatever is already queued
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.perf_counter()
+            EMBED_BATCH_SIZE.observe(len(batch))
+            for _, _, queued in batch: EMBED_QUEUE_WAIT.observe((now - queued) * 1000)
+            try:
+                vectors = self.inner.embed_documents([text for text, _, _ in batch])
+            except Exception as e:
+                for _, fut, _ in batch: fut.set_exception(e)
+                continue
+            for (_, fut, _), vec in zip(batch, vectors): fut.set_result(vec)
+
+def _query_embeddings():
+    emb = _embeddings()
+    return _BatchingEmbedder(emb) if EMBED_BATCH_WINDOW_MS > 0 else emb
 
 def _chroma_client():
     if CHROMA_HOST:
         return chromadb.HttpClient(host=CHROMA_HOST, port=8000)
     return None
 
-def _vectorstore():
+def _vectorstore(backend: str = None):
+    if (backend or VECTOR_BACKEND) == "numpy":
+        return NumpyVectorStore(os.path.join(NUMPY_DIR, "vectors"), _embeddings(), dtype=NUMPY_DTYPE)
     client = _chroma_client()
     if client:
-        return Chroma(client=client, embedding_function=_embeddings(), collection_name=COLLECTION)
-    return Chroma(persist_directory=PERSIST_DIR, embedding_function=_embeddings(), collection_name=COLLECTION)
+        return ChromaStore(client=client, embedding_function=_embeddings(), collection_name=COLLECTION)
+    return ChromaStore(persist_directory=PERSIST_DIR, embedding_function=_embeddings(), collection_name=COLLECTION)
+
+def _llm():
+    return ChatOpenAI(openai_api_base=OPENAI_BASE_URL, openai_api_key=OPENAI_API_KEY, model=MODEL_NAME, temperature=0)
+
+class _Resources:
+    """Per-process vector store and LLM client, built on first use and then reused by every query,
+    so requests don't reopen the collection or start a fresh HTTP connection pool."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+    def _get(self, name, factory):
+        item = self._items.get(name)
+        if item is None:
+            with self._lock:
+                item = self._items.get(name)
+                if item is None:
+                    item = self._items[name] = factory()
+        return item
+    def vectorstore(self):
+        return self._get("vectorstore", _vectorstore)
+    def llm(self):
+        return self._get("llm", _llm)
+    def lexical(self):
+        return self._get("lexical", lambda: LexicalIndex(LEXICAL_PATH))
+    def embeddings(self):
+        return self._get("embeddings", _query_embeddings)
+    def reset(self):
+        """Drops the store, index and client; the query embedder only wraps the model, and its batching thread
+        would leak if it were rebuilt, so it survives."""
+        with self._lock:
+            self._items = {k: v for k, v in self._items.items() if k == "embeddings"}
+
+_resources = _Resources()
+
+def warm_up():
+    """Build the shared resources and load the ONNX session up front (FastAPI startup hook)."""
+    with Timer() as t:
+        _resources.vectorstore().count()
+        _default_ef(["warm up"])  # direct call: the embedding cache would otherwise skip loading the model
+        _resources.llm()
+    print(f"[warm-up] {t.elapsed_ms:.0f} ms")
 
 # Ingest
-def ingest():
+def _download_sources():
     os.makedirs(DATA_DIR, exist_ok=True)
     for src in SOURCES:
         dest = os.path.join(DATA_DIR, src["filename"])
@@ -71,78 +224,560 @@ def ingest():
         except Exception as e:
             print(f"    Failed: {e}. Drop PDF manually into {DATA_DIR}/")
 
-    docs = []
-    for f in os.listdir(DATA_DIR):
-        fpath = os.path.join(DATA_DIR, f)
-        if f.lower().endswith(".pdf"):
-            print(f"  Loading {f}...")
-            docs.extend(PyPDFLoader(fpath).load())
-        elif f.lower().endswith(".txt"):
-            print(f"  Loading {f}...")
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _chunk_id(filename: str, page, content: str) -> str:
+    # Content-addressed, so an unchanged chunk keeps its id across runs and re-ingest upserts instead of appending
+    return hashlib.md5(f"{filename}|{page}|{content}".encode()).hexdigest()[:16]
+
+def _load_manifest() -> dict:
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"version": 0, "files": {}}
+
+def _save_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp = MANIFEST_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, MANIFEST_PATH)  # atomic, a crash mid-write never leaves a half manifest
+
+def _bump_version(manifest: dict):
+    # Any change to the collection invalidates cached answers (see _collection_version)
+    manifest["version"] = manifest.get("version", 0) + 1
+    _save_manifest(manifest)
+
+_version_cache = (None, 0)  # (manifest mtime, version)
+
+def _collection_version() -> int:
+    global _version_cache
+    try:
+        mtime = os.stat(MANIFEST_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+    if _version_cache[0] != mtime:
+        _version_cache = (mtime, _load_manifest().get("version", 0))
+    return _version_cache[1]
+
+def _plan_ingest(known: dict, current: dict) -> tuple[list[str], list[str]]:
+    """known: manifest files entry, current: {filename: sha256}. Returns (changed, removed)."""
+    changed = [f for f, sha in current.items() if known.get(f, {}).get("sha256") != sha]
+    removed = [f for f in known if f not in current]
+    return changed, removed
+
+def _parse_tasks(fpath: str) -> list[tuple]:
+    if fpath.lower().endswith(".pdf"):
+        from pypdf import PdfReader
+        n = len(PdfReader(fpath).pages)
+        return [(fpath, i, min(i + PAGES_PER_TASK, n)) for i in range(0, n, PAGES_PER_TASK)]
+    return [(fpath, None, None)]
+
+def _parse_shard(task: tuple) -> tuple[str, int, list[tuple]]:
+    """Runs in a worker process: parse one shard and chunk it page by page. Returns (file, pages, [(id, text, meta)])."""
+    fpath, start, stop = task
+    fname = os.path.basename(fpath)
+    # start_index lets query-time context packing merge overlapping neighbours exactly
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=300, add_start_index=True)
+
+    def pages():
+        if start is None:
             from langchain_community.document_loaders import TextLoader
-            docs.extend(TextLoader(fpath, encoding="utf-8").load())
-    print(f"  Pages/docs loaded: {len(docs)}")
+            for d in TextLoader(fpath, encoding="utf-8").lazy_load():
+                yield d.page_content, dict(d.metadata)
+        else:
+            # Same extraction PyPDFLoader does, but only for this shard's page range
+            from pypdf import PdfReader
+            reader = PdfReader(fpath)
+            for p in range(start, stop):
+                yield reader.pages[p].extract_text(), {"source": fpath, "page": p}
 
-    # Larger chunks + more overlap = better context preservation for retrieval
-    chunks = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=300).split_documents(docs)
-    for i, c in enumerate(chunks):
-        c.metadata["chunk_id"] = hashlib.md5(f"{c.metadata.get('source','')}-{i}".encode()).hexdigest()[:12]
-        # Storing a clean source name for citations
-        src_path = c.metadata.get("source", "unknown")
-        c.metadata["source_name"] = os.path.basename(src_path).replace("_", " ").replace(".pdf", "")
+    chunks, n_pages = [], 0
+    for text, meta in pages():
+        n_pages += 1
+        for doc in splitter.create_documents([text], [meta]):
+            cid = _chunk_id(fname, meta.get("page", ""), doc.page_content)
+            # Storing a clean source name for citations
+            chunks.append((cid, doc.page_content, {**doc.metadata, "source_name": fname.replace("_", " ").replace(".pdf", ""), "chunk_id": cid}))
+    return fname, n_pages, chunks
 
-    total = len(chunks)
-    batch_size = 100
-    print(f"  Embedding {total} chunks (local model: all-MiniLM-L6-v2)...")
+def _delete_ids(db, ids: list[str], batch_size: int = 1000):
+    for i in range(0, len(ids), batch_size):
+        db.delete(ids=ids[i:i + batch_size])
 
-    from tqdm import tqdm
-    emb = _embeddings()
-    client = _chroma_client()
+_DONE = object()
+
+def _stage(fn, inbox: queue.Queue, outbox, errors: list):
+    """Pipeline thread: apply fn to each item until _DONE. After a failure keep draining so upstream never blocks."""
+    while True:
+        item = inbox.get()
+        if item is _DONE: break
+        if errors: continue
+        try:
+            out = fn(item)
+        except BaseException as e:
+            errors.append(e); continue
+        if outbox is not None: outbox.put(out)
+    if outbox is not None: outbox.put(_DONE)
+
+def _peak_rss_mb() -> tuple[float, float]:
+    scale = 1 / 1024 if sys.platform != "darwin" else 1 / (1024 * 1024)  # ru_maxrss is KB on Linux, bytes on macOS
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+def _backfill_lexical(db, lexical: LexicalIndex, page: int = 1000):
+    total = db.count()
+    print(f"  Building lexical index for {total} existing chunks...")
+    for offset in range(0, total, page):
+        got = db.get_page(page, offset)
+        lexical.upsert(got["ids"], got["documents"], got["metadatas"])
 
-    # First batch creates the store, subsequent batches add to it
-    for i in tqdm(range(0, total, batch_size), desc="  Embedding", unit="batch"):
-        batch = chunks[i:i + batch_size]
-        if i == 0:
-            if client:
-                db = Chroma.from_documents(batch, emb, client=client, collection_name=COLLECTION)
-            else:
-                db = Chroma.from_documents(batch, emb, persist_directory=PERSIST_DIR, collection_name=COLLECTION)
+def ingest(workers: int = INGEST_WORKERS) -> dict:
+    _download_sources()
+    manifest = _load_manifest()
+    db = _vectorstore()
+    lexical = LexicalIndex(LEXICAL_PATH)
+    if not manifest["files"] and db.count():
+        # Collection was built before the manifest existed (positional ids) — rebuild it once, cleanly
+        print("  Existing collection has no manifest, rebuilding it")
+        db.delete_collection()
+        db = _vectorstore()
+        lexical.clear()
+    if manifest["files"] and not lexical.count() and db.count():
+        _backfill_lexical(db, lexical)  # collection predates the lexical index
+        _bump_version(manifest)
+
+    with Timer() as t:
+        current = {f: _file_sha256(os.path.join(DATA_DIR, f)) for f in sorted(os.listdir(DATA_DIR))
+                   if f.lower().endswith((".pdf", ".txt"))}
+        changed, removed = _plan_ingest(manifest["files"], current)
+    print(f"  {len(current)} files hashed in {t.elapsed_ms:.0f} ms — {len(changed)} new/changed, {len(removed)} removed")
+
+    for f in removed:
+        print(f"  Removing {f}...")
+        ids = manifest["files"].pop(f)["chunks"]
+        _delete_ids(db, ids); lexical.delete(ids)
+        _save_manifest(manifest)
+
+    if not changed:
+        if removed: _bump_version(manifest)
+        print(f"   Done — nothing to embed, collection size {db.count()}")
+        return {"files": 0, "pages": 0, "chunks": 0, "embedded": 0, "deleted": 0}
+
+    old = {f: set(manifest["files"].get(f, {}).get("chunks", [])) for f in changed}
+    tasks = [task for f in changed for task in _parse_tasks(os.path.join(DATA_DIR, f))]
+    shards_left = {f: 0 for f in changed}
+    for fpath, _, _ in tasks: shards_left[os.path.basename(fpath)] += 1
+    seen = {f: {} for f in changed}  # file -> ordered chunk ids (ids only, texts stream through)
+    stats = {"files": len(changed), "pages": 0, "chunks": 0, "embedded": 0, "deleted": 0}
+
+    # Stage 2 (thread): embed batches. Stage 3 (thread): upsert batches and commit finished files to the manifest.
+    emb = _embeddings()
+    def embed(item):
+        if "done" not in item:
+            item["vectors"] = emb.embed_documents(item["texts"])
+        return item
+    def write(item):
+        if "done" in item:
+            f = item["done"]
+            _delete_ids(db, item["stale"]); lexical.delete(item["stale"]); stats["deleted"] += len(item["stale"])
+            manifest["files"][f] = {"sha256": current[f], "chunks": item["chunks"]}
+            _save_manifest(manifest)
         else:
-            db.add_documents(batch)
+            db.upsert(item["ids"], item["vectors"], item["texts"], item["metas"])
+            lexical.upsert(item["ids"], item["texts"], item["metas"])
+            stats["embedded"] += len(item["ids"])
+
+    to_embed, to_write, errors = queue.Queue(QUEUE_DEPTH), queue.Queue(QUEUE_DEPTH), []
+    threads = [threading.Thread(target=_stage, args=(embed, to_embed, to_write, errors), daemon=True),
+               threading.Thread(target=_stage, args=(write, to_write, None, errors), daemon=True)]
+    for th in threads: th.start()
+    for f in changed:
+        if not shards_left[f]:  # nothing to parse (e.g. a 0-page PDF): record it now, dropping any old chunks
+            to_embed.put({"done": f, "chunks": [], "stale": list(old[f])})
 
-    print(f"   Done — {total} chunks embedded")
+    from tqdm import tqdm
+    print(f"  Parsing {len(tasks)} shards on {workers} workers, embedding (local model: all-MiniLM-L6-v2)...")
+    with Timer() as t, ProcessPoolExecutor(max_workers=workers) as pool, tqdm(desc="  Ingest", unit="page") as bar:
+        pending, it = set(), iter(tasks)
+        while True:
+            # Only a couple of shards in flight per worker; a full embed queue blocks here, which stalls submission
+            while len(pending) < workers * 2 and not errors:
+                task = next(it, None)
+                if task is None: break
+                pending.add(pool.submit(_parse_shard, task))
+            if not pending: break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                f, n_pages, chunks = fut.result()
+                stats["pages"] += n_pages; bar.update(n_pages)
+                fresh = []
+                for cid, text, meta in chunks:
+                    if cid in seen[f]: continue  # identical chunks within a file collapse to one vector
+                    seen[f][cid] = None
+                    if cid not in old[f]: fresh.append((cid, text, meta))
+                stats["chunks"] += len(chunks)
+                for i in range(0, len(fresh), EMBED_BATCH):
+                    ids, texts, metas = zip(*fresh[i:i + EMBED_BATCH])
+                    to_embed.put({"ids": list(ids), "texts": list(texts), "metas": list(metas)})
+                shards_left[f] -= 1
+                if shards_left[f] == 0:
+                    to_embed.put({"done": f, "chunks": list(seen[f]), "stale": [c for c in old[f] if c not in seen[f]]})
+        to_embed.put(_DONE)
+        for th in threads: th.join()
+    if errors: raise errors[0]
+    _bump_version(manifest)
+    _resources.reset()  # the collection may have been rebuilt under this process's cached wrapper
+
+    secs = max(t.elapsed_ms / 1000, 1e-9)
+    main_mb, worker_mb = _peak_rss_mb()
+    stats.update(seconds=round(secs, 2), pages_per_s=round(stats["pages"] / secs, 1),
+                 chunks_per_s=round(stats["chunks"] / secs, 1), peak_rss_mb=round(main_mb), peak_worker_rss_mb=round(worker_mb))
+    print(f"   Done — {stats['pages']} pages, {stats['chunks']} chunks ({stats['embedded']} embedded, "
+          f"{stats['deleted']} deleted) in {secs:.1f}s")
+    print(f"   {stats['pages_per_s']} pages/s, {stats['chunks_per_s']} chunks/s, "
+          f"peak RSS {stats['peak_rss_mb']} MB (workers {stats['peak_worker_rss_mb']} MB), collection size {db.count()}")
+    if emb.cache is not None:
+        stats["embed_cache"] = emb.cache.stats()
+        print(f"   Embedding cache: {stats['embed_cache']}")
+    return stats
 
 # ── Query ───────────────────────────────────────────────────────────────────
-def query(question: str, top_k: int = 5, verbose: bool = True) -> dict:
-    db = _vectorstore()
-    with Timer() as rt:
-        results = db.similarity_search_with_score(question, k=top_k)
-    if verbose: print(f"[retrieval] {rt.elapsed_ms:.0f} ms")
+_answer_cache, _answer_cache_lock = None, threading.Lock()
 
+def _get_answer_cache():
+    global _answer_cache
+    if ANSWER_CACHE_SIZE <= 0: return None
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_S, ANSWER_CACHE_PATH or None)
+        return _answer_cache
+
+def _answer_key(question: str, top_k: int, version: int, mode: str = None) -> str:
+    normalized = " ".join(question.lower().split()).rstrip("?!. ")
+    return hashlib.sha1(json.dumps([normalized, top_k, version, mode or RETRIEVAL_MODE]).encode()).hexdigest()
+
+def _fuse(vec: list, lex: list, top_k: int) -> list[tuple[Document, float]]:
+    by_id = {}
+    rankings = []
+    for hits in (vec, lex):
+        ids = []
+        for d, _ in hits:
+            cid = d.metadata.get("chunk_id") or hashlib.md5(d.page_content.encode()).hexdigest()
+            by_id.setdefault(cid, d); ids.append(cid)
+        rankings.append(ids)
+    return [(by_id[cid], score) for cid, score in rrf_fuse(rankings)[:top_k]]
+
+def _retrieve_many(questions: list[str], top_k: int, mode: str = None, vectors: list = None) -> list[list[tuple[Document, float]]]:
+    """_retrieve for a list of questions: one embedding call and one vector search cover all of them."""
+    mode = mode or RETRIEVAL_MODE
+    if mode not in RETRIEVAL_MODES: raise ValueError(f"mode must be one of {RETRIEVAL_MODES}")
+    db, lexical = _resources.vectorstore(), _resources.lexical()
+    use_lexical = mode != "vector" and lexical.count() > 0
+    fetch_k = max(top_k * 4, 20)  # candidate pool per retriever before fusion
+    lex = lambda q: [(Document(page_content=text, metadata=meta), score) for _, text, meta, score in lexical.search(q, fetch_k)]
+    if mode == "lexical" and use_lexical:
+        return [lex(q)[:top_k] for q in questions]
+    if vectors is None:
+        emb = _resources.embeddings()
+        # A single question goes through the micro-batcher so concurrent requests still share an ONNX run
+        vectors = [emb.embed_query(questions[0])] if len(questions) == 1 else emb.embed_documents(questions)
+    vec_hits = db.search_by_vectors(vectors, fetch_k if use_lexical else top_k)
+    if not use_lexical:
+        return vec_hits
+    return [_fuse(vec, lex(q), top_k) for q, vec in zip(questions, vec_hits)]
+
+def _retrieve(question: str, top_k: int, mode: str = None, vector: list[float] = None) -> list[tuple[Document, float]]:
+    """Vector (score = distance, lower is better), lexical (BM25) or hybrid (RRF score, higher is better).
+    Pass a precomputed query vector to skip embedding (batch callers)."""
+    return _retrieve_many([question], top_k, mode, None if vector is None else [vector])[0]
+
+SYSTEM_PROMPT = (
+    "You are a QA assistant. Answer using ONLY the provided context.\n"
+    "For EVERY claim, include an inline citation with the source name and page number, "
+    "formatted like: [1: Fellowship of the Ring, p.42]. "
+    "Use the citation labels from the context. If the answer is not in the context, say so."
+)
+
+def _build_messages(question: str, results: list) -> tuple[list[dict], list]:
+    """Pack the retrieved chunks into the context budget; returns (messages, packed results the labels refer to)."""
+    packed = pack_context(results, CONTEXT_TOKENS, count_tokens)
     # Build context with detailed citation markers
     context_parts = []
-    for i, (d, _) in enumerate(results, 1):
+    for i, (d, _) in enumerate(packed, 1):
         src_name = d.metadata.get("source_name", d.metadata.get("source", "unknown"))
         page = d.metadata.get("page", "?")
         context_parts.append(f"[{i}] — {src_name}, p.{page}\n{d.page_content}")
     context = "\n\n".join(context_parts)
+    return [{"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {question}"}], packed
+
+def _prompt_tokens(messages: list[dict]) -> int:
+    return sum(count_tokens(m["content"]) for m in messages)
+
+def _sources(results: list) -> list[dict]:
+    return [{"source": d.metadata.get("source_name",""), "page": d.metadata.get("page",""), "score": float(s)} for d,s in results]
+
+RETRIEVAL_MS = histogram("rag_retrieval_ms", MS_BUCKETS, "Vector/lexical/hybrid retrieval time", task="rag")
+LLM_MS = histogram("rag_llm_ms", MS_BUCKETS, "LLM call time (to last token when streaming)", task="rag")
+TTFT_MS = histogram("rag_ttft_ms", MS_BUCKETS, "Time to first streamed token, from request start", task="rag")
+QUERY_MS = histogram("rag_query_ms", MS_BUCKETS, "End-to-end answer latency, cache hits included", task="rag")
+
+def _lookup(question: str, top_k: int, mode: str, use_cache: bool) -> tuple:
+    """(cache, key, cached answer or None)."""
+    cache = _get_answer_cache() if use_cache else None
+    key = _answer_key(question, top_k, _collection_version(), mode)
+    return cache, key, cache.get(key) if cache else None
+
+def _prepare(question: str, top_k: int, mode: str = None) -> tuple:
+    """Retrieval, context packing and counting the prompt (~2k tokens) once: (messages, packed, retrieval_ms,
+    n retrieved, prompt tokens). Blocking, so async callers run it in a thread."""
+    with timed(RETRIEVAL_MS) as rt:
+        results = _retrieve(question, top_k, mode)
+    messages, packed = _build_messages(question, results)
+    return messages, packed, rt.elapsed_ms, len(results), _prompt_tokens(messages)
+
+def _result(answer: str, prompt_tokens: int, packed: list, retrieval_ms: float, llm_ms: float) -> dict:
+    record_usage("rag", prompt_tokens, count_tokens(answer))
+    return {"answer": answer, "retrieval_ms": retrieval_ms, "llm_ms": llm_ms,
+            "prompt_tokens": prompt_tokens, "sources": _sources(packed)}
 
-    system_prompt = (
-        "You are a QA assistant. Answer using ONLY the provided context.\n"
-        "For EVERY claim, include an inline citation with the source name and page number, "
-        "formatted like: [1: Fellowship of the Ring, p.42]. "
-        "Use the citation labels from the context. If the answer is not in the context, say so."
-    )
-
-    llm = ChatOpenAI(openai_api_base=OPENAI_BASE_URL, openai_api_key=OPENAI_API_KEY, model=MODEL_NAME, temperature=0)
-    with Timer() as lt:
-        resp = llm.invoke([
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {question}"},
-        ])
+def _answer(question: str, top_k: int, verbose: bool, mode: str = None) -> dict:
+    messages, packed, retrieval_ms, n, prompt_tokens = _prepare(question, top_k, mode)
+    if verbose: print(f"[retrieval] {retrieval_ms:.0f} ms — {n} chunks packed into {len(packed)} blocks, {prompt_tokens} prompt tokens")
+
+    llm = _resources.llm()
+    with timed(LLM_MS) as lt:
+        resp = llm.invoke(messages)
     if verbose: print(f"[llm] {lt.elapsed_ms:.0f} ms\n\nAnswer: {resp.content}\n")
-    return {"answer": resp.content, "retrieval_ms": rt.elapsed_ms, "llm_ms": lt.elapsed_ms,
-            "sources": [{"source": d.metadata.get("source_name",""), "page": d.metadata.get("page",""), "score": float(s)} for d,s in results]}
+    return _result(resp.content, prompt_tokens, packed, retrieval_ms, lt.elapsed_ms)
+
+def _cached_result(hit: dict) -> dict:
+    # Served without retrieval or an LLM round trip
+    return {**hit, "retrieval_ms": 0.0, "llm_ms": 0.0, "cached": True}
+
+def query(question: str, top_k: int = 5, verbose: bool = True, use_cache: bool = True, mode: str = None) -> dict:
+    with timed(QUERY_MS) as t:
+        cache, key, hit = _lookup(question, top_k, mode, use_cache)
+        if hit is None:
+            result = {**_answer(question, top_k, verbose, mode), "cached": False}
+            if cache: cache.put(key, {k: v for k, v in result.items() if k != "cached"})
+        else:
+            result = _cached_result(hit)
+            if verbose: print(f"[answer cache hit]\n\nAnswer: {hit['answer']}\n")
+    result["latency_ms"] = t.elapsed_ms
+    return result
+
+async def aquery(question: str, top_k: int = 5, use_cache: bool = True, mode: str = None) -> dict:
+    """query() for the event loop: retrieval runs in a worker thread, the LLM call on the async client,
+    so a request holds no thread while it waits on the model."""
+    with timed(QUERY_MS) as t:
+        cache, key, hit = await asyncio.to_thread(_lookup, question, top_k, mode, use_cache)
+        if hit is None:
+            messages, packed, retrieval_ms, _, prompt_tokens = await asyncio.to_thread(_prepare, question, top_k, mode)
+            with timed(LLM_MS) as lt:
+                resp = await _resources.llm().ainvoke(messages)
+            result = {**_result(resp.content, prompt_tokens, packed, retrieval_ms, lt.elapsed_ms), "cached": False}
+            # a file-backed cache commits to SQLite: keep it off the event loop, like _lookup
+            if cache: await asyncio.to_thread(cache.put, key, {k: v for k, v in result.items() if k != "cached"})
+        else:
+            result = _cached_result(hit)
+    result["latency_ms"] = t.elapsed_ms
+    return result
+
+class _StreamState:
+    """Accumulates one streamed answer; shared by the sync and async generators, which call store() after done()
+    (the async one from a thread)."""
+    def __init__(self, cache, key, prompt_tokens, packed, retrieval_ms, start):
+        self.cache, self.key, self.prompt_tokens, self.packed, self.retrieval_ms = cache, key, prompt_tokens, packed, retrieval_ms
+        self.start, self.llm_start = start, None
+        self.parts, self.ttft_ms, self.result = [], None, None
+    def elapsed(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+    def token(self, text: str):
+        if self.ttft_ms is None: self.ttft_ms = self.elapsed()
+        self.parts.append(text)
+    def done(self) -> dict:
+        total_ms, llm_ms = self.elapsed(), (time.perf_counter() - self.llm_start) * 1000
+        result = self.result = _result("".join(self.parts), self.prompt_tokens, self.packed, self.retrieval_ms, llm_ms)
+        LLM_MS.observe(llm_ms); QUERY_MS.observe(total_ms)
+        TTFT_MS.observe(self.ttft_ms if self.ttft_ms is not None else total_ms)
+        return {"retrieval_ms": self.retrieval_ms, "ttft_ms": self.ttft_ms if self.ttft_ms is not None else total_ms,
+                "total_ms": total_ms, "prompt_tokens": result["prompt_tokens"], "cached": False}
+    def store(self):
+        if self.cache: self.cache.put(self.key, self.result)
+
+def _cached_stream(hit: dict, start: float):
+    elapsed = (time.perf_counter() - start) * 1000
+    TTFT_MS.observe(elapsed); QUERY_MS.observe(elapsed)
+    return [("sources", hit["sources"]), ("token", hit["answer"]),
+            ("done", {"retrieval_ms": 0.0, "ttft_ms": elapsed, "total_ms": elapsed, "cached": True})]
+
+def query_stream(question: str, top_k: int = 5, use_cache: bool = True, mode: str = None):
+    """Yields (event, data): ("sources", [...]) once retrieval is done, ("token", str) per LLM delta,
+    then ("done", timings) with retrieval_ms, ttft_ms (time to first token, from request start) and total_ms."""
+    start = time.perf_counter()
+    cache, key, hit = _lookup(question, top_k, mode, use_cache)
+    if hit is not None:
+        yield from _cached_stream(hit, start)
+        return
+    messages, packed, retrieval_ms, _, prompt_tokens = _prepare(question, top_k, mode)
+    state = _StreamState(cache, key, prompt_tokens, packed, retrieval_ms, start)
+    yield "sources", _sources(packed)
+    state.llm_start = time.perf_counter()
+    for chunk in _resources.llm().stream(messages):
+        if not chunk.content: continue
+        state.token(chunk.content)
+        yield "token", chunk.content
+    done = state.done()
+    state.store()
+    yield "done", done
+
+async def aquery_stream(question: str, top_k: int = 5, use_cache: bool = True, mode: str = None):
+    """Async query_stream() on the async LLM client."""
+    start = time.perf_counter()
+    cache, key, hit = await asyncio.to_thread(_lookup, question, top_k, mode, use_cache)
+    if hit is not None:
+        for event in _cached_stream(hit, start): yield event
+        return
+    messages, packed, retrieval_ms, _, prompt_tokens = await asyncio.to_thread(_prepare, question, top_k, mode)
+    state = _StreamState(cache, key, prompt_tokens, packed, retrieval_ms, start)
+    yield "sources", _sources(packed)
+    state.llm_start = time.perf_counter()
+    async for chunk in _resources.llm().astream(messages):
+        if not chunk.content: continue
+        state.token(chunk.content)
+        yield "token", chunk.content
+    done = state.done()
+    await asyncio.to_thread(state.store)
+    yield "done", done
+
+# ── Batch answering ─────────────────────────────────────────────────────────
+
+class _RateLimiter:
+    """Spaces call starts at least 1/rps apart across threads (rps <= 0 disables)."""
+    def __init__(self, rps: float):
+        self.interval, self._next, self._lock = 1 / rps if rps > 0 else 0, 0.0, threading.Lock()
+    def wait(self):
+        if not self.interval: return
+        with self._lock:
+            now = time.monotonic()
+            slot, self._next = max(now, self._next), max(now, self._next) + self.interval
+        if slot > now: time.sleep(slot - now)
+
+def _batch_items(items: list) -> list[dict]:
+    """Accepts plain question strings or {"question", "id"?} objects."""
+    return [{"question": it} if isinstance(it, str) else it for it in items]
+
+def _answer_one(messages: list, packed: list, retrieval_ms: float, limiter: _RateLimiter, cache, key) -> dict:
+    limiter.wait()
+    with timed(LLM_MS) as lt:
+        resp = _resources.llm().invoke(messages)
+    result = _result(resp.content, _prompt_tokens(messages), packed, retrieval_ms, lt.elapsed_ms)
+    if cache: cache.put(key, result)
+    return {**result, "cached": False}
+
+def batch(items: list, top_k: int = 5, mode: str = None, concurrency: int = BATCH_CONCURRENCY, rps: float = BATCH_RPS,
+          use_cache: bool = True):
+    """Answers many questions, yielding one result dict per item in input order, then {"summary": {...}}.
+    Each chunk of questions shares one embedding call and one vector search; LLM calls run `concurrency` at a
+    time behind a rate limiter, and the next chunk is retrieved while the previous one is still generating."""
+    items = _batch_items(items)
+    limiter, pending = _RateLimiter(rps), deque()
+    retrieval_ms, llm_times, counts = 0.0, [], {"errors": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    start = time.perf_counter()
+
+    def finish(index: int, item: dict, result: dict) -> dict:
+        row = {"index": index, **({"id": item["id"]} if "id" in item else {}), "question": item["question"], **result}
+        if "error" in row:
+            counts["errors"] += 1
+            return row
+        row["completion_tokens"] = count_tokens(row["answer"])
+        row["cost_usd"] = 0.0 if row["cached"] else compute_cost(row["prompt_tokens"], row["completion_tokens"])
+        if row["cached"]: counts["cached"] += 1
+        else:
+            llm_times.append(row["llm_ms"])
+            counts["prompt_tokens"] += row["prompt_tokens"]; counts["completion_tokens"] += row["completion_tokens"]
+        return row
+
+    def drain(limit: int):
+        while len(pending) > limit:
+            index, item, fut = pending.popleft()
+            try:
+                result = fut.result()
+            except Exception as e:
+                result = {"error": f"{type(e).__name__}: {e}"}
+            yield finish(index, item, result)
+
+    def follow(first: Future) -> Future:
+        """A repeat of a question already being answered in this batch: reuse that answer, as a cache hit."""
+        dup = Future()
+        first.add_done_callback(lambda f: dup.set_exception(f.exception()) if f.exception()
+                                else dup.set_result(_cached_result({k: v for k, v in f.result().items() if k != "cached"})))
+        return dup
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="rag-batch") as pool:
+        for offset in range(0, len(items), BATCH_CHUNK):
+            chunk = list(enumerate(items[offset:offset + BATCH_CHUNK], offset))
+            todo, repeats = [], {}  # key -> slots in `pending` waiting on the first occurrence
+            for index, item in chunk:
+                cache, key, hit = _lookup(item["question"], top_k, mode, use_cache)
+                if hit is not None:
+                    fut = Future(); fut.set_result(_cached_result(hit))
+                    pending.append((index, item, fut))
+                elif key in repeats:
+                    pending.append((index, item, None)); repeats[key].append(len(pending) - 1)
+                else:
+                    pending.append((index, item, None)); todo.append((len(pending) - 1, index, item, cache, key))
+                    repeats[key] = []
+            if todo:
+                with Timer() as rt:
+                    try:
+                        hits = _retrieve_many([item["question"] for _, _, item, _, _ in todo], top_k, mode)
+                    except Exception as e:
+                        hits = e
+                retrieval_ms += rt.elapsed_ms
+                per_question = rt.elapsed_ms / len(todo)
+                for _ in todo: RETRIEVAL_MS.observe(per_question)  # one sample per question, like query()
+                for n, (slot, index, item, cache, key) in enumerate(todo):
+                    if isinstance(hits, Exception):
+                        fut = Future(); fut.set_exception(hits)
+                    else:
+                        messages, packed = _build_messages(item["question"], hits[n])
+                        fut = pool.submit(_answer_one, messages, packed, per_question, limiter, cache, key)
+                    pending[slot] = (index, item, fut)
+                    for dup_slot in repeats[key]:
+                        pending[dup_slot] = (*pending[dup_slot][:2], follow(fut))
+            yield from drain(len(todo))  # keep about one chunk in flight while the next is retrieved
+        yield from drain(0)
+
+    wall_s = time.perf_counter() - start
+    summary = {"n": len(items), **counts, "wall_s": round(wall_s, 2),
+               "questions_per_s": round(len(items) / wall_s, 2) if wall_s else 0.0,
+               "retrieval_ms": round(retrieval_ms, 1), "llm_p50_ms": round(percentile(llm_times, 50), 1),
+               "llm_p95_ms": round(percentile(llm_times, 95), 1),
+               "cost_usd": round(compute_cost(counts["prompt_tokens"], counts["completion_tokens"]), 6),
+               "concurrency": concurrency, "rps": rps}
+    yield {"summary": summary}
+
+def batch_file(path: str, out: str = None, top_k: int = 5, mode: str = None):
+    """CLI: answer every line of a JSONL file ({"question": ..., "id"?: ...} or a bare JSON string), writing
+    results as JSONL to `out` (stdout by default) in input order; the summary goes last and to stderr."""
+    with open(path) as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    sink = open(out, "w") if out else sys.stdout
+    try:
+        for row in batch(items, top_k=top_k, mode=mode):
+            sink.write(json.dumps(row) + "\n"); sink.flush()
+            if "summary" in row: print(f"[batch] {row['summary']}", file=sys.stderr)
+    finally:
+        if out: sink.close()
 
 # ── Evaluation (≥20 graded questions) ──────────────────────────────────────
 # Keywords are lowercased substrings that should appear in the top-K retrieved chunks.
@@ -170,28 +805,142 @@ EVAL_QUESTIONS = [
     {"q": "What are the Nazgul or Ringwraiths?", "keywords": ["nazgul", "ringwraith", "black rider", "nine"]},
 ]
 
-def evaluate():
-    db = _vectorstore()
+def evaluate(mode: str = None, k: int = 10):
     correct, times = 0, []
-    print(f"Evaluating {len(EVAL_QUESTIONS)} questions...\n")
+    print(f"Evaluating {len(EVAL_QUESTIONS)} questions ({mode or RETRIEVAL_MODE} retrieval)...\n")
     for i, item in enumerate(EVAL_QUESTIONS, 1):
         with Timer() as t:
-            results = db.similarity_search(item["q"], k=10)  # wider net for eval
+            results = _retrieve(item["q"], k, mode)  # wider net for eval
         times.append(t.elapsed_ms)
-        combined = " ".join(d.page_content.lower() for d in results)
+        combined = " ".join(d.page_content.lower() for d, _ in results)
         hit = any(kw in combined for kw in item["keywords"])
         if hit: correct += 1
         print(f"  {'Yes' if hit else 'No'} Q{i}: {item['q'][:55]}  ({t.elapsed_ms:.0f} ms)")
 
     print(f"\n{'='*50}")
-    print(f"Top-10 Retrieval Accuracy: {correct}/{len(EVAL_QUESTIONS)} ({correct/len(EVAL_QUESTIONS)*100:.1f}%)")
+    print(f"Top-{k} Retrieval Accuracy: {correct}/{len(EVAL_QUESTIONS)} ({correct/len(EVAL_QUESTIONS)*100:.1f}%)")
     print(f"Median retrieval time:     {sorted(times)[len(times)//2]:.0f} ms")
     print(f"{'='*50}")
 
+def _first_hit_rank(docs: list[Document], keywords: list[str]):
+    for rank, d in enumerate(docs, 1):
+        text = d.page_content.lower()
+        if any(kw in text for kw in keywords): return rank
+    return None
+
+def bench(modes: list[str] = None, ks: tuple = (1, 3, 5, 10), concurrency: tuple = (1, 4, 8), out: str = BENCH_FILE) -> dict:
+    """Retrieval benchmark over EVAL_QUESTIONS: recall@k, MRR@k, latency percentiles and QPS per (mode, k, concurrency).
+    Questions are embedded in one batch up front, so the timings are retrieval only."""
+    modes = modes or [RETRIEVAL_MODE]
+    questions = [item["q"] for item in EVAL_QUESTIONS]
+    with Timer() as et:
+        vectors = _resources.vectorstore().embeddings.embed_documents(questions)
+    print(f"Embedded {len(questions)} questions in one batch: {et.elapsed_ms:.0f} ms\n")
+
+    def retrieve_one(i, k, mode):
+        with Timer() as t:
+            docs = [d for d, _ in _retrieve(questions[i], k, mode, vector=vectors[i])]
+        return docs, t.elapsed_ms
+
+    rows = []
+    print(f"  {'mode':8s} {'k':>3s} {'conc':>5s} {'recall':>7s} {'MRR':>6s} {'p50':>7s} {'p95':>7s} {'p99':>7s} {'QPS':>7s}")
+    for mode in modes:
+        for k in ks:
+            for c in concurrency:
+                with Timer() as wall, ThreadPoolExecutor(max_workers=c) as pool:
+                    results = list(pool.map(lambda i: retrieve_one(i, k, mode), range(len(questions))))
+                ranks = [_first_hit_rank(docs, item["keywords"]) for (docs, _), item in zip(results, EVAL_QUESTIONS)]
+                times = [ms for _, ms in results]
+                row = {"mode": mode, "k": k, "concurrency": c,
+                       "recall": round(sum(r is not None for r in ranks) / len(ranks), 3),
+                       "mrr": round(sum(1 / r for r in ranks if r) / len(ranks), 3),
+                       "p50_ms": round(percentile(times, 50), 2), "p95_ms": round(percentile(times, 95), 2),
+                       "p99_ms": round(percentile(times, 99), 2), "qps": round(len(questions) / (wall.elapsed_ms / 1000), 1)}
+                rows.append(row)
+                print(f"  {mode:8s} {k:3d} {c:5d} {row['recall']:7.2f} {row['mrr']:6.3f} {row['p50_ms']:6.1f}ms "
+                      f"{row['p95_ms']:6.1f}ms {row['p99_ms']:6.1f}ms {row['qps']:7.1f}")
+
+    report = {"ts": datetime.utcnow().isoformat(), "collection_version": _collection_version(),
+              "n_questions": len(questions), "embed_batch_ms": round(et.elapsed_ms, 1), "results": rows}
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    # Headline numbers for the dashboard's history charts: widest k, single-threaded, first mode
+    head = next(r for r in rows if r["k"] == max(ks) and r["concurrency"] == min(concurrency))
+    log_metric("rag", "accuracy", head["recall"] * 100)
+    log_metric("rag", "retrieval_ms", head["p50_ms"])
+    print(f"\nWrote {out}")
+    return report
+
+def compare_backends(k: int = 10, out: str = None) -> dict:
+    """Recall/latency of the NumPy backend against the current Chroma collection, on EVAL_QUESTIONS.
+    Copies the Chroma vectors into NUMPY_DIR first if the NumPy store is empty (no re-embedding)."""
+    out = out or os.path.join(os.path.dirname(METRICS_FILE), "backend_compare.json")
+    chroma = _vectorstore("chroma")
+    with Timer() as ot:
+        npdb = _vectorstore("numpy")
+    if not npdb.count():
+        print(f"Copying {chroma.count()} vectors from Chroma into {NUMPY_DIR}...")
+        for offset in range(0, chroma.count(), 1000):
+            page = chroma.get_page(1000, offset, with_embeddings=True)
+            npdb.upsert(page["ids"], page["embeddings"], page["documents"], page["metadatas"])
+        chroma_manifest, numpy_manifest = (os.path.join(d, "ingest_manifest.json") for d in (PERSIST_DIR, NUMPY_DIR))
+        if os.path.exists(chroma_manifest) and not os.path.exists(numpy_manifest):
+            shutil.copy(chroma_manifest, numpy_manifest)  # same chunk ids, so VECTOR_BACKEND=numpy ingest stays incremental
+    questions = [item["q"] for item in EVAL_QUESTIONS]
+    vectors = chroma.embeddings.embed_documents(questions)
+
+    report = {"k": k, "n_questions": len(questions), "numpy_dtype": NUMPY_DTYPE, "numpy_open_ms": round(ot.elapsed_ms, 2)}
+    hits = {}
+    for name, db in [("chroma", chroma), ("numpy", npdb)]:
+        times = []
+        for v in vectors:
+            with Timer() as t:
+                res = db.search_by_vectors([v], k)[0]
+            times.append(t.elapsed_ms)
+            hits.setdefault(name, []).append([d.metadata.get("chunk_id") for d, _ in res])
+        with Timer() as bt:
+            batched = db.search_by_vectors(vectors, k)
+        ranks = [_first_hit_rank([d for d, _ in r], item["keywords"]) for r, item in zip(batched, EVAL_QUESTIONS)]
+        report[name] = {"p50_ms": round(percentile(times, 50), 2), "p99_ms": round(percentile(times, 99), 2),
+                        "batch_all_ms": round(bt.elapsed_ms, 2), "keyword_recall": round(sum(r is not None for r in ranks) / len(ranks), 3)}
+    # Overlap with Chroma's (approximate, HNSW) top-k; NumPy search is exact
+    report["numpy"]["overlap_with_chroma"] = round(
+        sum(len(set(a) & set(b)) for a, b in zip(hits["chroma"], hits["numpy"])) / (k * len(questions)), 3)
+    report["numpy"]["disk_mb"] = round(sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(os.path.join(NUMPY_DIR, "vectors")) for f in fs) / 1e6, 1)
+    if not CHROMA_HOST:
+        report["chroma"]["disk_mb"] = round(sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(PERSIST_DIR) for f in fs) / 1e6, 1)
+
+    for name in ("chroma", "numpy"):
+        print(f"  {name:7s} {report[name]}")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {out}")
+    return report
+
+def bench_warm(n: int = 20):
+    """p50/p99 of the /rag/query path (answer cache off) with per-request construction vs warm shared resources."""
+    questions = [EVAL_QUESTIONS[i % len(EVAL_QUESTIONS)]["q"] for i in range(n)]
+    report = {}
+    for label, cold in [("before (per-request construction)", True), ("after (warm resources)", False)]:
+        if not cold: warm_up()
+        times = []
+        for q in questions:
+            if cold: _resources.reset()
+            times.append(query(q, verbose=False, use_cache=False)["latency_ms"])
+        report[label] = {"p50_ms": percentile(times, 50), "p99_ms": percentile(times, 99)}
+        print(f"  {label:36s} p50 {report[label]['p50_ms']:7.0f} ms   p99 {report[label]['p99_ms']:7.0f} ms")
+    return report
+
 # CLI, Multi-modes
 if __name__ == "__main__":
     cmd = sys.argv[1].lower() if len(sys.argv) > 1 else ""
     if cmd == "ingest":     ingest()
     elif cmd == "query":    query(" ".join(sys.argv[2:]) or input("Question: "))
-    elif cmd == "evaluate": evaluate()
-    else: print("Usage: python rag.py [ingest|query|evaluate]")
\ No newline at end of file
+    elif cmd == "evaluate": evaluate(sys.argv[2] if len(sys.argv) > 2 else None, int(sys.argv[3]) if len(sys.argv) > 3 else 10)
+    elif cmd == "bench":    bench(sys.argv[2].split(",") if len(sys.argv) > 2 else None)
+    elif cmd == "compare-backends": compare_backends()
+    elif cmd == "bench-warm": bench_warm(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+    elif cmd == "batch":    batch_file(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    else: print("Usage: python rag.py [ingest|query|evaluate [vector|lexical|hybrid] [k]|bench [mode,...]|bench-warm [n]|compare-backends|batch <in.jsonl> [out.jsonl]]")
\ No newline at end of file
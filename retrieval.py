@@ -0,0 +1,137 @@
+import os, re, json, sqlite3, threading
+from langchain_core.documents import Document
+
+# ── Lexical (BM25) index ────────────────────────────────────────────────────
+# Dense MiniLM retrieval is weakest on exact names ("Shadowfax", "Ash nazg"); an inverted index catches those.
+
+_STOPWORDS = set("""a an and are as at be by did do does for from had has have he her his how i in is it its of on or
+s she that the their them they this to was were what when where which who whom why with you your""".split())
+
+def _terms(text: str) -> list[str]:
+    return list(dict.fromkeys(t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in _STOPWORDS))
+
+def _rowid(chunk_id: str) -> int:
+    return int(chunk_id[:15], 16)  # 60 bits of the content hash, so deletes hit the FTS rowid directly
+
+class LexicalIndex:
+    """BM25 inverted index over chunks in SQLite FTS5, kept in step with the vector store by ingest."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+                           "chunk_id UNINDEXED, content, metadata UNINDEXED, tokenize='porter unicode61')")
+
+    def upsert(self, ids: list[str], texts: list[str], metadatas: list[dict]):
+        with self._lock:
+            self._delete(ids)
+            self._conn.executemany("INSERT INTO chunks (rowid, chunk_id, content, metadata) VALUES (?, ?, ?, ?)",
+                                   [(_rowid(i), i, t, json.dumps(m)) for i, t, m in zip(ids, texts, metadatas)])
+            self._conn.commit()
+
+    def delete(self, ids: list[str]):
+        with self._lock:
+            self._delete(ids)
+            self._conn.commit()
+
+    def _delete(self, ids: list[str]):
+        self._conn.executemany("DELETE FROM chunks WHERE rowid = ?", [(_rowid(i),) for i in ids])
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def search(self, question: str, k: int) -> list[tuple[str, str, dict, float]]:
+        """Top-k (chunk_id, text, metadata, bm25 score) for any of the question's terms; higher score is better."""
+        terms = _terms(question)
+        if not terms: return []
+        match = " OR ".join(f'"{t}"' for t in terms)
+        with self._lock:
+            rows = self._conn.execute("SELECT chunk_id, content, metadata, bm25(chunks) FROM chunks "
+                                      "WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?", (match, k)).fetchall()
+        # FTS5's bm25() is negated so that ascending order is best-first
+        return [(cid, text, json.loads(meta), -score) for cid, text, meta, score in rows]
+
+# ── Fusion ──────────────────────────────────────────────────────────────────
+
+def rrf_fuse(rankings: list[list[str]], k: int = 60) -> list[tuple[str, float]]:
+    """Reciprocal rank fusion: score(id) = sum over rankings of 1 / (k + rank)."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+
+# ── Context packing ─────────────────────────────────────────────────────────
+# Adjacent hits from the same page repeat up to chunk_overlap characters, and the War and Peace editions repeat
+# whole passages; merge/drop those, then fill a token budget in rank order.
+
+def _merge_text(a: str, b: str, max_overlap: int = 400):
+    """a + b without the text they share (b continues a), or None if they don't overlap."""
+    if b in a: return a
+    for n in range(min(len(a), len(b), max_overlap), 20, -1):
+        if a.endswith(b[:n]): return a + b[n:]
+    return None
+
+def _shingles(text: str, n: int = 5) -> set:
+    words = re.findall(r"\w+", text.lower())
+    return {" ".join(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+
+def _merge_hits(hits: list[tuple]) -> list[tuple]:
+    """hits: (rank, Document, score) for one source page. Returns merged (rank, Document, score) spans."""
+    if all("start_index" in d.metadata for _, d, _ in hits):
+        spans = sorted(hits, key=lambda h: h[1].metadata["start_index"])
+        merged = [list(spans[0])]
+        for rank, d, score in spans[1:]:
+            cur = merged[-1][1]
+            end = cur.metadata["start_index"] + len(cur.page_content)
+            if d.metadata["start_index"] <= end:
+                text = cur.page_content + d.page_content[end - d.metadata["start_index"]:]
+                best = min(merged[-1][0], rank)
+                merged[-1] = [best, Document(page_content=text, metadata=cur.metadata),
+                              merged[-1][2] if merged[-1][0] <= rank else score]
+            else:
+                merged.append([rank, d, score])
+        return [tuple(m) for m in merged]
+    # Chunks ingested before start_index was stored: detect the shared overlap textually
+    merged = []
+    for rank, d, score in sorted(hits, key=lambda h: h[0]):
+        for m in merged:
+            text = _merge_text(m[1].page_content, d.page_content) or _merge_text(d.page_content, m[1].page_content)
+            if text is not None:
+                m[1] = Document(page_content=text, metadata=m[1].metadata)
+                break
+        else:
+            merged.append([rank, d, score])
+    return [tuple(m) for m in merged]
+
+def pack_context(results: list[tuple], budget_tokens: int, count_tokens, dedupe_threshold: float = 0.8) -> list[tuple]:
+    """Merge overlapping same-page hits, drop near-duplicates (>= threshold of a block's word 5-gram shingles already
+    present in a kept block, e.g. the same passage from another edition),
+    then keep blocks in rank order while they fit the token budget. Returns [(Document, score)] in rank order."""
+    pages = {}
+    for rank, (d, score) in enumerate(results):
+        key = (d.metadata.get("source_name", d.metadata.get("source")), d.metadata.get("page"))
+        pages.setdefault(key, []).append((rank, d, score))
+    blocks = sorted((b for hits in pages.values() for b in _merge_hits(hits)), key=lambda b: b[0])
+
+    packed, kept_shingles, used = [], [], 0
+    for _, d, score in blocks:
+        sh = _shingles(d.page_content)
+        if any(len(sh & k) / len(sh) >= dedupe_threshold for k in kept_shingles):
+            continue
+        tokens = count_tokens(d.page_content) + 16  # + the "[n] — source, p.X" label
+        if used + tokens > budget_tokens:
+            if packed: continue  # a smaller, lower-ranked block may still fit
+            # The best hit alone exceeds the budget: keep a truncated prefix rather than nothing
+            keep = int(len(d.page_content) * (budget_tokens - 16) / tokens)
+            d, tokens = Document(page_content=d.page_content[:max(keep, 0)], metadata=d.metadata), budget_tokens
+        packed.append((d, score)); kept_shingles.append(sh); used += tokens
+    return packed
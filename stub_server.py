@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import os, re, json, time, random, asyncio, hashlib, argparse, threading
+from datetime import date, timedelta
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from config import MODEL_NAME, count_tokens
+from metrics import counter, render_prometheus
+
+# ── Offline OpenAI-compatible stub ──────────────────────────────────────────
+# Point OPENAI_BASE_URL at http://localhost:8100/v1 and chat.py, rag.py, agent.py, healer.py and api.py run without
+# network access or spend. Replies are synthetic (deterministic per request), recorded from a real upstream, or
+# replayed from a recording; either way they are served with a configurable latency model:
+#   time to first token = STUB_LATENCY_MS + jitter + prompt tokens / STUB_PREFILL_TOKENS_PER_S
+#   then one streamed chunk per word at STUB_TOKENS_PER_S.
+
+STUB_MODE = os.getenv("STUB_MODE", "synthetic")  # synthetic | record | replay
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "300"))
+STUB_JITTER_MS = float(os.getenv("STUB_JITTER_MS", "0"))  # uniform 0..jitter added to each request
+STUB_TOKENS_PER_S = float(os.getenv("STUB_TOKENS_PER_S", "60"))  # completion decode rate, 0 = instant
+STUB_PREFILL_TOKENS_PER_S = float(os.getenv("STUB_PREFILL_TOKENS_PER_S", "0"))  # prompt processing rate, 0 = free
+STUB_COMPLETION_WORDS = int(os.getenv("STUB_COMPLETION_WORDS", "60"))  # length of synthetic text replies
+STUB_CASSETTE = os.getenv("STUB_CASSETTE", os.path.join(os.path.dirname(__file__), "stub_cassette.jsonl"))
+STUB_UPSTREAM_URL = os.getenv("STUB_UPSTREAM_URL", "https://api.openai.com/v1")
+STUB_UPSTREAM_KEY = os.getenv("STUB_UPSTREAM_KEY", os.getenv("OPENAI_API_KEY", ""))
+STUB_STRICT = os.getenv("STUB_STRICT", "0") == "1"  # replay miss -> 404 instead of a synthetic reply
+STUB_MODES = ("synthetic", "record", "replay")
+
+# Request fields that decide the reply; stream/stream_options/user don't, so a streamed call replays a recorded one
+KEY_FIELDS = ("model", "messages", "tools", "tool_choice", "temperature", "response_format")
+
+WORDS = ("the", "ring", "road", "journey", "north", "river", "light", "plan", "time", "city", "small", "quiet",
+         "morning", "across", "before", "under", "stone", "green", "long", "walk", "through", "with", "and", "of")
+
+def _requests(source: str):
+    return counter("stub_requests_total", "Stub completions served by source", source=source)
+
+# ── Record / replay ─────────────────────────────────────────────────────────
+
+def _request_key(body: dict) -> str:
+    return hashlib.sha1(json.dumps({k: body.get(k) for k in KEY_FIELDS}, sort_keys=True).encode()).hexdigest()
+
+class Cassette:
+    """Completions keyed by request hash, one JSON line each; the last recording of a key wins."""
+
+    def __init__(self, path: str = STUB_CASSETTE):
+        self.path, self._lock, self.entries = path, threading.Lock(), {}
+        if os.path.exists(path):
+            for line in open(path):
+                if line.strip():
+                    e = json.loads(line)
+                    self.entries[e["key"]] = e["response"]
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def put(self, key: str, request: dict, response: dict):
+        with self._lock:
+            self.entries[key] = response
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"key": key, "request": request, "response": response}) + "\n")
+
+_cassette = None
+
+def _get_cassette() -> Cassette:
+    global _cassette
+    if _cassette is None: _cassette = Cassette(STUB_CASSETTE)
+    return _cassette
+
+async def _upstream(body: dict) -> dict:
+    """Non-streamed completion from the real provider; streaming to our client is re-synthesised from it."""
+    from openai import AsyncOpenAI
+    client = AsyncOpenAI(base_url=STUB_UPSTREAM_URL, api_key=STUB_UPSTREAM_KEY)
+    args = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+    return (await client.chat.completions.create(**args)).model_dump(exclude_none=True)
+
+# ── Synthetic replies ───────────────────────────────────────────────────────
+
+def _schema_value(name: str, spec: dict):
+    t = spec.get("type", "string")
+    if t == "integer": return 1
+    if t == "number": return 100
+    if t == "boolean": return True
+    if "YYYY-MM-DD" in spec.get("description", "") or name in ("date", "checkin", "checkout"):
+        return (date.today() + timedelta(days=30)).isoformat()
+    return "Auckland" if name in ("city", "destination") else "Wellington" if name == "origin" else "stub"
+
+def _tool_calls(tools: list[dict], seed: str) -> list[dict]:
+    """One call per offered tool, with its required arguments filled in from the JSON schema."""
+    calls = []
+    for i, tool in enumerate(tools):
+        fn = tool["function"]
+        props = fn.get("parameters", {}).get("properties", {})
+        args = {p: _schema_value(p, props.get(p, {})) for p in fn.get("parameters", {}).get("required", [])}
+        calls.append({"id": f"call_{seed[:8]}_{i}", "type": "function",
+                      "function": {"name": fn["name"], "arguments": json.dumps(args)}})
+    return calls
+
+def _code_reply(system: str) -> str:
+    """Code blocks that pass healer's test runners, so healing runs end-to-end offline."""
+    if "rust" in system.lower():
+        return ("```rust\nfn add(a: i32, b: i32) -> i32 { a + b }\n\nfn main() { println!(\"{}\", add(1, 2)); }\n\n"
+                "#[cfg(test)]\nmod tests {\n    use super::*;\n    #[test] fn adds() { assert_eq!(add(1, 2), 3); }\n"
+                "    #[test] fn zero() { assert_eq!(add(0, 0), 0); }\n    #[test] fn negative() { assert_eq!(add(-1, 1), 0); }\n}\n```")
+    return ("```python\ndef add(a, b):\n    return a + b\n```\n\n```python\nfrom solution import add\n\n"
+            "def test_add():\n    assert add(1, 2) == 3\n\ndef test_zero():\n    assert add(0, 0) == 0\n\n"
+            "def test_negative():\n    assert add(-1, 1) == 0\n```")
+
+def _synthetic(body: dict, key: str) -> dict:
+    """Deterministic for a given request: tool calls on an agent's first turn, a JSON answer once tool results are
+    in, code blocks when the system prompt asks for them, otherwise seeded filler text."""
+    messages = body.get("messages", [])
+    system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    message, finish = {"role": "assistant", "content": None}, "stop"
+    if body.get("tools") and body.get("tool_choice") != "none" and not any(m.get("role") == "tool" for m in messages):
+        message["tool_calls"], finish = _tool_calls(body["tools"], key), "tool_calls"
+    elif body.get("tools"):
+        message["content"] = json.dumps({"destination": "Auckland", "summary": "stub itinerary",
+                                         "tool_results": sum(m.get("role") == "tool" for m in messages)})
+    elif "code block" in system.lower():
+        message["content"] = _code_reply(system)
+    else:
+        rng = random.Random(key)
+        message["content"] = " ".join(rng.choice(WORDS) for _ in range(STUB_COMPLETION_WORDS)).capitalize() + "."
+    return {"id": f"chatcmpl-stub-{key[:12]}", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", MODEL_NAME), "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+            "usage": _usage(messages, message)}
+
+def _usage(messages: list[dict], message: dict) -> dict:
+    prompt = sum(count_tokens(m.get("content") or "") + 4 for m in messages)
+    calls = message.get("tool_calls")
+    completion = count_tokens((message.get("content") or "") + (json.dumps(calls) if calls else ""))
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+# ── Serving with the latency model ──────────────────────────────────────────
+
+def _ttft_s(usage: dict) -> float:
+    prefill = usage.get("prompt_tokens", 0) / STUB_PREFILL_TOKENS_PER_S if STUB_PREFILL_TOKENS_PER_S else 0.0
+    return (STUB_LATENCY_MS + random.uniform(0, STUB_JITTER_MS)) / 1000 + prefill
+
+def _per_token_s() -> float:
+    return 1 / STUB_TOKENS_PER_S if STUB_TOKENS_PER_S else 0.0
+
+def _chunk(completion: dict, delta: dict = None, finish=None, usage: dict = None) -> str:
+    chunk = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+             "model": completion["model"],
+             "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish}]}
+    if usage: chunk["usage"] = usage
+    return f"data: {json.dumps(chunk)}\n\n"
+
+async def _stream(completion: dict, include_usage: bool, delay: bool):
+    choice = completion["choices"][0]
+    message, usage = choice["message"], completion.get("usage", {})
+    if delay: await asyncio.sleep(_ttft_s(usage))
+    yield _chunk(completion, {"role": "assistant", "content": ""})
+    for piece in re.findall(r"\s*\S+", message.get("content") or ""):
+        if delay: await asyncio.sleep(_per_token_s() * max(1, count_tokens(piece)))
+        yield _chunk(completion, {"content": piece})
+    for i, tc in enumerate(message.get("tool_calls") or []):
+        if delay: await asyncio.sleep(_per_token_s() * count_tokens(tc["function"]["arguments"]))
+        yield _chunk(completion, {"tool_calls": [{"index": i, **tc}]})
+    yield _chunk(completion, {}, choice.get("finish_reason", "stop"))
+    if include_usage: yield _chunk(completion, usage=usage)
+    yield "data: [DONE]\n\n"
+
+app = FastAPI(title="OpenAI stub")
+
+@app.post("/v1/chat/completions")
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    key = _request_key(body)
+    delay = True
+    if STUB_MODE == "replay":
+        completion = _get_cassette().get(key)
+        if completion is None:
+            _requests("replay_miss").inc()
+            if STUB_STRICT: raise HTTPException(status_code=404, detail=f"no recording for request {key}")
+            completion = _synthetic(body, key)
+        else:
+            _requests("replay").inc()
+    elif STUB_MODE == "record":
+        completion, delay = await _upstream(body), False  # the upstream call already took real time
+        _get_cassette().put(key, {k: body.get(k) for k in KEY_FIELDS if k in body}, completion)
+        _requests("recorded").inc()
+    else:
+        completion = _synthetic(body, key)
+        _requests("synthetic").inc()
+    if body.get("stream"):
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return StreamingResponse(_stream(completion, include_usage, delay), media_type="text/event-stream")
+    if delay:
+        tokens = completion.get("usage", {}).get("completion_tokens", 0)
+        await asyncio.sleep(_ttft_s(completion.get("usage", {})) + tokens * _per_token_s())
+    return completion
+
+@app.get("/v1/models")
+def models():
+    return {"object": "list", "data": [{"id": MODEL_NAME, "object": "model", "owned_by": "stub"}]}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Offline OpenAI-compatible stub server")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--mode", choices=STUB_MODES, default=STUB_MODE)
+    parser.add_argument("--latency-ms", type=float, default=STUB_LATENCY_MS, help="base time to first token")
+    parser.add_argument("--jitter-ms", type=float, default=STUB_JITTER_MS)
+    parser.add_argument("--tokens-per-s", type=float, default=STUB_TOKENS_PER_S, help="completion rate, 0 = instant")
+    parser.add_argument("--prefill-tokens-per-s", type=float, default=STUB_PREFILL_TOKENS_PER_S)
+    parser.add_argument("--cassette", default=STUB_CASSETTE, help="JSONL recording for record/replay")
+    parser.add_argument("--strict", action="store_true", default=STUB_STRICT, help="404 on a replay miss")
+    args = parser.parse_args()
+    STUB_MODE, STUB_LATENCY_MS, STUB_JITTER_MS = args.mode, args.latency_ms, args.jitter_ms
+    STUB_TOKENS_PER_S, STUB_PREFILL_TOKENS_PER_S = args.tokens_per_s, args.prefill_tokens_per_s
+    STUB_CASSETTE, STUB_STRICT = args.cassette, args.strict
+    print(f"Stub on http://0.0.0.0:{args.port}/v1 — mode={STUB_MODE} latency={STUB_LATENCY_MS:g} ms "
+          f"rate={STUB_TOKENS_PER_S:g} tok/s")
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -1,6 +1,7 @@
 import os, sys, time, pytest
 from collections import deque
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+os.environ.setdefault("METRICS_STORE", "0")  # keep test runs out of the dashboard's metrics store
 
 #  Config tests 
 class TestConfig:
@@ -19,6 +20,12 @@ class TestConfig:
         with Timer() as t: time.sleep(0.01)
         assert t.elapsed_ms >= 10
 
+    def test_percentile(self):
+        from config import percentile
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50 and percentile(values, 99) == 99 and percentile(values, 100) == 100
+        assert percentile([7], 99) == 7 and percentile([], 50) == 0.0
+
 #  Chat tests 
 class TestChat:
     def test_deque_bounded(self):
@@ -26,6 +33,53 @@ class TestChat:
         for i in range(20): h.append(f"msg{i}")
         assert len(h) == 10 and h[0] == "msg10"
 
+    def test_history_by_token_budget(self, tmp_path):
+        import chat
+        conn = chat._init_db(str(tmp_path / "c.db"))
+        chat._add_messages(conn, [("user", "a", 5), ("assistant", "b", 50), ("user", "c", 20), ("assistant", "d", 30)])
+        assert chat._get_history(conn, 10, 60) == [("user", "c", 20), ("assistant", "d", 30)]
+        assert chat._get_history(conn, 1, 1000) == [("assistant", "d", 30)]
+        assert chat._get_history(conn, 10, 10) == [("assistant", "d", 30)]  # the newest always goes, even over budget
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        w = chat._Window(10, 60, chat._get_history(conn, 10, 1000))
+        assert len(w) == 2 and w.tokens == 50
+        w.append("user", "e", 15)
+        assert w.messages() == [{"role": "assistant", "content": "d"}, {"role": "user", "content": "e"}] and w.tokens == 45
+
+    def test_failed_turn_leaves_no_orphan(self, tmp_path, monkeypatch):
+        from types import SimpleNamespace
+        import chat
+        monkeypatch.setattr(chat, "DB_PATH", str(tmp_path / "c.db"))
+        conn = chat._init_db()
+        chat._add_messages(conn, [("user", "a", 30), ("assistant", "b", 30)])
+        sent = []
+        def create(messages, **kw):
+            sent.append([m["content"] for m in messages[1:]])
+            if len(sent) == 1: raise RuntimeError("api down")
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="ok"))])])
+        monkeypatch.setattr(chat, "get_openai_client", lambda: SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+        monkeypatch.setattr(chat, "count_tokens", lambda text: 30)
+        inputs = iter(["q", "q", "quit"])
+        monkeypatch.setattr("builtins.input", lambda prompt: next(inputs))
+        chat.chat_loop(max_history=10, max_history_tokens=60)
+        assert sent == [["b", "q"], ["b", "q"]]  # the failed question is not sent twice with the retry
+        assert chat._get_history(conn, 10, 1000) == [("user", "a", 30), ("assistant", "b", 30), ("user", "q", 30), ("assistant", "ok", 30)]
+        w = chat._Window(2, 1000, [("user", "a", 1), ("assistant", "b", 2)])
+        w.undo(w.append("user", "c", 4))
+        assert w.messages() == [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}] and w.tokens == 3
+
+    def test_migration_backfills_token_count(self, tmp_path):
+        import sqlite3
+        import chat
+        from config import count_tokens
+        old = sqlite3.connect(str(tmp_path / "old.db"))
+        old.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, role TEXT, content TEXT)")
+        old.executemany("INSERT INTO messages (role, content) VALUES (?, ?)", [("user", "hello there"), ("assistant", "hi")])
+        old.commit(); old.close()
+        conn = chat._init_db(str(tmp_path / "old.db"))
+        assert chat._get_history(conn, 10, 1000) == [("user", "hello there", count_tokens("hello there")),
+                                                     ("assistant", "hi", count_tokens("hi"))]
+
 #  RAG tests
 class TestRAG:
     def test_min_20_questions(self):
@@ -37,6 +91,338 @@ class TestRAG:
         for q in EVAL_QUESTIONS:
             assert "q" in q and "keywords" in q and len(q["keywords"]) > 0
 
+    def test_chunk_id_content_addressed(self):
+        from rag import _chunk_id
+        assert _chunk_id("a.pdf", 3, "text") == _chunk_id("a.pdf", 3, "text")
+        assert _chunk_id("a.pdf", 3, "text") != _chunk_id("a.pdf", 3, "text!")
+        assert _chunk_id("a.pdf", 3, "text") != _chunk_id("b.pdf", 3, "text")
+
+    def test_plan_ingest(self):
+        from rag import _plan_ingest
+        known = {"same.pdf": {"sha256": "1"}, "edited.pdf": {"sha256": "2"}, "gone.pdf": {"sha256": "3"}}
+        changed, removed = _plan_ingest(known, {"same.pdf": "1", "edited.pdf": "x", "new.txt": "4"})
+        assert sorted(changed) == ["edited.pdf", "new.txt"]
+        assert removed == ["gone.pdf"]
+
+    def test_parse_tasks_and_shard(self, tmp_path):
+        from pypdf import PdfWriter
+        from rag import _parse_tasks, _parse_shard, _chunk_id, PAGES_PER_TASK
+        for name, pages in (("big.pdf", PAGES_PER_TASK * 2 + 3), ("empty.pdf", 0)):
+            w = PdfWriter()
+            for _ in range(pages): w.add_blank_page(100, 100)
+            with open(tmp_path / name, "wb") as f: w.write(f)
+        big = str(tmp_path / "big.pdf")
+        assert _parse_tasks(big) == [(big, 0, 50), (big, 50, 100), (big, 100, 103)]
+        assert _parse_tasks(str(tmp_path / "empty.pdf")) == []
+        (tmp_path / "notes.txt").write_text("The Shire is green.")
+        fname, n_pages, chunks = _parse_shard(*_parse_tasks(str(tmp_path / "notes.txt")))
+        assert (fname, n_pages, len(chunks)) == ("notes.txt", 1, 1)
+        assert chunks[0][0] == _chunk_id("notes.txt", "", "The Shire is green.") and chunks[0][2]["chunk_id"] == chunks[0][0]
+        assert _parse_shard((big, 0, 2))[:2] == ("big.pdf", 2)
+
+    def test_stage_error_drains_and_signals_done(self):
+        import queue
+        from rag import _stage, _DONE
+        inbox, outbox, errors = queue.Queue(), queue.Queue(), []
+        for item in (1, 2, 3, _DONE): inbox.put(item)
+        _stage(lambda x: 10 // (x - 2), inbox, outbox, errors)
+        assert [outbox.get_nowait() for _ in range(2)] == [-10, _DONE] and outbox.empty()
+        assert len(errors) == 1 and isinstance(errors[0], ZeroDivisionError) and inbox.empty()
+
+    def test_ingest_deletes_stale_chunks_and_records_empty_files(self, tmp_path, monkeypatch):
+        import json
+        from types import SimpleNamespace
+        from pypdf import PdfWriter
+        import rag
+        data, store = tmp_path / "data", {}
+        data.mkdir()
+        db = SimpleNamespace(count=lambda: len(store), delete=lambda ids: [store.pop(i, None) for i in ids],
+                             upsert=lambda ids, vecs, texts, metas: store.update(zip(ids, texts)))
+        monkeypatch.setattr(rag, "DATA_DIR", str(data))
+        monkeypatch.setattr(rag, "MANIFEST_PATH", str(tmp_path / "manifest.json"))
+        monkeypatch.setattr(rag, "LEXICAL_PATH", str(tmp_path / "lex.db"))
+        monkeypatch.setattr(rag, "_download_sources", lambda: None)
+        monkeypatch.setattr(rag, "_vectorstore", lambda: db)
+        monkeypatch.setattr(rag, "_embeddings", lambda: SimpleNamespace(cache=None, embed_documents=lambda t: [[0.0]] * len(t)))
+        with open(data / "empty.pdf", "wb") as f: PdfWriter().write(f)
+        (data / "a.txt").write_text("Frodo left the Shire.")
+        rag.ingest(workers=1)
+        files = json.load(open(tmp_path / "manifest.json"))["files"]
+        assert files["empty.pdf"]["chunks"] == [] and list(store.values()) == ["Frodo left the Shire."]
+        assert rag.ingest(workers=1)["files"] == 0  # nothing re-planned
+        (data / "a.txt").write_text("Sam followed him.")
+        assert rag.ingest(workers=1)["deleted"] == 1 and list(store.values()) == ["Sam followed him."]
+        (data / "a.txt").write_text("")
+        rag.ingest(workers=1)
+        assert store == {} and json.load(open(tmp_path / "manifest.json"))["files"]["a.txt"]["chunks"] == []
+
+    def test_rrf_fuse(self):
+        from retrieval import rrf_fuse
+        fused = rrf_fuse([["a", "b", "c"], ["c", "a", "d"]])
+        assert [i for i, _ in fused][:2] == ["a", "c"]  # found high by both retrievers
+        assert {i for i, _ in fused} == {"a", "b", "c", "d"}
+
+    def test_lexical_index(self, tmp_path):
+        from retrieval import LexicalIndex
+        idx = LexicalIndex(str(tmp_path / "lex.db"))
+        ids = ["a" * 16, "b" * 16, "c" * 16]
+        idx.upsert(ids, ["Gandalf rode Shadowfax", "Frodo drew Sting", "the hobbits walked"], [{"page": i} for i in range(3)])
+        hits = idx.search("What is the name of Gandalf's horse Shadowfax?", 5)
+        assert hits[0][0] == ids[0] and hits[0][2] == {"page": 0}
+        idx.upsert([ids[0]], ["Gandalf rode a horse"], [{"page": 9}])  # replaces, no duplicate
+        idx.delete([ids[1]])
+        assert idx.count() == 2 and idx.search("Sting", 5) == [] and idx.search("Shadowfax", 5) == []
+
+    def test_first_hit_rank(self):
+        from langchain_core.documents import Document
+        from rag import _first_hit_rank
+        docs = [Document(page_content=t) for t in ("The Shire", "Gandalf on Shadowfax", "Sting glows")]
+        assert _first_hit_rank(docs, ["shadowfax", "sting"]) == 2
+        assert _first_hit_rank(docs, ["balrog"]) is None
+
+    @pytest.mark.parametrize("dtype", ["float16", "int8"])
+    def test_numpy_store_search_delete_reopen(self, tmp_path, dtype):
+        import numpy as np
+        from vecstore import NumpyVectorStore
+        rng = np.random.default_rng(0)
+        vecs = rng.standard_normal((2000, 32)).astype(np.float32)
+        ids = [f"c{i}" for i in range(2000)]
+        store = NumpyVectorStore(str(tmp_path / "v"), None, dtype=dtype)
+        store.upsert(ids, vecs, [f"doc {i}" for i in range(2000)], [{"i": i} for i in range(2000)])
+        results = store.search_by_vectors(vecs[:3], 2)  # three queries, one search
+        assert [r[0][0].metadata["i"] for r in results] == [0, 1, 2]
+        assert results[0][0][1] < 0.01 and results[0][0][1] <= results[0][1][1]
+        store.delete(["c0"])
+        assert store.count() == 1999 and store.search_by_vectors(vecs[:1], 1)[0][0][0].metadata["i"] != 0
+        reopened = NumpyVectorStore(str(tmp_path / "v"), None)
+        assert reopened.count() == 1999 and reopened.search_by_vectors(vecs[1:2], 1)[0][0][0].page_content == "doc 1"
+
+    def test_pack_context_merges_dedupes_and_budgets(self):
+        from langchain_core.documents import Document
+        from retrieval import pack_context
+        words = lambda t: len(t.split())
+        page = " ".join(f"w{i}" for i in range(400))
+        a = Document(page_content=page[:1200], metadata={"source_name": "A", "page": 1, "start_index": 0})
+        b = Document(page_content=page[900:], metadata={"source_name": "A", "page": 1, "start_index": 900})
+        edition = Document(page_content=page[:1200], metadata={"source_name": "A 1900", "page": 7})
+        other = Document(page_content="Gandalf rides Shadowfax " * 20, metadata={"source_name": "B", "page": 2})
+        packed = pack_context([(a, 0.1), (edition, 0.2), (b, 0.3), (other, 0.4)], 10_000, words)
+        assert len(packed) == 2  # a+b merged into one span, the other edition dropped
+        assert packed[0][0].page_content == page and packed[1][0].metadata["source_name"] == "B"
+        tight = pack_context([(a, 0.1), (other, 0.4)], 100, words)
+        assert len(tight) == 1 and words(tight[0][0].page_content) <= 100  # best hit truncated to the budget
+
+    def test_pack_context_merges_overlap_without_offsets(self):
+        from langchain_core.documents import Document
+        from retrieval import pack_context
+        text = "".join(f"sentence {i}. " for i in range(200))
+        first = Document(page_content=text[:1500], metadata={"source_name": "A", "page": 3})
+        second = Document(page_content=text[1200:2700], metadata={"source_name": "A", "page": 3})
+        packed = pack_context([(second, 0.1), (first, 0.2)], 10_000, lambda t: len(t.split()))
+        assert len(packed) == 1 and text[:2700] in packed[0][0].page_content
+
+    def test_batch_ordered_deduped_and_isolates_errors(self, monkeypatch):
+        import rag
+        from langchain_core.documents import Document
+        calls = []
+        class FakeLLM:
+            def invoke(self, messages):
+                question = messages[-1]["content"].rsplit("Question: ", 1)[1]
+                calls.append(question)
+                if "boom" in question: raise RuntimeError("llm down")
+                return type("Resp", (), {"content": f"answer to {question}"})()
+        monkeypatch.setattr(rag, "_collection_version", lambda: 1)
+        monkeypatch.setattr(rag, "_retrieve_many", lambda qs, k, mode=None: [[(Document(page_content=f"ctx {q}"), 0.1)] for q in qs])
+        monkeypatch.setattr(rag._resources, "llm", lambda: FakeLLM())
+        items = ["q one", {"id": "x", "question": "boom"}, "q two", "q one"]
+        rows = list(rag.batch(items, concurrency=3, use_cache=False))
+        summary = rows.pop()["summary"]
+        assert [r["index"] for r in rows] == [0, 1, 2, 3] and rows[1]["id"] == "x"
+        assert rows[0]["answer"] == "answer to q one" and "llm down" in rows[1]["error"]
+        assert rows[3]["cached"] and rows[3]["answer"] == rows[0]["answer"] and calls.count("q one") == 1
+        assert summary["n"] == 4 and summary["errors"] == 1 and summary["cached"] == 1
+
+    def test_stream_counts_prompt_tokens_once(self, monkeypatch):
+        import rag
+        from langchain_core.documents import Document
+        counted = []
+        class FakeLLM:
+            def stream(self, messages):
+                return iter([type("Chunk", (), {"content": "hi"})()])
+        monkeypatch.setattr(rag, "_collection_version", lambda: 1)
+        monkeypatch.setattr(rag, "_retrieve_many", lambda qs, k, mode=None, vectors=None: [[(Document(page_content="ctx"), 0.1)]])
+        monkeypatch.setattr(rag._resources, "llm", lambda: FakeLLM())
+        monkeypatch.setattr(rag, "_prompt_tokens", lambda messages: counted.append(1) or 42)
+        events = dict(rag.query_stream("q", use_cache=False))
+        assert events["done"]["prompt_tokens"] == 42 and events["token"] == "hi" and len(counted) == 1
+
+    def test_async_answers_tokenize_and_cache_off_the_loop(self, monkeypatch):
+        import asyncio, threading
+        import rag
+        from langchain_core.documents import Document
+        threads = []
+        class FakeLLM:
+            async def ainvoke(self, messages): return type("Resp", (), {"content": "a"})()
+            async def astream(self, messages): yield type("Chunk", (), {"content": "a"})()
+        class Cache:
+            def get(self, key): return None
+            def put(self, key, value): threads.append(("put", threading.get_ident()))
+        monkeypatch.setattr(rag, "_collection_version", lambda: 1)
+        monkeypatch.setattr(rag, "_get_answer_cache", lambda: Cache())
+        monkeypatch.setattr(rag, "_retrieve_many", lambda qs, k, mode=None, vectors=None: [[(Document(page_content="ctx"), 0.1)]])
+        monkeypatch.setattr(rag._resources, "llm", lambda: FakeLLM())
+        monkeypatch.setattr(rag, "_prompt_tokens", lambda messages: threads.append(("tokens", threading.get_ident())) or 7)
+        async def run():
+            loop_thread = threading.get_ident()
+            result = await rag.aquery("q")
+            events = [e async for e in rag.aquery_stream("q")]
+            return loop_thread, result, dict(events)
+        loop_thread, result, events = asyncio.run(run())
+        assert result["prompt_tokens"] == 7 and events["done"]["prompt_tokens"] == 7
+        assert [kind for kind, _ in threads] == ["tokens", "put"] * 2 and all(t != loop_thread for _, t in threads)
+
+#  Cache tests
+class TestCache:
+    def test_embedding_cache_roundtrip(self, tmp_path):
+        from cache import EmbeddingCache
+        c = EmbeddingCache(str(tmp_path / "e.db"), "m1")
+        assert c.get_many(["a", "b"]) == [None, None]
+        c.put_many(["a"], [[0.5, 1.0]])
+        assert c.get_many(["a", "b"]) == [[0.5, 1.0], None]
+        assert c.stats()["hits"] == 1 and c.stats()["misses"] == 3
+        # Same text under another model id is a different entry
+        assert EmbeddingCache(str(tmp_path / "e.db"), "m2").get_many(["a"]) == [None]
+
+    def test_embedding_cache_evicts_lru(self, tmp_path):
+        from cache import EmbeddingCache
+        c = EmbeddingCache(str(tmp_path / "e.db"), "m", max_entries=10)
+        c.put_many([f"t{i}" for i in range(10)], [[float(i)] for i in range(10)])
+        c.get_many(["t0"])  # touch, so t0 is most recently used
+        c.put_many(["t10"], [[10.0]])
+        assert c.stats()["size"] <= 10
+        assert c.get_many(["t0"]) == [[0.0]] and c.get_many(["t1"]) == [None]
+
+    def test_embedding_cache_hits_do_not_write(self, tmp_path):
+        from cache import EmbeddingCache
+        c = EmbeddingCache(str(tmp_path / "e.db"), "m")
+        c.put_many(["a"], [[1.0]])
+        before = c._conn.total_changes
+        for _ in range(3): assert c.get_many(["a"]) == [[1.0]]
+        assert c._conn.total_changes == before and len(c._touched) == 1
+        c.TOUCH_FLUSH_S = 0
+        c.get_many(["a"])
+        assert c._conn.total_changes == before + 1 and not c._touched
+
+    def test_answer_cache_lru_and_ttl(self):
+        from cache import AnswerCache
+        c = AnswerCache(max_entries=2, ttl_s=60)
+        c.put("a", {"answer": 1}); c.put("b", {"answer": 2})
+        assert c.get("a") == {"answer": 1}
+        c.put("c", {"answer": 3})  # evicts b, the least recently used
+        assert c.get("b") is None and c.get("a") and c.get("c")
+        short = AnswerCache(ttl_s=0.01)
+        short.put("k", 1); time.sleep(0.02)
+        assert short.get("k") is None
+
+    def test_answer_cache_persists(self, tmp_path):
+        from cache import AnswerCache
+        AnswerCache(path=str(tmp_path / "a.db")).put("k", {"answer": "x"})
+        assert AnswerCache(path=str(tmp_path / "a.db")).get("k") == {"answer": "x"}
+
+    def test_answer_cache_shared_through_disk_with_per_entry_ttl(self, tmp_path):
+        from cache import AnswerCache
+        a, b = AnswerCache(10, 60, str(tmp_path / "c.db")), AnswerCache(10, 60, str(tmp_path / "c.db"))
+        a.put("k", {"v": 1}); a.put("short", [1], ttl_s=-1)
+        assert b.get("k") == {"v": 1}  # written by another instance after b started
+        assert b.get("short") is None and a.get("short") is None
+
+    def test_answer_cache_lru_eviction_keeps_shared_disk_rows(self, tmp_path):
+        from cache import AnswerCache
+        a, b = AnswerCache(1, 60, str(tmp_path / "c.db"), max_disk_entries=2), AnswerCache(1, 60, str(tmp_path / "c.db"))
+        a.put("x", 1, ttl_s=30); a.put("y", 2)  # evicts x from a's memory only
+        assert b.get("x") == 1 and a.get("x") == 1
+        a.put("old", 0, ttl_s=-1); a.put("z", 3, ttl_s=120)
+        a._sweep()  # expired rows go, then the soonest-expiring beyond the disk cap
+        assert sorted(k for k, in a._conn.execute("SELECT key FROM answers")) == ["y", "z"]
+
+    def test_answer_key_normalizes_and_versions(self):
+        from rag import _answer_key
+        assert _answer_key("Who is Frodo?", 5, 1) == _answer_key("  who is  frodo ", 5, 1)
+        assert _answer_key("Who is Frodo?", 5, 1) != _answer_key("Who is Frodo?", 3, 1)
+        assert _answer_key("Who is Frodo?", 5, 1) != _answer_key("Who is Frodo?", 5, 2)
+
+    def test_resources_reused_until_reset(self):
+        from rag import _Resources
+        r, built = _Resources(), []
+        make = lambda: built.append(1) or object()
+        first = r._get("x", make)
+        assert r._get("x", make) is first and len(built) == 1
+        r.reset()
+        assert r._get("x", make) is not first and len(built) == 2
+
+    def test_reset_keeps_query_embedder_thread(self, monkeypatch):
+        import threading
+        import rag
+        from types import SimpleNamespace
+        monkeypatch.setattr(rag, "_embeddings", lambda: SimpleNamespace(embed_documents=lambda t: [[1.0]] * len(t)))
+        monkeypatch.setattr(rag, "EMBED_BATCH_WINDOW_MS", 1)
+        r = rag._Resources()
+        emb, threads = r.embeddings(), threading.active_count()
+        for _ in range(5): r.reset()
+        assert r.embeddings() is emb and threading.active_count() == threads and emb.embed_query("q") == [1.0]
+
+    def test_histogram_snapshot_is_cumulative(self):
+        from metrics import Histogram
+        h = Histogram("t", [1, 5])
+        for v in (0.5, 3, 3, 10): h.observe(v)
+        snap = h.snapshot()
+        assert snap["count"] == 4 and snap["sum"] == 16.5
+        assert snap["buckets"] == {"1": 1, "5": 3, "+Inf": 4}
+
+    def test_metrics_prometheus_and_store(self, tmp_path, monkeypatch):
+        import json, metrics
+        writer = metrics._StoreWriter(str(tmp_path / "m.jsonl"), 60)
+        monkeypatch.setattr(metrics, "_store", writer)
+        monkeypatch.setattr(metrics, "METRICS_STORE", True)
+        h = metrics.histogram("test_step_ms", [10, 100], "Step time", task="test", step="a")
+        with metrics.timed(h) as t:
+            pass
+        for n in (7, 1, 2): metrics.counter("test_tokens_total", "Tokens", task="test").inc(n)
+        text = metrics.render_prometheus()
+        assert "# TYPE test_step_ms histogram" in text and "# TYPE test_tokens_total counter" in text
+        assert 'test_step_ms_bucket{le="10",step="a"} 1' in text and "test_tokens_total 10" in text
+        writer.flush(); writer.flush()  # nothing new: no second set of rows
+        rows = [json.loads(l) for l in open(tmp_path / "m.jsonl")]
+        assert [(r["task"], r["type"], r["metric"]) for r in rows] == [("test", "stats", "step_ms"), ("test", "stats", "tokens")]
+        assert rows[0]["count"] == 1 and rows[0]["p50"] == t.elapsed_ms and rows[0]["labels"] == {"step": "a"}
+        assert (rows[1]["count"], rows[1]["sum"], rows[1]["p50"], rows[1]["p95"]) == (3, 10, 2, 7)
+
+    def test_batching_embedder_coalesces(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from rag import _BatchingEmbedder
+        calls = []
+        class Inner:
+            def embed_documents(self, texts):
+                calls.append(len(texts)); return [[float(len(t))] for t in texts]
+        b = _BatchingEmbedder(Inner(), window_ms=50, max_batch=8)
+        with ThreadPoolExecutor(16) as pool:
+            out = list(pool.map(b.embed_query, ["x" * i for i in range(16)]))
+        assert out == [[float(i)] for i in range(16)]
+        assert sum(calls) == 16 and len(calls) < 16 and max(calls) <= 8
+
+    def test_solution_cache_history_and_fixes(self, tmp_path):
+        from cache import SolutionCache
+        c = SolutionCache(str(tmp_path / "s.db"))
+        c.put("sort a list", "python", "m", ["sol", "tests"])
+        assert c.get("sort a list", "python", "m") == {"blocks": ["sol", "tests"], "passes": 1, "fails": 0}
+        assert c.get("sort a list", "python", "other-model") is None
+        c.record("sort a list", "python", "m", passed=False)  # stale: hidden until a new solution passes
+        assert SolutionCache(str(tmp_path / "s.db")).get("sort a list", "python", "m") is None
+        c.put_fix("python", "m", ["bad"], "E assert 1 == 2", ["good"])
+        assert c.get_fix("python", "m", ["bad"], "E assert 1 == 2") == ["good"]
+        c.put_fix("python", "m", ["bad"], "E assert 1 == 2", ["good"], passed=False)
+        assert c.get_fix("python", "m", ["bad"], "E assert 1 == 2") is None and c.get_fix("python", "m", ["x"], "y") is None
+
 #  Agent tool tests 
 class TestAgentTools:
     def test_flights(self):
@@ -73,6 +459,125 @@ class TestAgentTools:
         from agent import TOOL_DISPATCH, TOOLS_SPEC
         assert {t["function"]["name"] for t in TOOLS_SPEC} == set(TOOL_DISPATCH.keys())
 
+    def test_run_tools_parallel_ordered_and_isolated(self, monkeypatch):
+        import agent
+        from types import SimpleNamespace
+        def slow(city, **_):
+            time.sleep(0.2); return {"city": city}
+        def broken(**_):
+            raise RuntimeError("api down")
+        def hang(**_):
+            time.sleep(1); return {}
+        monkeypatch.setitem(agent.TOOL_DISPATCH, "slow", slow)
+        monkeypatch.setitem(agent.TOOL_DISPATCH, "broken", broken)
+        monkeypatch.setitem(agent.TOOL_DISPATCH, "hang", hang)
+        monkeypatch.setitem(agent.TOOL_TIMEOUTS, "hang", 0.3)
+        call = lambda i, name, args: SimpleNamespace(id=f"c{i}", function=SimpleNamespace(name=name, arguments=args))
+        calls = [call(0, "slow", '{"city": "A"}'), call(1, "broken", "{}"), call(2, "slow", '{"city": "B"}'),
+                 call(3, "hang", "{}"), call(4, "slow", "{not json")]
+        start = time.perf_counter()
+        out = agent._run_tools(calls)
+        assert time.perf_counter() - start < 0.6  # ~max(0.2, 0.3 timeout), not the 1.4 s serial sum
+        assert [tc.id for tc, *_ in out] == ["c0", "c1", "c2", "c3", "c4"]
+        assert out[0][2] == {"city": "A"} and out[2][2] == {"city": "B"} and out[0][3] >= 200
+        assert "api down" in out[1][2]["error"] and "timed out" in out[3][2]["error"] and "invalid" in out[4][2]["error"]
+
+    def test_tool_cache_canonical_keys_and_errors(self, monkeypatch):
+        import agent
+        from types import SimpleNamespace
+        from cache import AnswerCache
+        monkeypatch.setattr(agent, "_tool_cache", AnswerCache(100, 60))
+        calls = []
+        def flights(origin, destination, date, max_price=999):
+            calls.append(origin)
+            if origin == "Nowhere": raise RuntimeError("no route")
+            return [{"flight": "NZ1", "price_nzd": 50}]
+        monkeypatch.setitem(agent.TOOL_DISPATCH, "search_flights", flights)
+        call = lambda args: SimpleNamespace(id="c", function=SimpleNamespace(name="search_flights", arguments=args))
+        first = agent._run_tools([call('{"origin": "Wellington", "destination": "Auckland", "date": "2025-03-15"}')])
+        again = agent._run_tools([call('{"date": "2025-03-15", "destination": "auckland ", "origin": "WELLINGTON"}')])
+        assert again[0][2] == first[0][2] and again[0][4] and not first[0][4] and calls == ["Wellington"]
+        for _ in range(2):
+            agent._run_tools([call('{"origin": "Nowhere", "destination": "X", "date": "2025-03-15"}')])
+        assert calls.count("Nowhere") == 2  # errors are never cached
+        uncached = agent._run_tools([call('{"origin": "Wellington", "destination": "Auckland", "date": "2025-03-15"}')], use_cache=False)
+        assert not uncached[0][4] and calls.count("Wellington") == 2 and agent._tool_cache.stats()["hits"] == 1
+
+    def test_weather_deterministic_mode(self, monkeypatch):
+        import agent
+        monkeypatch.setattr(agent, "DETERMINISTIC_WEATHER", True)
+        assert agent.get_weather("Auckland", "2025-03-15") == agent.get_weather(" auckland", "2025-03-15") | {"city": "Auckland"}
+
+    def test_serialize_result_compact_and_projected(self):
+        import json, agent
+        hotels = [{"name": f"H{i}", "type": "hostel", "price_per_night_nzd": 40 + i, "rating": 4.0, "address": "x" * 50}
+                  for i in range(agent.TOOL_MAX_ITEMS + 2)]
+        out = agent._serialize_result("search_accommodation", hotels)
+        data = json.loads(out)
+        assert "\n" not in out and data["omitted"] == 2 and len(data["results"]) == agent.TOOL_MAX_ITEMS
+        assert set(data["results"][0]) == {"name", "type", "price_per_night_nzd", "rating"}
+
+    def test_compact_summarises_oldest_tool_turns(self):
+        import agent
+        flights = agent._serialize_result("search_flights", agent.search_flights("A", "B", "2025-03-15"))
+        messages = [{"role": "system", "content": "s"}, {"role": "user", "content": "plan"}]
+        for i in range(3):
+            messages.append({"role": "assistant", "tool_calls": [{"id": f"c{i}", "type": "function",
+                             "function": {"name": "search_flights", "arguments": "{}"}}]})
+            messages.append({"role": "tool", "tool_call_id": f"c{i}", "content": flights})
+        full = sum(agent._message_tokens(m) for m in messages)
+        assert agent._compact(messages, budget=full) == full  # within budget: untouched
+        tokens = agent._compact(messages, budget=1)
+        tool_msgs = [m for m in messages if m["role"] == "tool"]
+        assert tokens < full and all(m["content"].startswith(agent.SUMMARY_PREFIX) for m in tool_msgs[:2])
+        assert tool_msgs[-1]["content"] == flights  # latest turn kept whole
+        assert '"price_nzd":59' in tool_msgs[0]["content"]  # cheapest option survives the summary
+
+    def test_tool_ms_labels_bounded(self):
+        from agent import _tool_ms
+        assert _tool_ms("made_up_tool") is _tool_ms("another_fake") and _tool_ms("search_flights").labels == {"tool": "search_flights"}
+
+    def test_compact_without_tool_turns_is_noop(self):
+        import agent
+        messages = [{"role": "system", "content": "s"}, {"role": "user", "content": "plan " * 4000}]
+        full = sum(agent._message_tokens(m) for m in messages)
+        assert agent._compact(messages, budget=100) == full and messages[1]["content"] == "plan " * 4000
+
+    def test_extract_trip_and_prefetch_calls(self):
+        from datetime import date
+        import agent
+        from agent import _extract_trip, _prefetch_calls
+        trip = _extract_trip("Plan a 2-day trip to Auckland for under NZ$500. Departing from Wellington on the 15th of "
+                             "next month.", today=date(2025, 12, 20))
+        assert trip == {"destination": "Auckland", "origin": "Wellington", "days": 2, "budget": 500.0,
+                        "start": "2026-01-15", "end": "2026-01-16"}
+        calls = _prefetch_calls(trip)
+        assert ("search_flights", {"origin": "Auckland", "destination": "Wellington", "date": "2026-01-16", "max_price": 500.0}) in calls
+        assert ("search_accommodation", {"city": "Auckland", "checkin": "2026-01-15", "nights": 1, "max_price": 500.0}) in calls
+        assert [n for n, _ in calls].count("get_weather") == 2
+        stay = dict(_prefetch_calls(_extract_trip("4 nights in Auckland from 2026-03-01 under $300")))["search_accommodation"]
+        assert stay["max_price"] == 300 and agent.search_accommodation(**stay) == [
+            h for h in agent.search_accommodation("Auckland", "2026-03-01", 4) if h["price_per_night_nzd"] <= 300 / 4]
+        assert "max_price" not in dict(_prefetch_calls(_extract_trip("3 nights in Rotorua on 2026-03-03")))["search_accommodation"]
+        # Unresolved parts are left to the model: no origin -> no flights, no destination -> nothing at all
+        assert "search_flights" not in [n for n, _ in _prefetch_calls(_extract_trip("3 nights in Rotorua on March 3rd"))]
+        assert _prefetch_calls(_extract_trip("Plan me something for under $300")) == []
+
+    def test_prefetch_runs_tools_before_first_llm_call(self, monkeypatch):
+        import agent
+        from types import SimpleNamespace
+        seen = []
+        def create(messages, **_):
+            seen.append([m["role"] for m in messages])
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(tool_calls=None, content='{"destination": "Auckland"}'))],
+                                   usage=None)
+        monkeypatch.setattr(agent, "get_openai_client", lambda: SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+        steps = []
+        out = agent.run_agent("Weekend trip to Auckland from Wellington on 2026-11-14", on_step=steps.append, prefetch=True)
+        assert out == {"destination": "Auckland"} and len(seen) == 1
+        assert seen[0][:3] == ["system", "user", "assistant"] and seen[0].count("tool") == 6  # 2 flights, hotel, 2 weather, attractions
+        assert [s["iteration"] for s in steps] == [0, 1]
+
 #  Healer tests 
 class TestHealer:
     def test_extract_blocks_python(self):
@@ -104,6 +609,148 @@ class TestHealer:
         from healer import MAX_RETRIES
         assert MAX_RETRIES == 3
 
+    def test_score_failed_runs(self):
+        from healer import _score
+        assert _score("python", "=== 1 failed, 2 passed in 0.1s ===") == 2 / 3
+        assert _score("python", "=== 1 error in 0.1s ===") == 0.0
+        assert _score("rust", "test result: FAILED. 3 passed; 1 failed; 0 ignored") == 0.75
+        assert _score("rust", "error[E0308]: mismatched types") == 0.0
+
+    def test_candidates_first_pass_cancels_rest(self, monkeypatch, tmp_path):
+        import healer
+        monkeypatch.setattr(healer, "HEALER_TEST_WORKERS", 3)
+        def runner(workdir, blocks, cancel):
+            if blocks == ["slow"]:
+                return (False, healer.CANCELLED, {}) if cancel.wait(5) else (True, "too slow", {})
+            time.sleep(0.1)
+            return blocks == ["good"], "=== 1 failed in 0.1s ===" if blocks == ["bad"] else "ok", {"test": 100.0}
+        start = time.perf_counter()
+        results = healer._test_candidates(runner, "python", [str(tmp_path / d) for d in "abc"], [["slow"], ["bad"], ["good"]],
+                                          sched=healer._Scheduler(test_concurrency=3))
+        assert time.perf_counter() - start < 2
+        assert [r[0] for r in results] == [False, False, True] and results[0][1] == healer.CANCELLED
+
+    def test_warm_pytest_isolated_and_limited(self, tmp_path, monkeypatch):
+        import healer
+        monkeypatch.setattr(healer, "HEALER_WARM_PYTEST", True)
+        tests = "from solution import f\ndef test_f():\n    assert f(2) == 2\n"
+        runs = {"good": "def f(x):\n    return x", "bad": "def f(x):\n    return 0",
+                "hog": "BLOB = bytearray(4 * 1024 ** 3)\ndef f(x):\n    return x"}
+        results = {}
+        for name, solution in runs.items():  # same module name each time: nothing may leak between runs
+            (tmp_path / name).mkdir()
+            results[name] = healer._write_and_test_python(str(tmp_path / name), [solution, tests])
+        assert [results[k][0] for k in runs] == [True, False, False]
+        assert "MemoryError" in results["hog"][1] and set(results["good"][2]) == {"write", "test"}
+
+    def test_warm_pytest_gives_up_on_wedged_zygote(self, tmp_path, monkeypatch):
+        import subprocess
+        import healer
+        warm = healer._WarmPytest.__new__(healer._WarmPytest)
+        warm.__dict__.update(_proc=subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"], stdin=subprocess.PIPE),
+                             _send_lock=healer.threading.Lock(), _waiters={}, _ids=healer.itertools.count(), _abandoned=set())
+        try:
+            start = time.perf_counter()
+            with pytest.raises(RuntimeError, match="did not start"):
+                warm.run(str(tmp_path), healer.PYTEST_ARGS, timeout=0.2)
+            assert time.perf_counter() - start < 2 and warm._waiters == {}
+        finally:
+            warm._proc.kill()
+        monkeypatch.setattr(healer, "_get_warm_pytest", lambda: warm)  # dead zygote: _pytest falls back to a cold run
+        (tmp_path / "test_solution.py").write_text("def test_ok():\n    pass\n")
+        assert healer._pytest(str(tmp_path))[0] == 0
+
+    def test_sweep_workdirs_removes_only_stale(self, tmp_path, monkeypatch):
+        import tempfile
+        import healer
+        monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+        old, new, other = (tmp_path / "healer_old"), (tmp_path / "healer_new"), (tmp_path / "keep_me")
+        for d in (old, new, other): d.mkdir()
+        os.utime(old, (time.time() - 7200,) * 2)
+        os.utime(other, (time.time() - 7200,) * 2)
+        assert healer._sweep_workdirs(3600) == 1 and not old.exists() and new.exists() and other.exists()
+        busy = tmp_path / "healer_busy"; busy.mkdir(); (busy / "solution.py").write_text("x = 1")
+        os.utime(busy, (time.time() - 7200,) * 2)  # rewriting a file leaves the dir's mtime alone
+        with healer._workdir() as live:
+            for path in (live, os.path.join(live, healer.WORKDIR_LOCK)): os.utime(path, (time.time() - 7200,) * 2)
+            assert healer._sweep_workdirs(3600) == 0 and busy.exists() and os.path.exists(live)  # locked by this run
+        assert healer._sweep_workdirs(3600) == 1 and not os.path.exists(live)
+        sweeps = []
+        monkeypatch.setattr(healer, "_sweep_workdirs", lambda: sweeps.append(1))
+        monkeypatch.setattr(healer, "_heal", lambda task, workdir, *rest: os.path.isdir(workdir))
+        monkeypatch.setattr(healer, "HEALER_KEEP_WORKDIR", True)
+        assert healer.heal("t") and sweeps == []
+
+    def test_error_signature_ignores_paths_lines_and_timings(self):
+        from healer import _error_signature
+        run = "/tmp/healer_a/test_solution.py:12: AssertionError\nE       assert 3 == 4\n=== 1 failed in 0.12s ==="
+        other = run.replace("healer_a", "healer_b").replace(":12", ":14").replace("0.12s", "0.31s")
+        assert _error_signature("python", run) == _error_signature("python", other) == "E       assert 3 == 4"
+        assert _error_signature("python", run) != _error_signature("python", run.replace("3 == 4", "3 == 5"))
+
+    def test_heal_cache_hit_skips_llm(self, tmp_path, monkeypatch):
+        from types import SimpleNamespace
+        import healer
+        from cache import SolutionCache
+        cache, runs = SolutionCache(str(tmp_path / "s.db")), []
+        cache.put(healer._normalize_task("Write f."), "python", healer.MODEL_NAME, ["def f(): pass", "def test_f(): pass"])
+        def fail(**kw): raise AssertionError("LLM called")
+        monkeypatch.setattr(healer, "get_openai_client", lambda: SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=fail))))
+        monkeypatch.setattr(healer, "_get_solution_cache", lambda: cache)
+        monkeypatch.setattr(healer, "_get_warm_pytest", lambda: None)
+        monkeypatch.setattr(healer, "_write_and_test_python", lambda w, blocks, cancel=None, sched=None: (runs.append(blocks), (True, "ok", {}))[1])
+        assert healer.heal("  write F ") and runs == [["def f(): pass", "def test_f(): pass"]]
+        assert cache.get("write f", "python", healer.MODEL_NAME)["passes"] == 2
+
+    def test_test_slots_cap_runs_across_tasks(self, tmp_path, monkeypatch):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        import healer
+        sched = healer._Scheduler(test_concurrency=1)
+        running, peak, lock = [0], [0], threading.Lock()
+        def runner(workdir, blocks, cancel):
+            with lock: running[0] += 1; peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock: running[0] -= 1
+            return False, "=== 1 failed ===", {"test": 50.0}
+        reports = [{} for _ in range(3)]
+        with ThreadPoolExecutor(3) as pool:
+            list(pool.map(lambda i: healer._test_candidates(runner, "python", [str(tmp_path / str(i))], [["x"]], reports[i], sched), range(3)))
+        assert peak[0] == 1 and sum(r["phases_ms"]["test_wait"] for r in reports) >= 50
+
+    def test_batch_reports_in_order_with_summary(self, monkeypatch):
+        import healer
+        scheds = set()
+        def fake_heal(task, candidates, use_cache, report, sched):
+            scheds.add(sched)
+            time.sleep(0.05 if task == "slow" else 0)
+            report.update(lang="rust" if "rust" in task else "python", attempts=2 if task == "slow" else 1,
+                          llm_calls=1, cost_usd=0.01, phases_ms={"llm": 5.0})
+            if task == "boom": raise RuntimeError("api down")
+            return task != "bad"
+        monkeypatch.setattr(healer, "heal", fake_heal)
+        monkeypatch.delenv("CARGO_BUILD_JOBS", raising=False)
+        rows = list(healer.batch([{"task": "slow"}, {"task": "bad", "id": "b"}, {"task": "in rust"}, {"task": "boom"}],
+                                 llm_concurrency=2, test_concurrency=1))
+        assert [r["id"] for r in rows[:-1]] == [0, "b", 2, 3] and rows[3]["error"] == "RuntimeError: api down"
+        summary = rows[-1]["summary"]
+        assert summary["pass_rate"] == 0.5 and summary["pass_rate_by_lang"] == {"python": 0.333, "rust": 1.0}
+        assert summary["first_attempt_pass_rate"] == 0.25 and summary["llm_calls"] == 4 and summary["phases_ms"] == {"llm": 20.0}
+        (sched,) = scheds
+        assert not sched.verbose and (sched.llm_concurrency, sched.test_concurrency) == (2, 1) and sched.cargo_jobs >= 1
+        assert healer._scheduler.verbose and "CARGO_BUILD_JOBS" not in os.environ
+
+    def test_generate_tops_up_when_n_ignored(self):
+        from types import SimpleNamespace
+        import healer
+        calls = []
+        def create(**kw):
+            calls.append(kw.get("n"))
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="```python\nx = 1\n```"))], usage=None)
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        out = healer._generate(client, "python", "task", "E: boom", ["x = 0"], n=3)
+        assert out == [["x = 1"]] * 3 and calls == [3, None, None]
+
 #  API tests
 class TestAPI:
     def test_health_endpoint(self):
@@ -112,4 +759,191 @@ class TestAPI:
         client = TestClient(app)
         r = client.get("/health")
         assert r.status_code == 200
-        assert r.json()["status"] == "ok"
\ No newline at end of file
+        assert r.json()["status"] == "ok"
+
+    def test_metrics_endpoint(self):
+        from fastapi.testclient import TestClient
+        from api import app
+        r = TestClient(app).get("/metrics")
+        assert r.status_code == 200 and r.headers["content-type"].startswith("text/plain")
+        assert 'api_active_requests{endpoint="rag"} 0' in r.text
+
+    def test_rag_stream_sse(self, monkeypatch):
+        from fastapi.testclient import TestClient
+        import api
+        async def fake_stream(question, top_k, mode):
+            yield "sources", [{"source": "s", "page": 1, "score": 0.1}]
+            yield "token", "Sting"
+            yield "done", {"retrieval_ms": 1.0, "ttft_ms": 2.0, "total_ms": 3.0, "cached": False}
+        monkeypatch.setattr(api, "rag_query_stream", fake_stream)
+        r = TestClient(api.app).post("/rag/query/stream", json={"question": "Frodo's sword?"})
+        assert r.headers["content-type"].startswith("text/event-stream")
+        events = [line.split(": ", 1)[1] for line in r.text.splitlines() if line.startswith("event:")]
+        assert events == ["sources", "token", "done"]
+        assert "rag_cache_hits_total" in TestClient(api.app).get("/metrics").text
+
+    def test_admission_gate_rejects_when_saturated(self):
+        import asyncio
+        from fastapi import HTTPException
+        from api import AdmissionGate
+        async def scenario():
+            gate = AdmissionGate("test", limit=1, max_queue=1, max_wait_s=0.05)
+            await gate.acquire()
+            waiter = asyncio.create_task(gate.acquire())  # takes the one queue place
+            await asyncio.sleep(0)
+            with pytest.raises(HTTPException) as full:
+                await gate.acquire()
+            with pytest.raises(HTTPException) as timeout:
+                await waiter
+            gate.release()
+            async with gate.slot():
+                assert gate.active == 1
+            return full.value, timeout.value, gate.stats()
+        full, timeout, stats = asyncio.run(scenario())
+        assert full.status_code == 429 and "Retry-After" in full.headers
+        assert timeout.status_code == 503 and "Retry-After" in timeout.headers
+        assert stats["rejected"] == 1 and stats["timed_out"] == 1 and stats["active"] == 0 and stats["queued"] == 0
+
+    def test_job_queue_runs_and_resumes(self, tmp_path):
+        from jobs import JobStore, JobQueue
+        store = JobStore(str(tmp_path / "jobs.db"))
+        stale = store.create("echo", {"x": 1}); store.start(stale)  # interrupted by a "restart"
+        def echo(payload, on_step):
+            on_step({"iteration": 1}); return payload
+        q = JobQueue(JobStore(str(tmp_path / "jobs.db")), {"echo": echo}, workers=2)
+        assert q.resume() == 1
+        fresh = q.submit("echo", {"x": 2})
+        for _ in range(100):
+            if all(q.store.get(j)["status"] == "done" for j in (stale, fresh)): break
+            time.sleep(0.02)
+        job = q.store.get(fresh)
+        assert job["status"] == "done" and job["result"] == {"x": 2} and job["steps"] == [{"iteration": 1}]
+        assert q.store.get(stale)["result"] == {"x": 1}
+
+    def test_job_queue_cap_holds_under_concurrent_submits(self, tmp_path):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from jobs import JobStore, JobQueue, QueueFull
+        release = threading.Event()
+        q = JobQueue(JobStore(str(tmp_path / "jobs.db")), {"wait": lambda p, s: release.wait(5)}, workers=1, max_pending=3)
+        def submit(i):
+            try: return q.submit("wait", {"i": i})
+            except QueueFull: return None
+        with ThreadPoolExecutor(16) as pool:
+            accepted = [j for j in pool.map(submit, range(32)) if j]
+        release.set()
+        assert len(accepted) == 3
+
+    def test_agent_job_endpoints(self, tmp_path, monkeypatch):
+        from fastapi.testclient import TestClient
+        import api
+        from jobs import JobStore, JobQueue
+        def fake_agent(prompt, on_step=None):
+            on_step({"iteration": 1, "llm_ms": 1.0, "tools_ms": 0.5, "scratchpad": [" search_flights(...)"]})
+            return {"destination": prompt}
+        monkeypatch.setattr(api, "_job_queue", JobQueue(JobStore(str(tmp_path / "jobs.db")),
+                                                        {"agent_plan": lambda p, on_step: fake_agent(p["prompt"], on_step)}))
+        monkeypatch.setattr(api, "JOB_POLL_S", 0.01)
+        client = TestClient(api.app)
+        r = client.post("/agent/jobs", json={"prompt": "Auckland"})
+        assert r.status_code == 202
+        job_id = r.json()["job_id"]
+        events = [l.split(": ", 1)[1] for l in client.get(f"/agent/jobs/{job_id}/events").text.splitlines() if l.startswith("event:")]
+        assert "step" in events and events[-1] == "done"
+        job = client.get(f"/agent/jobs/{job_id}").json()
+        assert job["result"] == {"destination": "Auckland"} and job["steps"][0]["iteration"] == 1
+        assert client.get("/agent/jobs/nope").status_code == 404
+
+    def test_rag_batch_ndjson(self, monkeypatch):
+        import json
+        from fastapi.testclient import TestClient
+        import api
+        rates = []
+        def fake_batch(items, top_k, mode, concurrency, rps):
+            rates.append(rps)
+            for i, item in enumerate(items):
+                yield {"index": i, "question": item if isinstance(item, str) else item["question"], "answer": "a"}
+            yield {"summary": {"n": len(items)}}
+        monkeypatch.setattr(api, "rag_batch", fake_batch)
+        r = TestClient(api.app).post("/rag/query/batch", json={"questions": ["a?", {"id": "2", "question": "b?"}]})
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        assert [row.get("index") for row in rows] == [0, 1, None] and rows[-1]["summary"]["n"] == 2
+        assert api.batch_gate.active == 0
+        monkeypatch.setattr(api, "BATCH_RPS", 2.0)
+        for rps in (0, 100, 1):  # unlimited and faster requests are clamped to the server's rate
+            list(TestClient(api.app).post("/rag/query/batch", json={"questions": ["a?"], "rps": rps}).iter_lines())
+        assert rates[1:] == [2.0, 2.0, 1]
+
+#  Stub server / load test tests
+class TestStub:
+    def test_stub_tool_calls_then_answer(self, monkeypatch):
+        import json
+        from fastapi.testclient import TestClient
+        import stub_server
+        from agent import TOOLS_SPEC
+        monkeypatch.setattr(stub_server, "STUB_LATENCY_MS", 0)
+        monkeypatch.setattr(stub_server, "STUB_TOKENS_PER_S", 0)
+        client = TestClient(stub_server.app)
+        messages = [{"role": "user", "content": "Plan a trip"}]
+        first = client.post("/v1/chat/completions", json={"model": "m", "messages": messages, "tools": TOOLS_SPEC}).json()
+        calls = first["choices"][0]["message"]["tool_calls"]
+        assert first["choices"][0]["finish_reason"] == "tool_calls" and len(calls) == len(TOOLS_SPEC)
+        assert {"city", "checkin", "nights"} <= set(json.loads(calls[3]["function"]["arguments"]))
+        messages += [{"role": "assistant", "tool_calls": calls}, {"role": "tool", "tool_call_id": calls[0]["id"], "content": "[]"}]
+        done = client.post("/chat/completions", json={"model": "m", "messages": messages, "tools": TOOLS_SPEC}).json()
+        assert json.loads(done["choices"][0]["message"]["content"])["tool_results"] == 1 and done["usage"]["prompt_tokens"] > 0
+
+    def test_stub_record_then_replay_streamed(self, monkeypatch, tmp_path):
+        import json
+        from fastapi.testclient import TestClient
+        import stub_server
+        recorded = {"id": "chatcmpl-1", "object": "chat.completion", "created": 1, "model": "m",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "Recorded reply"}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}}
+        async def upstream(body): return recorded
+        monkeypatch.setattr(stub_server, "_upstream", upstream)
+        monkeypatch.setattr(stub_server, "_cassette", stub_server.Cassette(str(tmp_path / "cassette.jsonl")))
+        monkeypatch.setattr(stub_server, "STUB_LATENCY_MS", 0)
+        monkeypatch.setattr(stub_server, "STUB_MODE", "record")
+        client, body = TestClient(stub_server.app), {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+        assert client.post("/v1/chat/completions", json=body).json() == recorded
+        monkeypatch.setattr(stub_server, "STUB_MODE", "replay")
+        monkeypatch.setattr(stub_server, "_cassette", stub_server.Cassette(str(tmp_path / "cassette.jsonl")))  # reloaded from disk
+        r = client.post("/v1/chat/completions", json={**body, "stream": True, "stream_options": {"include_usage": True}})
+        chunks = [json.loads(l[6:]) for l in r.text.splitlines() if l.startswith("data: {")]
+        assert "".join(c["choices"][0]["delta"].get("content", "") for c in chunks if c["choices"]) == "Recorded reply"
+        assert chunks[-1]["usage"]["total_tokens"] == 5 and r.text.rstrip().endswith("data: [DONE]")
+        monkeypatch.setattr(stub_server, "STUB_STRICT", True)
+        assert client.post("/v1/chat/completions", json={**body, "model": "other"}).status_code == 404
+
+    def test_loadtest_open_loop_report(self):
+        import loadtest
+        def sender(base_url, scenario, question, scheduled, timeout_s):
+            slow = scenario == "agent"
+            return {"scenario": scenario, "status": 500 if question == "bad" else 200, "lag_ms": 0.0, "ttft_ms": None,
+                    "error": None, "latency_ms": 100.0 if slow else 10.0}
+        start = time.perf_counter()
+        report = loadtest.run_load("http://x", ["rag", "agent"], rps=40, duration_s=0.25, questions=["q", "q", "bad", "q"],
+                                   sender=sender)
+        assert 0.2 < time.perf_counter() - start < 1.0  # paced at the target rate
+        rag, agent_, overall = (report["scenarios"][k] for k in ("rag", "agent", "all"))
+        assert overall["requests"] == 10 and rag["errors"] == {"500": 2} and agent_["error_rate"] == 0
+        assert agent_["latency_ms"]["p95"] == 100.0 and rag["latency_ms"]["p50"] == 10.0
+        assert loadtest.check(report, max_p95_ms=50, max_error_rate=0.5) == ["p95 100 ms > 50 ms"]
+
+    def test_loadtest_stream_errors_after_200(self, monkeypatch):
+        import contextlib, loadtest
+        from types import SimpleNamespace
+        body = []
+        session = SimpleNamespace(request=lambda *a, **kw: contextlib.nullcontext(
+            SimpleNamespace(status_code=200, iter_content=lambda chunk_size: iter(body))))
+        monkeypatch.setattr(loadtest, "_session", lambda: session)
+        send = lambda scenario: loadtest.send("http://x", scenario, "q", time.perf_counter(), 5)
+        body[:] = [b'{"index": 0, "answer": "a", "cached": false}\n{"index": 1, "quest', b'ion": "q", "error": "llm down"}\n',
+                   b'{"summary": {"n": 2}}\n']
+        assert "llm down" in send("rag_batch")["error"]
+        body[:] = [b'event: sources\ndata: []\n\nevent: tok', b'en\ndata: "hi"\n\neve', b'nt: error\ndata: {"detail": "x"}\n\n']
+        assert send("rag_stream")["error"] == "event: error"
+        body[:] = [b'event: token\ndata: {"error": null}\n\n', b'{"index": 0, "error": null}']
+        row = send("rag_stream")
+        assert row["error"] is None and row["ttft_ms"] is not None
@@ -0,0 +1,185 @@
+import os, json, shutil, sqlite3, threading
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+
+# Both backends expose the same small surface used by rag.py:
+#   count(), upsert(ids, embeddings, documents, metadatas), delete(ids), delete_collection(),
+#   get_page(limit, offset, with_embeddings), search_by_vectors(vectors, k), .embeddings
+# Scores are distances (lower is better), on the same squared-L2 scale for unit vectors.
+
+# ── Chroma backend ──────────────────────────────────────────────────────────
+
+class ChromaStore(Chroma):
+    """LangChain's Chroma wrapper plus the batch/raw-vector calls the ingest pipeline and batch retrieval need."""
+
+    def count(self) -> int:
+        return self._collection.count()
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self._collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def get_page(self, limit: int, offset: int, with_embeddings: bool = False) -> dict:
+        include = ["documents", "metadatas"] + (["embeddings"] if with_embeddings else [])
+        return self._collection.get(limit=limit, offset=offset, include=include)
+
+    def search_by_vectors(self, vectors: list, k: int) -> list[list[tuple[Document, float]]]:
+        res = self._collection.query(query_embeddings=vectors, n_results=k, include=["documents", "metadatas", "distances"])
+        return [[(Document(page_content=d, metadata=m or {}), float(s)) for d, m, s in zip(docs, metas, dists)]
+                for docs, metas, dists in zip(res["documents"], res["metadatas"], res["distances"])]
+
+# ── NumPy backend ───────────────────────────────────────────────────────────
+
+class NumpyVectorStore:
+    """Embedded vector store: unit-normalised embeddings in a memory-mapped float16 (or int8 + per-row scale) matrix,
+    searched exactly with one matrix multiply per block of rows for a whole batch of queries. Ids, texts and metadata
+    live in a SQLite side file and are only read for the rows a search returns, so opening the store is near-instant."""
+
+    BLOCK = 65536  # rows dequantised per matmul; bounds the float32 scratch to BLOCK x dim
+
+    def __init__(self, path: str, embedding_function, dtype: str = "float16"):
+        if dtype not in ("float16", "int8"): raise ValueError("dtype must be float16 or int8")
+        self.path, self.embeddings = path, embedding_function
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, "docs.db"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS docs (row INTEGER PRIMARY KEY, id TEXT UNIQUE, document TEXT, metadata TEXT)")
+        try:
+            with open(self._file("meta.json")) as f:
+                self._meta = json.load(f)
+        except FileNotFoundError:
+            self._meta = {"dtype": dtype, "dim": None, "rows": 0}
+        self._vecs = self._scales = self._valid = None
+        if self._meta["dim"]:
+            self._vecs = np.load(self._file("vectors.npy"), mmap_mode="r+")
+            self._valid = np.load(self._file("valid.npy"), mmap_mode="r+")
+            if self._meta["dtype"] == "int8":
+                self._scales = np.load(self._file("scales.npy"), mmap_mode="r+")
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _save_meta(self):
+        tmp = self._file("meta.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self._meta, f)
+        os.replace(tmp, self._file("meta.json"))
+
+    def _resize(self, capacity: int):
+        """(Re)create the memmaps with room for `capacity` rows, keeping existing rows."""
+        dim, rows = self._meta["dim"], self._meta["rows"]
+        specs = [("vectors.npy", np.float16 if self._meta["dtype"] == "float16" else np.int8, (capacity, dim), "_vecs"),
+                 ("valid.npy", np.uint8, (capacity,), "_valid")]
+        if self._meta["dtype"] == "int8":
+            specs.append(("scales.npy", np.float32, (capacity,), "_scales"))
+        for name, dt, shape, attr in specs:
+            tmp = self._file(name + ".tmp")
+            arr = np.lib.format.open_memmap(tmp, mode="w+", dtype=dt, shape=shape)
+            old = getattr(self, attr)
+            if old is not None and rows:
+                keep = min(rows, len(old))
+                arr[:keep] = old[:keep]
+            arr.flush(); del arr
+            os.replace(tmp, self._file(name))
+            setattr(self, attr, np.load(self._file(name), mmap_mode="r+"))
+
+    def count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def _rows_for(self, ids: list[str]) -> dict:
+        found = {}
+        for i in range(0, len(ids), 500):
+            part = ids[i:i + 500]
+            found.update(self._db.execute(f"SELECT id, row FROM docs WHERE id IN ({','.join('?' * len(part))})", part))
+        return found
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        vecs = np.asarray(embeddings, dtype=np.float32)
+        vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            if self._meta["dim"] is None:
+                self._meta["dim"] = vecs.shape[1]
+                self._resize(1024)
+            rows_by_id = self._rows_for(list(ids))
+            free = list(np.flatnonzero(self._valid[:self._meta["rows"]] == 0)[::-1])  # slots left by deletes
+            rows = []
+            for cid in ids:
+                if cid not in rows_by_id:
+                    if free: rows_by_id[cid] = int(free.pop())
+                    else: rows_by_id[cid] = self._meta["rows"]; self._meta["rows"] += 1
+                rows.append(rows_by_id[cid])
+            if self._meta["rows"] > len(self._valid):
+                self._resize(max(self._meta["rows"], len(self._valid) * 2))
+            rows = np.asarray(rows)
+            if self._meta["dtype"] == "int8":
+                scales = np.maximum(np.abs(vecs).max(axis=1), 1e-12) / 127
+                self._vecs[rows] = np.round(vecs / scales[:, None]).astype(np.int8)
+                self._scales[rows] = scales
+            else:
+                self._vecs[rows] = vecs.astype(np.float16)
+            self._valid[rows] = 1
+            self._db.executemany("INSERT OR REPLACE INTO docs (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                                 [(int(r), cid, doc, json.dumps(meta)) for r, cid, doc, meta in zip(rows, ids, documents, metadatas)])
+            self._db.commit()
+            self._vecs.flush(); self._valid.flush()
+            self._save_meta()
+
+    def delete(self, ids: list[str] = None, **_):
+        if not ids: return
+        with self._lock:
+            rows = list(self._rows_for(list(ids)).values())
+            if not rows: return
+            self._valid[np.asarray(rows)] = 0
+            self._valid.flush()
+            self._db.executemany("DELETE FROM docs WHERE row = ?", [(r,) for r in rows])
+            self._db.commit()
+
+    def delete_collection(self):
+        with self._lock:
+            self._db.close()
+            self._vecs = self._scales = self._valid = None
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.__init__(self.path, self.embeddings, self._meta["dtype"])
+
+    def get_page(self, limit: int, offset: int, with_embeddings: bool = False) -> dict:
+        rows = self._db.execute("SELECT row, id, document, metadata FROM docs ORDER BY row LIMIT ? OFFSET ?",
+                                (limit, offset)).fetchall()
+        page = {"ids": [r[1] for r in rows], "documents": [r[2] for r in rows], "metadatas": [json.loads(r[3]) for r in rows]}
+        if with_embeddings:
+            page["embeddings"] = self._dequantize(np.asarray([r[0] for r in rows], dtype=np.int64)).tolist() if rows else []
+        return page
+
+    def _dequantize(self, rows) -> np.ndarray:
+        block = np.asarray(self._vecs[rows], dtype=np.float32)
+        if self._scales is not None: block *= self._scales[rows][:, None]
+        return block
+
+    def search_by_vectors(self, vectors: list, k: int) -> list[list[tuple[Document, float]]]:
+        q = np.asarray(vectors, dtype=np.float32)
+        q /= np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        n = self._meta["rows"]
+        if not n or k <= 0: return [[] for _ in q]
+        best_s = np.empty((len(q), 0), dtype=np.float32)
+        best_i = np.empty((len(q), 0), dtype=np.int64)
+        for start in range(0, n, self.BLOCK):
+            stop = min(start + self.BLOCK, n)
+            sims = q @ self._dequantize(slice(start, stop)).T  # (queries, block): the whole batch in one matmul
+            sims[:, self._valid[start:stop] == 0] = -np.inf
+            cand_s = np.concatenate([best_s, sims], axis=1)
+            cand_i = np.concatenate([best_i, np.broadcast_to(np.arange(start, stop), sims.shape)], axis=1)
+            kk = min(k, cand_s.shape[1])
+            top = np.argpartition(-cand_s, kk - 1, axis=1)[:, :kk]
+            best_s, best_i = np.take_along_axis(cand_s, top, 1), np.take_along_axis(cand_i, top, 1)
+        order = np.argsort(-best_s, axis=1)
+        best_s, best_i = np.take_along_axis(best_s, order, 1), np.take_along_axis(best_i, order, 1)
+
+        wanted = sorted({int(r) for r, s in zip(best_i.ravel(), best_s.ravel()) if s != -np.inf})
+        docs = {}
+        for i in range(0, len(wanted), 500):
+            part = wanted[i:i + 500]
+            for row, doc, meta in self._db.execute(
+                    f"SELECT row, document, metadata FROM docs WHERE row IN ({','.join('?' * len(part))})", part):
+                docs[row] = Document(page_content=doc, metadata=json.loads(meta))
+        # 2 - 2cos is the squared L2 distance between unit vectors, matching Chroma's default space
+        return [[(docs[int(r)], float(2 - 2 * s)) for r, s in zip(rows, sims) if s != -np.inf and int(r) in docs]
+                for rows, sims in zip(best_i, best_s)]